@@ -1,24 +1,33 @@
+import array
 import copy
 import json
-
-import matplotlib.pyplot as plt
-from matplotlib.patches import Rectangle
-from matplotlib.offsetbox import OffsetImage, AnnotationBbox
+import sys
 
 # Function for plan generation using LLM outputs
-def convertChatPlanResToSpatParams(resStr, plot=True):
+def convertChatPlanResToSpatParams(resStr, plot=True, verbose=True, slim=False, engine=None, countdownTables=False):
     '''
     Convert json format plan results by LLM to plan scheme object, with plan result validation and visualization.
     
     Parameters:
-    resStr(json object as str): json format plan results by LLM, based on user's plan descriptions.
-    plot: boolean, whether to make a plot for the plan or not.
+    resStr(json object as str, or the parsed dict): json format plan results by LLM, based on user's plan descriptions.
+    A parsed dict is copied, never modified, so it can be cached and assembled again.
+    plot: boolean, whether to make a plot for the plan or not (shown with pyplot, for interactive use).
+    verbose: boolean, whether to print the validation result or not.
+    slim: boolean, whether to return a slim plan obj (see slimPlanRes), for holding many plans in memory.
+    engine(dict): step functions replacing those of the reference engine (dict_referenceEngine), e.g. an optimized engine in assemblyEngines.py.
+    countdownTables: boolean, whether to add the time to the next color change of each phase at each second (see getCountdownTables).
 
     Returns:
     resOfChat2SPaT(dict): The generated plan obj, with plan scheme including phase info and second-by-second traffic light color code.
     Warning msgs are included for plan validation.
     A plot of the traffic color is shown for visualization for users. 
+
+    With plot=False and verbose=False, the assembly has no side effects (no global state, no output, inputs not modified),
+    and can run concurrently in threads (see stressThreadSafety.py).
     '''
+    # Step functions of the assembly engine
+    engine = dict_referenceEngine if engine == None else dict(dict_referenceEngine, **engine)
+
     # Step 0: Read LLM outputs
 
     # List of format errors in LLM outputs:
@@ -28,7 +37,7 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
     # Type 3 format error: phaseName is recorded for the same movements of two opposing directions such as '南北直行'
 
     # Read LLM outputs
-    res=json.loads(resStr)
+    res=json.loads(resStr) if type(resStr) == str else copy.deepcopy(resStr)
     result1, result2, result3 = res["result1"], res["result2"], res["result3"]
 
     # Deal with Type 0 format error in result 1
@@ -394,7 +403,7 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
     # Update cycle length
     cycleLength = getCycleLengthOfPlanScheme(planSchemeMajor)
     # merge major phases
-    planSchemeMajorMerged = mergeConnectedPhaseInPlanScheme(planSchemeMajor)
+    planSchemeMajorMerged = engine['mergeConnectedPhaseInPlanScheme'](planSchemeMajor)
     #print(planSchemeMajorMerged)
 
     # Step 3: Add overlapped phases and standalone phases
@@ -406,7 +415,7 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
     # Get all phase names in planSchemeMajorMerged
     allPhaseNamesInPlanSchemeMajorMerged = set([ helper_getSubValueFromPhase('phaseName', _) for _ in planSchemeMajorMerged])
 
-    result2 = helper_updateConcurrentPhaseAttribute(result2, planSchemeMajorMerged)
+    result2 = helper_updateConcurrentPhaseAttribute(result2, planSchemeMajorMerged, engine['getDefaultParentPhaseList'])
     #print(result2)
 
     # Calculate the split for each concurrent phase in the updated result2.
@@ -484,7 +493,7 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
     # Update cycleLength again, after overlapped phases and standalone phases are added.
     cycleLength = getCycleLengthOfPlanScheme(planSchemeMinorAdded)
     # Merge minor phases
-    planSchemeMinorMerged = mergeConnectedPhaseInPlanScheme(planSchemeMinorAdded)
+    planSchemeMinorMerged = engine['mergeConnectedPhaseInPlanScheme'](planSchemeMinorAdded)
 
     # Final updating on each phase info
     for phase in planSchemeMinorMerged:
@@ -513,9 +522,50 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
     # This part is skipped for the study, but should be extended for real-world applications.
 
     # Step 5.3：generate second-by-second traffic light color code
-    allPhaseNamesInPlanSchemeMinorMerged = set([ helper_getSubValueFromPhase('phaseName', _) for _ in planSchemeMinorMerged])
-    dict_lightColorRec = {_: [0] * cycleLength for _ in allPhaseNamesInPlanSchemeMinorMerged}
-    for phase in planSchemeMinorMerged:
+    dict_lightColorRec = engine['paintLightColorRec'](planSchemeMinorMerged, cycleLength)
+    resOfChat2SPaT.update({'dict_lightColorRec': dict_lightColorRec})        
+
+    # Step 5.4: validation on conflicted movements
+    warningMsgConflictPhases = engine['checkConflictPhases'](dict_lightColorRec)
+    resOfChat2SPaT.update({'warningMsgConflictPhases': warningMsgConflictPhases})  # 记录冲突相位的校验结果
+
+    # Step 5.5：Ped WALK interval validation
+    warningMsgPedWalk = engine['checkPedWalkIntvl'](dict_lightColorRec)
+    resOfChat2SPaT.update({'warningMsgPedWalk': warningMsgPedWalk})
+
+    # Step 5.6：Assign validation result for the generatd plan
+    if len(resOfChat2SPaT['warningMsgConflictPhases']) == 0 and len(resOfChat2SPaT['warningMsgPedWalk']) == 0:
+        resOfChat2SPaT.update({'isValid': 1}) 
+        if verbose == True:
+            print('【The generated plan is VALID.】')
+    else:
+        resOfChat2SPaT.update({'isValid': 0}) 
+        if verbose == True:
+            print('【The generated plan is INVALID!】', resOfChat2SPaT['warningMsgConflictPhases'], resOfChat2SPaT['warningMsgPedWalk'])
+
+    # Step 5.7: Countdown tables (optional), for countdown displays and SPaT minEndTime
+    if countdownTables == True:
+        resOfChat2SPaT.update({'dict_countdownTables': engine['getCountdownTables'](dict_lightColorRec)})
+
+    # Slim result: no raw LLM outputs and dummy phases, color codes stored compactly
+    if slim == True:
+        resOfChat2SPaT = slimPlanRes(resOfChat2SPaT)
+
+    # Plan visualization
+    if plot == True: 
+        import matplotlib.pyplot as plt  # imported on demand, so plan assembly itself does not depend on matplotlib
+        plotPlanScheme(planSchemeMinorMerged, cycleLength, fig=plt.figure(figsize=(12, 8)))  # pyplot only manages the window
+        plt.show()
+
+    return resOfChat2SPaT
+
+# Step 5.3：generate second-by-second traffic light color code
+def paintLightColorRec(planScheme, cycleLength):
+    '''Color code of each phase at each second of the cycle: {phaseName: [colorCode] * cycleLength}.
+    0 - red, 1 - yellow, 2 - green / WALK, 3 - green flash / flashing don't walk, 4 - redAmber, -1 - permissive (lights off)'''
+    allPhaseNamesInPlanScheme = set([ helper_getSubValueFromPhase('phaseName', _) for _ in planScheme])
+    dict_lightColorRec = {_: [0] * cycleLength for _ in allPhaseNamesInPlanScheme}
+    for phase in planScheme:
         # Extract phase info
         phaseName = helper_getSubValueFromPhase('phaseName', phase)
         isPermissive = helper_getSubValueFromPhase('isPermissive', phase)
@@ -556,29 +606,32 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
             lightColorRec = helper_paintLightColor(lightColorRec, startTime+lateStart, redAmber, cycleLength, colorCode=4)
             dict_lightColorRec.update({phaseName: lightColorRec})
 
-    resOfChat2SPaT.update({'dict_lightColorRec': dict_lightColorRec})        
+    return dict_lightColorRec
 
-    # Step 5.4: validation on conflicted movements
-    conflictMatrix = {'北直行': ['东直行', '西直行', '东左转', '西左转', '北行人', '北行人二次过街A', '南行人', '南行人二次过街B', '南左转'],
-                      '东直行': ['南直行', '北直行', '南左转', '北左转', '东行人', '东行人二次过街A', '西行人', '西行人二次过街B', '西左转'],
-                      '南直行': ['西直行', '东直行', '西左转', '东左转', '南行人', '南行人二次过街A', '北行人', '北行人二次过街B', '北左转'],
-                      '西直行': ['北直行', '南直行', '北左转', '南左转', '西行人', '西行人二次过街A', '东行人', '东行人二次过街B', '东左转'],
-
-                      '北左转': ['东直行', '西直行', '东左转', '西左转', '北行人', '北行人二次过街A', '南直行'],
-                      '东左转': ['南直行', '北直行', '南左转', '北左转', '东行人', '东行人二次过街A', '西直行'],
-                      '南左转': ['西直行', '东直行', '西左转', '东左转', '南行人', '南行人二次过街A', '北直行'],
-                      '西左转': ['北直行', '南直行', '北左转', '南左转', '西行人', '西行人二次过街A', '东直行'],
-
-                      'SBT': ['WBT', 'EBT', 'WBL', 'EBL', 'NORTHPED', 'NORTHPEDa', 'SOUTHPED', 'SOUTHPEDB', 'NBL'],
-                      'WBT': ['NBT', 'SBT', 'NBL', 'SBL', 'EASTPED', 'EASTPEDA', 'WESTPED', 'WESTPEDB', 'EBL'],
-                      'NBT': ['EBT', 'WBT', 'EBL', 'WBL', 'SOUTHPED', 'SOUTHPEDA', 'NORTHPED', 'NORTHPEDB', 'SBL'],
-                      'EBT': ['SBT', 'NBT', 'SBL', 'NBL', 'WESTPED', 'WESTPEDA', 'EASTPED', 'EASTPEDB', 'WBL'],
-
-                      'SBL': ['WBT', 'EBT', 'WBL', 'EBL', 'NORTHPED', 'NORTHPEDA', 'NBT'],
-                      'WBL': ['NBT', 'SBT', 'NBL', 'SBL', 'EASTPED', 'EASTPEDA', 'EBT'],
-                      'NBL': ['EBT', 'WBT', 'EBL', 'WBL', 'SOUTHPED', 'SOUTHPEDA', 'SBT'],
-                      'EBL': ['SBT', 'NBT', 'SBL', 'NBL', 'WESTPED', 'WESTPEDA', 'WBT']
-                     }
+# Step 5.4: validation on conflicted movements
+conflictMatrix = {'北直行': ['东直行', '西直行', '东左转', '西左转', '北行人', '北行人二次过街A', '南行人', '南行人二次过街B', '南左转'],
+                  '东直行': ['南直行', '北直行', '南左转', '北左转', '东行人', '东行人二次过街A', '西行人', '西行人二次过街B', '西左转'],
+                  '南直行': ['西直行', '东直行', '西左转', '东左转', '南行人', '南行人二次过街A', '北行人', '北行人二次过街B', '北左转'],
+                  '西直行': ['北直行', '南直行', '北左转', '南左转', '西行人', '西行人二次过街A', '东行人', '东行人二次过街B', '东左转'],
+
+                  '北左转': ['东直行', '西直行', '东左转', '西左转', '北行人', '北行人二次过街A', '南直行'],
+                  '东左转': ['南直行', '北直行', '南左转', '北左转', '东行人', '东行人二次过街A', '西直行'],
+                  '南左转': ['西直行', '东直行', '西左转', '东左转', '南行人', '南行人二次过街A', '北直行'],
+                  '西左转': ['北直行', '南直行', '北左转', '南左转', '西行人', '西行人二次过街A', '东直行'],
+
+                  'SBT': ['WBT', 'EBT', 'WBL', 'EBL', 'NORTHPED', 'NORTHPEDa', 'SOUTHPED', 'SOUTHPEDB', 'NBL'],
+                  'WBT': ['NBT', 'SBT', 'NBL', 'SBL', 'EASTPED', 'EASTPEDA', 'WESTPED', 'WESTPEDB', 'EBL'],
+                  'NBT': ['EBT', 'WBT', 'EBL', 'WBL', 'SOUTHPED', 'SOUTHPEDA', 'NORTHPED', 'NORTHPEDB', 'SBL'],
+                  'EBT': ['SBT', 'NBT', 'SBL', 'NBL', 'WESTPED', 'WESTPEDA', 'EASTPED', 'EASTPEDB', 'WBL'],
+
+                  'SBL': ['WBT', 'EBT', 'WBL', 'EBL', 'NORTHPED', 'NORTHPEDA', 'NBT'],
+                  'WBL': ['NBT', 'SBT', 'NBL', 'SBL', 'EASTPED', 'EASTPEDA', 'EBT'],
+                  'NBL': ['EBT', 'WBT', 'EBL', 'WBL', 'SOUTHPED', 'SOUTHPEDA', 'SBT'],
+                  'EBL': ['SBT', 'NBT', 'SBL', 'NBL', 'WESTPED', 'WESTPEDA', 'WBT']
+                 }
+
+def checkConflictPhases(dict_lightColorRec):
+    '''Conflicting phases timed simultaneously: {'phaseName|phaseConflictName': [[start, end], ...]}'''
     warningMsgConflictPhases = {}
     checkedPhaseNames = []  # 记录已经对比过的相位
     for phaseName in dict_lightColorRec:
@@ -597,125 +650,95 @@ def convertChatPlanResToSpatParams(resStr, plot=True):
 
         checkedPhaseNames.append(phaseName)
 
-    resOfChat2SPaT.update({'warningMsgConflictPhases': warningMsgConflictPhases})  # 记录冲突相位的校验结果
-
-    # Step 5.5：Ped WALK interval validation
-    warningMsgPedWalk = checkPedWalkIntvl(dict_lightColorRec)
-    resOfChat2SPaT.update({'warningMsgPedWalk': warningMsgPedWalk})
+    return warningMsgConflictPhases
 
-    # Step 5.6：Assign validation result for the generatd plan
-    if len(resOfChat2SPaT['warningMsgConflictPhases']) == 0 and len(resOfChat2SPaT['warningMsgPedWalk']) == 0:
-        resOfChat2SPaT.update({'isValid': 1}) 
-        print('【The generated plan is VALID.】')
-    else:
-        resOfChat2SPaT.update({'isValid': 0}) 
-        print('【The generated plan is INVALID!】', resOfChat2SPaT['warningMsgConflictPhases'], resOfChat2SPaT['warningMsgPedWalk'])
+# Slim plan obj
+def slimPlanRes(resOfChat2SPaT):
+    '''
+    Return a slim copy of the generated plan obj, for holding many plans in memory:
+    resStr (the raw LLM outputs) is dropped, DUMMYPHASE is removed from planSchemeMinorMerged,
+    phase attribute names are interned (shared by all plans),
+    and each row of dict_lightColorRec is an array of signed bytes ('b') instead of a list of int (as are the rows of dict_countdownTables, 'h' for timeToChange).
+    The arrays support len(), indexing, slicing and iteration as the lists do, but are not json serializable (use list(row)).
+    '''
+    resSlim = {}
+    for k in resOfChat2SPaT:
+        if k == 'resStr':
+            continue
+        elif k == 'planSchemeMinorMerged':
+            planScheme = []
+            for phase in resOfChat2SPaT[k]:
+                phaseName = helper_getSubValueFromPhase('phaseName', phase)
+                if phaseName == 'DUMMYPHASE':
+                    continue
+                planScheme.append({sys.intern(phaseName): {sys.intern(attr): v for attr, v in phase[phaseName].items()}})
+            resSlim[k] = planScheme
+        elif k == 'dict_lightColorRec':
+            resSlim[k] = {sys.intern(phaseName): array.array('b', row) for phaseName, row in resOfChat2SPaT[k].items()}
+        elif k == 'dict_countdownTables':
+            resSlim[k] = {sys.intern(phaseName): {'timeToChange': array.array('h', table['timeToChange']), 'nextColor': array.array('b', table['nextColor'])}
+                          for phaseName, table in resOfChat2SPaT[k].items()}
+        else:
+            resSlim[k] = resOfChat2SPaT[k]
+    return resSlim
+
+# Plan visualization: signal times table
+def plotPlanScheme(planScheme, cycleLength, fig=None):
+    '''Draw the signal times table of the plan scheme (dummy phases excluded) with matplotlib, and return the figure.
+    The figure is a new matplotlib Figure not registered in pyplot (save it with fig.savefig), or fig if given.
+    No global matplotlib state (pyplot, rcParams) is used, so figures can be drawn concurrently in threads.'''
+    planScheme = [_ for _ in planScheme if helper_getSubValueFromPhase('phaseName', _) != 'DUMMYPHASE']  # as stored in the plan obj, with dummy phases
+    if fig == None:
+        from matplotlib.figure import Figure
+        fig = Figure(figsize=(12, 8))
+    figW, figH = fig.get_size_inches()
+    ax = fig.subplots()
+    ax.plot([],[],color="cyan")
+
+    unitHeight = 1  # 单位相位的高度
+    spaceBtwBars = 0.1
+
+    planSchemeSorted, dict_rowOfPhases = helper_getPhasePlotRows(planScheme)
+    phasePlotNum = len(dict_rowOfPhases)  # non-dpulicated phase names
+    # paint the whole cycle as red first
+    for phaseName in dict_rowOfPhases:
+        y1 = unitHeight*(phasePlotNum-dict_rowOfPhases[phaseName])
+        drawRectangleInCycle(ax, 0, cycleLength, y1, unitHeight-spaceBtwBars, cycleLength, 'red')
+
+    for phase in planSchemeSorted:
+        # Extract phase info
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        startTime = helper_getSubValueFromPhase('startTime', phase)
+        lateStart = helper_getSubValueFromPhase('lateStart', phase)
+        redAmber = helper_getSubValueFromPhase('redAmber', phase)
 
-    # Plan visualization
-    if plot == True: 
-        figW, figH = 12, 8
-        fig, ax = plt.subplots(figsize=(figW, figH))
-        ax.plot([],[],color="cyan")
-
-        unitHeight = 1  # 单位相位的高度
-        spaceBtwBars = 0.1
-        cnt = 0         # 已画的相位的个数（先算出总个数，然后从上往下画）
-        dict_y1OfPhases = {}  # 记录各相位的bar的y坐标；同名相位的
-
-        planSchemeSorted = sorted(planSchemeMinorMerged, key=lambda x: helper_getSubValueFromPhase('startTime', x), reverse=False)
-        phasePlotNum = len(set([helper_getSubValueFromPhase('phaseName', _) for _ in planSchemeSorted]))  # non-dpulicated phase names
-
-
-        for phase in planSchemeSorted:
-            # Extract phase info
-            phaseName = helper_getSubValueFromPhase('phaseName', phase)
-            isPermissive = helper_getSubValueFromPhase('isPermissive', phase)
-            startTime = helper_getSubValueFromPhase('startTime', phase)
-            endTime = helper_getSubValueFromPhase('endTime', phase)
-            split = helper_getSubValueFromPhase('split', phase)
-            lateStart = helper_getSubValueFromPhase('lateStart', phase)
-            greenFlash = helper_getSubValueFromPhase('greenFlash', phase)
-            yellow = helper_getSubValueFromPhase('yellow', phase)
-            allRed = helper_getSubValueFromPhase('allRed', phase)
-            redAmber = helper_getSubValueFromPhase('redAmber', phase)
-            earlyCutOff = helper_getSubValueFromPhase('earlyCutOff', phase)
-            countDown = helper_getSubValueFromPhase('countDown', phase)
-
-            # Draw rectangles
-            # y1 of Anchor point
-            if phaseName not in dict_y1OfPhases:
-                y1 = unitHeight*(phasePlotNum-cnt)
-                dict_y1OfPhases.update({phaseName: y1})
-                # Update cnt
-                cnt += 1
-                # paint the whole cycle as red first
-                drawRectangleInCycle(ax, 0, cycleLength, y1, unitHeight-spaceBtwBars, cycleLength, 'red')
+        # Draw rectangles, on the row of the phase (phases with the same name are drawn on the same row)
+        y1 = unitHeight*(phasePlotNum-dict_rowOfPhases[phaseName])
+        for t1, width, color, barPart in helper_getPhasePlotRectangles(phase, cycleLength):
+            if barPart == 'lower':
+                drawRectangleInCycle(ax, t1, width, y1, 0.5*(unitHeight-spaceBtwBars), cycleLength, color)
+            elif barPart == 'upper':
+                drawRectangleInCycle(ax, t1, width, y1+0.5*(unitHeight-spaceBtwBars), 0.5*(unitHeight-spaceBtwBars), cycleLength, color)
             else:
-                y1 = dict_y1OfPhases[phaseName]  # use the y-coord of the phase which already exists, to draw on the same row
-            # 对行人和机动车相位分别画图
-            if '行人' in phaseName or 'PED' in phaseName:  # ped phase
-                walk = split - lateStart - countDown - allRed - earlyCutOff # 由split计算出的walk时长
-                # lateStart (in red)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime, cycleLength), lateStart,\
-                                     y1, unitHeight-spaceBtwBars, cycleLength, 'red')
-                # walk (in green)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), walk,\
-                                     y1, unitHeight-spaceBtwBars, cycleLength, 'green')
-                # flashing don't walk (in green dashed)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart + walk, cycleLength), countDown,\
-                                     y1, unitHeight-spaceBtwBars, cycleLength, 'lightgreen')
-            else:  # vehicular phases
-                greenTimeWithoutGreenFlash = split - lateStart - greenFlash - yellow - allRed - earlyCutOff  # 由split计算出的‘真’绿灯时长
-                # lateStart (in red)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime, cycleLength), lateStart,\
-                                     y1, unitHeight-spaceBtwBars, cycleLength, 'red')
-                # Draw green and greenFlash / permissive green
-                if isPermissive == 0:
-                    # green (in green)
-                    drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), greenTimeWithoutGreenFlash,\
-                                         y1, unitHeight-spaceBtwBars, cycleLength, 'green')
-                    # greenFlash (in green dashed)
-                    drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart + greenTimeWithoutGreenFlash, cycleLength), greenFlash,\
-                                         y1, unitHeight-spaceBtwBars, cycleLength, 'lightgreen')
-                else:
-                    # permissive green (in grey)
-                    permissiveDuration = split - lateStart - yellow - allRed - earlyCutOff  # duration of lights off for permissive phase
-                    drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), permissiveDuration,\
-                                         y1, unitHeight-spaceBtwBars, cycleLength, 'dimgrey')
-                # yellow (in yellow)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart + greenTimeWithoutGreenFlash + greenFlash, cycleLength), yellow,\
-                                     y1, unitHeight-spaceBtwBars, cycleLength, 'yellow')
-                # allRed (in red)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart + greenTimeWithoutGreenFlash + greenFlash + yellow, cycleLength), allRed,\
-                                     y1, unitHeight-spaceBtwBars, cycleLength, 'red')
-                # redAmber (in yellow+red)
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), redAmber,\
-                                     y1, 0.5*(unitHeight-spaceBtwBars), cycleLength, 'yellow')
-                drawRectangleInCycle(ax, helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), redAmber,\
-                                     y1+0.5*(unitHeight-spaceBtwBars), 0.5*(unitHeight-spaceBtwBars), cycleLength, 'red')
-
-            # Add text and symbol of the phase
-            fontsizeModifier = calcFontsizeModifier(figH, phasePlotNum)
-            plt.rcParams['font.family']=['SimHei'] #用来正常显示中文标签
-            ax.text(helper_modifyCyclicTimepoint(startTime + lateStart + redAmber + 1, cycleLength), y1 + 0.51, phaseName, style='italic', fontsize=int(14*fontsizeModifier), rotation = 0)  # 写入相位名称
-            text, rotation = getPhasePlotLabelAndRotation(phaseName)
-            plt.rcParams['font.family'] = 'DejaVu Sans'  # Ensure the font supports Unicode
-            ax.text(helper_modifyCyclicTimepoint(startTime + lateStart + redAmber + 1, cycleLength), y1 + 0.18, text, fontsize=int(15*fontsizeModifier), rotation = rotation)
-
-        # Set labels, titles, ticks
-        ax.set_ylabel('Phases',  fontsize=16, color='k')
-        ax.set_xlabel('Timeline within a cycle',  fontsize=16, color='k')
-        ax.yaxis.set_ticks([]) 
-        xtick_list = [_ * 10 for _ in range(cycleLength//10 + 1)]
-        if cycleLength % 10 > 0:
-            if cycleLength % 10 < 3:  # If the last tick is too close to cycleLength, remove it
-                xtick_list  =xtick_list[:-1]
-            xtick_list.append(cycleLength)
-        plt.xticks(xtick_list, xtick_list, fontsize=12, rotation=0)
-
-        plt.show()
-
-    return resOfChat2SPaT
+                drawRectangleInCycle(ax, t1, width, y1, unitHeight-spaceBtwBars, cycleLength, color)
+
+        # Add text and symbol of the phase
+        fontsizeModifier = calcFontsizeModifier(figH, phasePlotNum)
+        ax.text(helper_modifyCyclicTimepoint(startTime + lateStart + redAmber + 1, cycleLength), y1 + 0.51, phaseName, style='italic', fontsize=int(14*fontsizeModifier), rotation = 0,
+                fontfamily=['SimHei'])  # 写入相位名称, SimHei用来正常显示中文标签
+        text, rotation = getPhasePlotLabelAndRotation(phaseName)
+        ax.text(helper_modifyCyclicTimepoint(startTime + lateStart + redAmber + 1, cycleLength), y1 + 0.18, text, fontsize=int(15*fontsizeModifier), rotation = rotation,
+                fontfamily='DejaVu Sans')  # Ensure the font supports Unicode
+
+    # Set labels, titles, ticks
+    ax.set_ylabel('Phases',  fontsize=16, color='k', fontfamily='DejaVu Sans')
+    ax.set_xlabel('Timeline within a cycle',  fontsize=16, color='k', fontfamily='DejaVu Sans')
+    ax.yaxis.set_ticks([]) 
+    xtick_list = helper_getXtickList(cycleLength)
+    ax.set_xticks(xtick_list)
+    ax.set_xticklabels(xtick_list, fontsize=12, rotation=0)
+
+    return fig
 
 # HELPER FUNCTIONS
 # 【Step 1-4】helper functions 
@@ -837,9 +860,12 @@ def helper_modifyCyclicTimepoint(t, cycleLength): #
     return t%cycleLength
 
 #0606 ABCD debug
-def helper_updateConcurrentPhaseAttribute(result2, planSchemeMajorMerged):
+def helper_updateConcurrentPhaseAttribute(result2, planSchemeMajorMerged, getDefaultParentPhaseList=None):
     '''In step three, update phase attribute - result2.
-    replace placeholder of parentPhase and overlapNum'''
+    replace placeholder of parentPhase and overlapNum.
+    getDefaultParentPhaseList: default parent phases of a phase with parentPhase 'default' (helper_getDefaultParentPhaseList if None)'''
+    if getDefaultParentPhaseList == None:
+        getDefaultParentPhaseList = helper_getDefaultParentPhaseList
     result2_formatted = []
     # Get all phase names in planSchemeMajorMerged
     allPhaseNamesInPlanSchemeMajorMerged = set([ helper_getSubValueFromPhase('phaseName', _) for _ in planSchemeMajorMerged])
@@ -859,7 +885,7 @@ def helper_updateConcurrentPhaseAttribute(result2, planSchemeMajorMerged):
             result2_formatted.append(phase)
             continue
         elif parentPhaseName == 'default':
-            parentPhaseName = helper_getDefaultParentPhaseList(phaseName)
+            parentPhaseName = getDefaultParentPhaseList(phaseName)
             phase[phaseName].update({'parentPhase': parentPhaseName})
         elif ',' in parentPhaseName:  # multiple parent phases are recorded as one, e.g. parentPhase = 'NBT, SBT'
             parentPhaseName = [_.replace(' ', '').replace('[', '').replace(']', '') for _ in parentPhaseName.split(',')]
@@ -1121,31 +1147,35 @@ def getCycleLengthOfPlanScheme(planScheme):
         cycleLength = max(cycleLength, endTime)
     return cycleLength
 
+# Default values of phase attributes
+dict_defaultValues = {"lateStart": 0, "earlyCutOff": 0,
+                      "allRed": 0, "greenFlash": 0,
+                      "redAmber": 0, "isPermissive": 0,
+                      "startTime": None, "endTime": None,
+                      "startOfGreen": None, "endOfGreen": None,
+                      "split": None, "greenTime": None,
+                      "yellow": 3, "countDown": 9,
+                      "phaseId": None, "isProhibited": 0,
+                      "maxGreen": 60, "minGreen": 5,
+                      "parentPhase": None, "overlapNum": None}
+
 # helper 从phase结构体中获取二级结构的字典值
 def helper_getSubValueFromPhase(k, phase, getDefaultValue=False):
-    phaseName = list(phase.keys())[0]
+    phaseName = next(iter(phase))
     if k == 'phaseName':
         return phaseName
-    dict_defaultValues = {"lateStart": 0, "earlyCutOff": 0,
-                          "allRed": 0, "greenFlash": 0,
-                          "redAmber": 0, "isPermissive": 0,
-                          "startTime": None, "endTime": None,
-                          "startOfGreen": None, "endOfGreen": None,
-                          "split": None, "greenTime": None,
-                          "yellow": 3, "countDown": 9,
-                          "phaseId": None, "isProhibited": 0,
-                          "maxGreen": 60, "minGreen": 5,
-                          "parentPhase": None, "overlapNum": None}
     # Covnert required key and phase atrributes to capital and mathch
-    for key in phase[phaseName].keys():
-        if key.replace(' ', '').upper() == k.replace(' ', '').upper():
-            return phase[phaseName][key]
+    kFormatted = k.replace(' ', '').upper()
+    phaseInfo = phase[phaseName]
+    for key in phaseInfo:
+        if key == k or key.replace(' ', '').upper() == kFormatted:
+            return phaseInfo[key]
     
     # Key does not exist in the phase, return default value 
-    if k not in phase[phaseName].keys() or getDefaultValue==True:
+    if k not in phaseInfo or getDefaultValue==True:
         return dict_defaultValues[k]
     # Get values of a key directly
-    return phase[phaseName][k]
+    return phaseInfo[k]
 
 # helper 根据planScheme中已获取的相位，为当前的相位写入order(从1开始计数)
 def helper_AssignPhaseOrder(planScheme, phaseName):
@@ -1364,6 +1394,30 @@ def checkPedWalkIntvl(dict_lightColorRec):
         #print(listOfWalkShort, listOfWalk)   
     return res
 
+# Step 5.7: time to the next color change at each second, for countdown displays and SPaT minEndTime
+def getCountdownTables(dict_lightColorRec):
+    '''
+    For each phase and each second t of the cycle: the seconds until its color changes (the change happens at t + timeToChange),
+    and the color code after the change. The cycle is cyclic: a color lasting over the end of the cycle counts down into the next cycle.
+    A phase whose color never changes gets the cycle length and its own color.
+    Example: {"NBT": [2,2,1,0,0]} -> {'NBT': {'timeToChange': [2,1,1,2,1], 'nextColor': [1,1,0,2,2]}}
+    '''
+    res = {}
+    for phaseName, row in dict_lightColorRec.items():
+        cycleLength = len(row)
+        timeToChange, nextColor = [cycleLength] * cycleLength, list(row)
+        # The last change point of the cycle; the reverse scan starts just before it and runs one full cycle back
+        lastChange = next((t for t in range(cycleLength - 1, -1, -1) if row[t] != row[t - 1]), None)
+        if lastChange != None:
+            countDown, colorAfter = 0, row[lastChange]
+            for t in range(lastChange - 1, lastChange - 1 - cycleLength, -1):  # negative t wraps to the end of the cycle
+                if row[t] != row[t + 1]:
+                    countDown, colorAfter = 0, row[t + 1]
+                countDown += 1
+                timeToChange[t], nextColor[t] = countDown, colorAfter
+        res.update({phaseName: {'timeToChange': timeToChange, 'nextColor': nextColor}})
+    return res
+
 # fontsize modifier
 def calcFontsizeModifier(figH, N):
     '''figH - the height of the figure
@@ -1405,10 +1459,82 @@ def getPhasePlotLabelAndRotation(phaseName):
     
     return ['', 0]
 
+# rows of the phases in the plot
+def helper_getPhasePlotRows(planScheme):
+    '''Sort the phases by startTime, and assign a row (counting from 0, top to bottom) to each phase name.
+    Phases with the same name share the same row. Every phase given is plotted.'''
+    planSchemeSorted = sorted(planScheme, key=lambda x: helper_getSubValueFromPhase('startTime', x), reverse=False)
+    dict_rowOfPhases = {}
+    for phase in planSchemeSorted:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        if phaseName not in dict_rowOfPhases:
+            dict_rowOfPhases.update({phaseName: len(dict_rowOfPhases)})
+    return planSchemeSorted, dict_rowOfPhases
+
+# rectangles of a phase in the plot
+def helper_getPhasePlotRectangles(phase, cycleLength):
+    '''Return the rectangles to draw for the phase on its row (painted over the red background), in drawing order.
+    Each rectangle is [t1, width, color, barPart]; barPart is 'full', or 'lower'/'upper' for the two halves of redAmber.'''
+    phaseName = helper_getSubValueFromPhase('phaseName', phase)
+    isPermissive = helper_getSubValueFromPhase('isPermissive', phase)
+    startTime = helper_getSubValueFromPhase('startTime', phase)
+    split = helper_getSubValueFromPhase('split', phase)
+    lateStart = helper_getSubValueFromPhase('lateStart', phase)
+    greenFlash = helper_getSubValueFromPhase('greenFlash', phase)
+    yellow = helper_getSubValueFromPhase('yellow', phase)
+    allRed = helper_getSubValueFromPhase('allRed', phase)
+    redAmber = helper_getSubValueFromPhase('redAmber', phase)
+    earlyCutOff = helper_getSubValueFromPhase('earlyCutOff', phase)
+    countDown = helper_getSubValueFromPhase('countDown', phase)
+
+    rectangles = []
+    # 对行人和机动车相位分别画图
+    if '行人' in phaseName or 'PED' in phaseName:  # ped phase
+        walk = split - lateStart - countDown - allRed - earlyCutOff # 由split计算出的walk时长
+        # lateStart (in red)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime, cycleLength), lateStart, 'red', 'full'])
+        # walk (in green)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), walk, 'green', 'full'])
+        # flashing don't walk (in green dashed)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart + walk, cycleLength), countDown, 'lightgreen', 'full'])
+    else:  # vehicular phases
+        greenTimeWithoutGreenFlash = split - lateStart - greenFlash - yellow - allRed - earlyCutOff  # 由split计算出的‘真’绿灯时长
+        # lateStart (in red)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime, cycleLength), lateStart, 'red', 'full'])
+        # Draw green and greenFlash / permissive green
+        if isPermissive == 0:
+            # green (in green)
+            rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), greenTimeWithoutGreenFlash, 'green', 'full'])
+            # greenFlash (in green dashed)
+            rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart + greenTimeWithoutGreenFlash, cycleLength), greenFlash, 'lightgreen', 'full'])
+        else:
+            # permissive green (in grey)
+            permissiveDuration = split - lateStart - yellow - allRed - earlyCutOff  # duration of lights off for permissive phase
+            rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), permissiveDuration, 'dimgrey', 'full'])
+        # yellow (in yellow)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart + greenTimeWithoutGreenFlash + greenFlash, cycleLength), yellow, 'yellow', 'full'])
+        # allRed (in red)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart + greenTimeWithoutGreenFlash + greenFlash + yellow, cycleLength), allRed, 'red', 'full'])
+        # redAmber (in yellow+red)
+        rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), redAmber, 'yellow', 'lower'])
+        rectangles.append([helper_modifyCyclicTimepoint(startTime + lateStart, cycleLength), redAmber, 'red', 'upper'])
+    return rectangles
+
+# ticks of the timeline
+def helper_getXtickList(cycleLength):
+    '''Ticks every 10s, and the cycle length at the end. cycleLength = 104 -> [0, 10, ..., 90, 104]'''
+    xtick_list = [_ * 10 for _ in range(cycleLength//10 + 1)]
+    if cycleLength % 10 > 0:
+        if cycleLength % 10 < 3:  # If the last tick is too close to cycleLength, remove it
+            xtick_list  =xtick_list[:-1]
+        xtick_list.append(cycleLength)
+    return xtick_list
+
 # draw rectangle
 def drawRectangleInCycle(ax, t1, width, y1, height, cycleLength, color):
     '''draw rectangle within cycle. t1->t2, or 0->t2 + t1 -> cycleLength,
     y1-y coord of the anchor point， width = t2-t1'''
+    from matplotlib.patches import Rectangle
     t2 = (t1 + width) % cycleLength
     if width == 0:#t1 == t2:
         return
@@ -1428,4 +1554,12 @@ def helper_paintLightColor(listToPaint, startTime, duration, cycleLength, colorC
     else:
         listToPaint[startTime:cycleLength] = [colorCode] * (cycleLength-startTime)
         listToPaint[0:duration-(cycleLength-startTime)] = [colorCode] * (duration-(cycleLength-startTime))
-    return listToPaint
\ No newline at end of file
+    return listToPaint
+
+# Step functions of the reference engine
+dict_referenceEngine = {'mergeConnectedPhaseInPlanScheme': mergeConnectedPhaseInPlanScheme,
+                        'paintLightColorRec': paintLightColorRec,
+                        'checkConflictPhases': checkConflictPhases,
+                        'checkPedWalkIntvl': checkPedWalkIntvl,
+                        'getCountdownTables': getCountdownTables,
+                        'getDefaultParentPhaseList': helper_getDefaultParentPhaseList}
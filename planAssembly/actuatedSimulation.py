@@ -0,0 +1,233 @@
+# Actuated control of an assembled plan: vectorized Monte Carlo simulation of gap-out, max-out and skipped stages
+#
+# The cycle of the fixed-time plan is cut into stages where a vehicle phase gets the right of way (as the stage table of planExport;
+# for a ring style plan, the intervals between the phase starts of all rings, so the barriers are kept). The stages run in the same
+# order; the green of a stage is actuated by the movements ending in it (min green, passage time gap-out, max green), followed by
+# its fixed clearance (redAmber, green flash, yellow, allRed of the fixed-time stage). A stage is skipped if none of the movements
+# starting in it has vehicles waiting. Ped phases follow their parent movements and are not simulated.
+# All replications run at once, second by second, as numpy arrays; Poisson arrivals are sampled in batches of seconds.
+#
+# Run: python actuatedSimulation.py [--plans 200] [--replications 200] [--cycles 30]
+import time
+
+import numpy as np
+
+from Chat2SPaT import helper_getSubValueFromPhase
+from planExport import iterStageTableRows
+from splitOptimizer import helper_getFlow
+
+def simulateActuatedPlan(resOfChat2SPaT, dict_movementFlows, numCycles=30, numReplications=200, passageTime=3,
+                         permissiveFactor=0.5, recall=False, batchSeconds=300, seed=0):
+    '''
+    Simulate the assembled plan under actuated control with random (Poisson) arrivals.
+
+    Parameters:
+    resOfChat2SPaT(dict): the assembled plan obj (full or slim); minGreen and maxGreen of the phases of planSchemeMinorMerged
+                          (default 5 and 60) bound the actuated greens.
+    dict_movementFlows(dict): movement -> flow (veh/h) or {'flow': veh/h, 'saturationFlow': veh/h (default 1800)}, as in
+                              splitOptimizer; movements of the plan without a flow get no arrivals.
+    numCycles: simulated time, in fixed-time cycles.
+    numReplications: independent replications, run at once.
+    passageTime: a green gaps out when no ending movement had an arrival or a waiting vehicle for passageTime seconds.
+    permissiveFactor: saturation flow factor of permissive movements (-1 at the start of the stage).
+    recall: if True, no stage is skipped.
+    batchSeconds: seconds of arrivals sampled at once.
+
+    Returns:
+    dict of stages (per stage: phases, fixedGreen, avgGreen, skipRate, gapOutRate, maxOutRate), movements (per movement:
+    greenUtilisation = departures / capacity offered in green, avgDelay (s/veh), residualQueue (veh, mean at the end)),
+    avgCycleLength (s) and simulatedSeconds (per replication).
+    '''
+    rnd = np.random.default_rng(seed)
+    stages = helper_getStageStructure(resOfChat2SPaT, permissiveFactor)
+    movementNames, numStages = stages['movementNames'], len(stages['rows'])
+    R, M = numReplications, len(movementNames)
+    flows = np.array([helper_getFlow(dict_movementFlows[_])[0] if _ in dict_movementFlows else 0 for _ in movementNames]) / 3600
+    saturationFlows = np.array([helper_getFlow(dict_movementFlows[_])[1] if _ in dict_movementFlows else 1800 for _ in movementNames]) / 3600
+    capacityOfStage = saturationFlows * stages['saturationFactor']  # (stages, movements), veh/s in green
+    capacityOfClearance = capacityOfStage * stages['clearanceIncidence']
+    capacityOfStage = capacityOfStage * stages['incidence']
+
+    # Step 1: State of the replications
+    stage = np.zeros(R, dtype=int)
+    inGreen = np.zeros(R, dtype=bool)
+    clearanceLeft = np.zeros(R, dtype=int)
+    stageGreenElapsed = np.zeros(R, dtype=int)
+    queue = np.zeros((R, M))
+    gapTimer = np.full((R, M), passageTime)
+    greenElapsed = np.zeros((R, M), dtype=int)
+    dict_counts = {k: np.zeros(numStages) for k in ['served', 'skipped', 'gapOut', 'maxOut', 'green']}
+    departures, capacity, queueSeconds, arrivals = np.zeros(M), np.zeros(M), np.zeros(M), np.zeros(M)
+
+    def enterStage(mask):
+        # skip the stages without demand of their starting movements (at most one cycle of skips)
+        for _ in range(numStages):
+            noDemand = mask & (not recall) & ~((queue > 0) & stages['startingIncidence'][stage]).any(axis=1)
+            if not noDemand.any():
+                break
+            dict_counts['skipped'] += np.bincount(stage[noDemand], minlength=numStages)
+            stage[noDemand] = (stage[noDemand] + 1) % numStages
+        dict_counts['served'] += np.bincount(stage[mask], minlength=numStages)
+        inGreen[mask] = stages['fixedGreen'][stage[mask]] > 0
+        clearanceLeft[mask] = np.where(inGreen[mask], 0, stages['lostTime'][stage[mask]])
+        stageGreenElapsed[mask] = 0
+
+    enterStage(np.ones(R, dtype=bool))
+    simulatedSeconds = numCycles * stages['cycleLength']
+    for t in range(simulatedSeconds):
+        if t % batchSeconds == 0:
+            arrivalBatch = rnd.poisson(flows, size=(min(batchSeconds, simulatedSeconds - t), R, M))
+
+        # Step 2: Arrivals and departures of the second
+        arrivalsOfSecond = arrivalBatch[t % batchSeconds]
+        queue += arrivalsOfSecond
+        capacityOfSecond = np.where(inGreen[:, None], capacityOfStage[stage], capacityOfClearance[stage])
+        departuresOfSecond = np.minimum(queue, capacityOfSecond)
+        queue -= departuresOfSecond
+        departures += departuresOfSecond.sum(axis=0)
+        capacity += capacityOfSecond.sum(axis=0)
+        queueSeconds += queue.sum(axis=0)
+        arrivals += arrivalsOfSecond.sum(axis=0)
+        gapTimer = np.where((arrivalsOfSecond > 0) | (queue > 1e-9), 0, gapTimer + 1)
+        greenElapsed = np.where(capacityOfSecond > 0, greenElapsed + 1, 0)
+
+        # Step 3: Gap-out and max-out of the actuated greens
+        wasInGreen = inGreen.copy()
+        stageGreenElapsed += wasInGreen
+        endingIncidence = stages['endingIncidence'][stage]
+        minGreenDone = np.all(~endingIncidence | (greenElapsed >= stages['minGreen']), axis=1)
+        gappedOut = np.all(~endingIncidence | (gapTimer >= passageTime), axis=1)
+        maxedOut = wasInGreen & np.any(endingIncidence & (greenElapsed >= stages['maxGreen']), axis=1)
+        gapOut = wasInGreen & minGreenDone & gappedOut & ~maxedOut
+        endOfGreen = gapOut | maxedOut
+        if endOfGreen.any():
+            dict_counts['gapOut'] += np.bincount(stage[gapOut], minlength=numStages)
+            dict_counts['maxOut'] += np.bincount(stage[maxedOut], minlength=numStages)
+            dict_counts['green'] += np.bincount(stage[endOfGreen], stageGreenElapsed[endOfGreen], minlength=numStages)
+        inGreen[endOfGreen] = False
+        clearanceLeft[endOfGreen] = stages['lostTime'][stage[endOfGreen]]
+
+        # Step 4: Clearance, then the next stage
+        clearanceLeft[~wasInGreen] -= 1
+        endOfStage = ~inGreen & (clearanceLeft <= 0)
+        if endOfStage.any():
+            stage[endOfStage] = (stage[endOfStage] + 1) % numStages
+            enterStage(endOfStage)
+
+    ended = dict_counts['gapOut'] + dict_counts['maxOut']
+    cycles = dict_counts['served'][0] + dict_counts['skipped'][0] - R  # returns to the first stage
+    resOfSimulation = {'stages': [], 'movements': {}, 'simulatedSeconds': simulatedSeconds,
+                       'avgCycleLength': round(simulatedSeconds * R / cycles, 2) if cycles > 0 else None}
+    for k, row in enumerate(stages['rows']):
+        resOfSimulation['stages'].append({'phases': row['phases'], 'fixedGreen': row['green'],
+                                          'avgGreen': round(float(dict_counts['green'][k] / ended[k]), 2) if ended[k] > 0 else None,
+                                          'skipRate': helper_ratio(dict_counts['skipped'][k], dict_counts['skipped'][k] + dict_counts['served'][k]),
+                                          'gapOutRate': helper_ratio(dict_counts['gapOut'][k], ended[k]),
+                                          'maxOutRate': helper_ratio(dict_counts['maxOut'][k], ended[k])})
+    for m, movementName in enumerate(movementNames):
+        resOfSimulation['movements'][movementName] = {'greenUtilisation': helper_ratio(departures[m], capacity[m]),
+                                                      'avgDelay': helper_ratio(queueSeconds[m], arrivals[m]),
+                                                      'residualQueue': round(float(queue[:, m].mean()), 2)}
+    return resOfSimulation
+
+def screenPlans(resOfPlans, dict_movementFlows, **kwargs):
+    '''
+    Simulate plans one after another (e.g. from batchAssembly.assemblePlanBatch); yields one summary per plan
+    (None for a plan that could not be assembled or simulated): avgDelay (s/veh, weighted by the flows), maxOutRate and skipRate
+    (max over the stages), avgCycleLength, unservedMovements (movements with a flow but not in the plan), and the full result
+    of simulateActuatedPlan.
+    '''
+    for resOfChat2SPaT in resOfPlans:
+        if resOfChat2SPaT == None:
+            yield None
+            continue
+        try:
+            resOfSimulation = simulateActuatedPlan(resOfChat2SPaT, dict_movementFlows, **kwargs)
+        except ValueError:
+            yield None
+            continue
+        weights = {k: helper_getFlow(dict_movementFlows[k])[0] for k in resOfSimulation['movements'] if k in dict_movementFlows}
+        delays = [(resOfSimulation['movements'][k]['avgDelay'], w) for k, w in weights.items()
+                  if resOfSimulation['movements'][k]['avgDelay'] != None]
+        yield {'avgDelay': round(sum(d * w for d, w in delays) / sum(w for d, w in delays), 2) if sum(w for d, w in delays) > 0 else None,
+               'maxOutRate': max(_['maxOutRate'] or 0 for _ in resOfSimulation['stages']),
+               'skipRate': max(_['skipRate'] or 0 for _ in resOfSimulation['stages']),
+               'avgCycleLength': resOfSimulation['avgCycleLength'],
+               'unservedMovements': [k for k in dict_movementFlows if k not in resOfSimulation['movements']], 'simulation': resOfSimulation}
+
+# helper: stage structure of the fixed-time plan as arrays (stages x movements)
+def helper_getStageStructure(resOfChat2SPaT, permissiveFactor):
+    dict_lightColorRec = resOfChat2SPaT['dict_lightColorRec']
+    rows = list(iterStageTableRows(None, resOfChat2SPaT))
+    if len(rows) == 0:
+        raise ValueError('No vehicle phase with right of way in the plan.')
+    movementNames = sorted(_ for _ in dict_lightColorRec if '行人' not in _ and 'PED' not in _)
+    cycleLength = len(dict_lightColorRec[movementNames[0]])
+    S, M = len(rows), len(movementNames)
+    incidence = np.array([[_ in row['phases'].split('|') for _ in movementNames] for row in rows]).reshape(S, M)
+    nextIncidence = np.roll(incidence, -1, axis=0)
+    endingIncidence = incidence & ~nextIncidence
+    endingIncidence[~endingIncidence.any(axis=1)] = incidence[~endingIncidence.any(axis=1)]  # no movement ends: all of the stage
+    saturationFactor = np.ones((S, M))
+    for k, row in enumerate(rows):
+        for m, movementName in enumerate(movementNames):
+            if dict_lightColorRec[movementName][row['startTime']] == -1:
+                saturationFactor[k, m] = permissiveFactor
+    # min and max green of the movements (max over their phase stages)
+    minGreen, maxGreen = np.zeros(M, dtype=int), np.zeros(M, dtype=int)
+    for phase in resOfChat2SPaT['planSchemeMinorMerged']:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        if phaseName in movementNames:
+            m = movementNames.index(phaseName)
+            minGreen[m] = max(minGreen[m], helper_getSubValueFromPhase('minGreen', phase))
+            maxGreen[m] = max(maxGreen[m], helper_getSubValueFromPhase('maxGreen', phase))
+    fixedGreen = np.array([row['green'] for row in rows])
+    return {'rows': rows, 'movementNames': movementNames, 'cycleLength': cycleLength, 'incidence': incidence,
+            'startingIncidence': incidence & ~np.roll(incidence, 1, axis=0), 'endingIncidence': endingIncidence,
+            'clearanceIncidence': incidence & nextIncidence, 'saturationFactor': saturationFactor,
+            'minGreen': minGreen, 'maxGreen': maxGreen, 'fixedGreen': fixedGreen,
+            'lostTime': np.array([row['endTime'] - row['startTime'] for row in rows]) - fixedGreen}
+
+# helper: rounded ratio, None if the denominator is 0
+def helper_ratio(a, b):
+    return round(float(a / b), 3) if b > 0 else None
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    from assemblyEngines import assemblePlanWithEngine
+    from batchAssembly import WARM_UP_RES_STR
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='Screen synthetic plans under actuated control with Monte Carlo replications.')
+    parser.add_argument('--plans', type=int, default=200)
+    parser.add_argument('--replications', type=int, default=200)
+    parser.add_argument('--cycles', type=int, default=30)
+    args = parser.parse_args()
+
+    dict_movementFlows = {'NBL': 180, 'SBL': 260, 'SBT': {'flow': 900, 'saturationFlow': 3600}, 'NBT': {'flow': 700, 'saturationFlow': 3600},
+                          'EBL': 150, 'WBL': 120, 'EBT': {'flow': 800, 'saturationFlow': 3600}, 'WBT': {'flow': 650, 'saturationFlow': 3600}}
+    resOfSimulation = simulateActuatedPlan(assemblePlanWithEngine(WARM_UP_RES_STR, 'fast'), dict_movementFlows,
+                                           numCycles=args.cycles, numReplications=args.replications)
+    print('example plan: average cycle %s s' % resOfSimulation['avgCycleLength'])
+    for row in resOfSimulation['stages']:
+        print('  stage %-10s fixed green %3d  avg green %6s  skip %5s  gap-out %5s  max-out %5s'
+              % (row['phases'], row['fixedGreen'], row['avgGreen'], row['skipRate'], row['gapOutRate'], row['maxOutRate']))
+    for movementName, row in resOfSimulation['movements'].items():
+        print('  %-4s green utilisation %5s  delay %6s s/veh  residual queue %s' % (movementName, row['greenUtilisation'], row['avgDelay'],
+                                                                                   row['residualQueue']))
+
+    rnd = random.Random(0)
+    resStrList = [generateSyntheticPlan(seed=i, cycleLength=rnd.choice([90, 100, 120, 150]), numStages=rnd.choice([2, 3, 4]),
+                                        numRings=rnd.choice([0, 0, 2]), numPermissivePhases=rnd.choice([0, 2])) for i in range(args.plans)]
+    t0 = time.perf_counter()
+    resOfPlans = [assemblePlanWithEngine(_, 'fast') for _ in resStrList]
+    summaries = list(screenPlans(resOfPlans, dict_movementFlows, numCycles=args.cycles, numReplications=args.replications))
+    seconds = time.perf_counter() - t0
+    screened = [_ for _ in summaries if _ != None]
+    print('%d plans x %d replications x %d cycles screened in %.1f s' % (len(screened), args.replications, args.cycles, seconds))
+    candidates = [i for i, _ in enumerate(summaries) if _ != None and _['avgDelay'] != None and len(_['unservedMovements']) == 0]
+    if len(candidates) > 0:
+        best = min(candidates, key=lambda i: summaries[i]['avgDelay'])
+        print('best plan serving all movements: %d, %.1f s/veh, average cycle %s s, max-out rate %.2f, skip rate %.2f'
+              % (best, summaries[best]['avgDelay'], summaries[best]['avgCycleLength'], summaries[best]['maxOutRate'], summaries[best]['skipRate']))
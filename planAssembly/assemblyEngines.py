@@ -0,0 +1,227 @@
+# Assembly engines: the reference (pure-python) engine of Chat2SPaT.py and optimized engines, with a shadow-compare mode
+#
+# An engine is a dict of step functions passed to convertChatPlanResToSpatParams(resStr, engine=...);
+# steps not given in the dict use the reference implementation (dict_referenceEngine in Chat2SPaT.py).
+import collections
+import json
+import random
+import time
+
+from Chat2SPaT import convertChatPlanResToSpatParams, dict_referenceEngine, conflictMatrix, getCycleLengthOfPlanScheme,\
+    helper_getSubValueFromPhase, helper_timeIntersectsStartAndEndTime, helper_mergeConnectedphaseStages
+
+# Fields of the plan obj compared by the shadow mode
+SHADOW_COMPARED_KEYS = ['planSchemeMinorMerged', 'dict_lightColorRec', 'warningMsgCycleLength', 'warningMsgConflictPhases',
+                        'warningMsgPedWalk', 'isValid']
+
+# 【fast engine】 Same results as the reference engine, with the quadratic parts of Step 2/4 and Step 5.4 reduced
+
+def mergeConnectedPhaseInPlanSchemeFast(planScheme, cycleLength=None):
+    '''Same as mergeConnectedPhaseInPlanScheme. The attributes of each phase stage are read once, and only phase stages
+    with the same phaseName and isPermissive are compared, instead of all pairs.'''
+    planSchemeMerged = []
+    if cycleLength == None:
+        cycleLength = getCycleLengthOfPlanScheme(planScheme)
+
+    # Truncated start and end time (by lateStart and earlyCutOff) of each phase stage, grouped by (phaseName, isPermissive)
+    dict_groups = collections.defaultdict(list)
+    truncatedTimes = []
+    for i, phase in enumerate(planScheme):
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        isPermissive = helper_getSubValueFromPhase('isPermissive', phase)
+        truncatedTimes.append([helper_getSubValueFromPhase('startTime', phase) + helper_getSubValueFromPhase('lateStart', phase),
+                               helper_getSubValueFromPhase('endTime', phase) - helper_getSubValueFromPhase('earlyCutOff', phase)])
+        dict_groups[(phaseName, isPermissive)].append(i)
+
+    # Graph of connected phase stages (neighbors in ascending order, as in the reference)
+    graph = {}
+    for group in dict_groups.values():
+        for i in group:
+            startTime1, endTime1 = truncatedTimes[i]
+            graph[i] = []
+            for j in group:
+                if i == j:
+                    continue
+                startTime2, endTime2 = truncatedTimes[j]
+                if helper_timeIntersectsStartAndEndTime(startTime1, startTime2, endTime2, cycleLength) >= 0 or\
+                   helper_timeIntersectsStartAndEndTime(endTime1, startTime2, endTime2, cycleLength) >= 0:
+                    graph[i].append(j)
+
+    # Connected components by DFS (iterative, in the same visiting order as the recursive DFS of the reference)
+    visited = [False] * len(planScheme)
+    dict_phaseOrder = collections.Counter()
+    for i in range(len(planScheme)):
+        if visited[i]:
+            continue
+        component = []
+        visited[i] = True
+        component.append(i)
+        stack = [iter(graph[i])]
+        while len(stack) > 0:
+            for neighbor in stack[-1]:
+                if not visited[neighbor]:
+                    visited[neighbor] = True
+                    component.append(neighbor)
+                    stack.append(iter(graph[neighbor]))
+                    break
+            else:
+                stack.pop()
+
+        mergedPhase = helper_mergeConnectedphaseStages([planScheme[j] for j in component], cycleLength)
+        phaseName = helper_getSubValueFromPhase('phaseName', mergedPhase)
+        dict_phaseOrder[phaseName] += 1
+        mergedPhase[phaseName].update({'phaseOrder': dict_phaseOrder[phaseName]})
+        planSchemeMerged.append(mergedPhase)
+    return planSchemeMerged
+
+def checkConflictPhasesFast(dict_lightColorRec):
+    '''Same as checkConflictPhases. The permissive exemptions of each phase pair are decided once, instead of every second.'''
+    warningMsgConflictPhases = {}
+    checkedPhaseNames = set([])
+    for phaseName in dict_lightColorRec:
+        if phaseName not in conflictMatrix:
+            continue
+        for phaseConflictName in conflictMatrix[phaseName]:
+            if phaseConflictName in checkedPhaseNames or phaseConflictName not in dict_lightColorRec:
+                continue
+            conflictTimeIntervals = helper_findConflictIntervals(phaseName, phaseConflictName,
+                                                                 dict_lightColorRec[phaseName], dict_lightColorRec[phaseConflictName])
+            if len(conflictTimeIntervals) > 0:
+                warningMsgConflictPhases.update({'%s|%s'%(phaseName, phaseConflictName): conflictTimeIntervals})
+        checkedPhaseNames.add(phaseName)
+    return warningMsgConflictPhases
+
+# helper: same as helper_areConflictingPhasesTimedSimultaneously
+def helper_findConflictIntervals(phaseName, phaseConflictName, lightStateOfPhase, lightStateOfPhaseConflict):
+    if len(lightStateOfPhase) == 0:
+        return []
+    dictOpposite = {'东': '西', '西': '东', '北': '南', '南': '北', 'E': 'W', 'W': 'E', 'N': 'S', 'S': 'N'}
+    # through and opposite permissive left-turn: not a conflict while the left-turn is permissive (-1) or yellow (1)
+    exemptByConflictPhase = ('直行' in phaseName and '左转' in phaseConflictName and dictOpposite[phaseName[0]] == phaseConflictName[0]) or\
+                            ('BT' in phaseName and 'BL' in phaseConflictName and dictOpposite[phaseName[0]] == phaseConflictName[0])
+    exemptByPhase = ('左转' in phaseName and '直行' in phaseConflictName and dictOpposite[phaseName[0]] == phaseConflictName[0]) or\
+                    ('BL' in phaseName and 'BT' in phaseConflictName and dictOpposite[phaseName[0]] == phaseConflictName[0])
+    return helper_findConflictIntervalsWithExemptions(lightStateOfPhase, lightStateOfPhaseConflict, exemptByPhase, exemptByConflictPhase)
+
+# helper: conflict intervals of two color rows, the permissive exemptions of the pair being given
+# (exemptByConflictPhase: not a conflict while the conflicting phase is permissive or yellow; exemptByPhase: same for the phase)
+def helper_findConflictIntervalsWithExemptions(lightStateOfPhase, lightStateOfPhaseConflict, exemptByPhase, exemptByConflictPhase):
+    res = []
+    startOfCurInterval = None
+    for t, (colorCode, colorCodeConflict) in enumerate(zip(lightStateOfPhase, lightStateOfPhaseConflict)):
+        conflicted = colorCode != 0 and colorCodeConflict != 0 and\
+                     not (exemptByConflictPhase and (colorCodeConflict == -1 or colorCodeConflict == 1)) and\
+                     not (exemptByPhase and (colorCode == -1 or colorCode == 1))
+        if conflicted:
+            if startOfCurInterval == None:
+                startOfCurInterval = t
+        elif startOfCurInterval != None:
+            res.append([startOfCurInterval, t])
+            startOfCurInterval = None
+    if startOfCurInterval != None:
+        res.append([startOfCurInterval, min(len(lightStateOfPhase), len(lightStateOfPhaseConflict))])
+    return res
+
+# Engines by name
+dict_assemblyEngines = {'reference': dict_referenceEngine,
+                        'fast': {'mergeConnectedPhaseInPlanScheme': mergeConnectedPhaseInPlanSchemeFast,
+                                 'checkConflictPhases': checkConflictPhasesFast}}
+
+def registerAssemblyEngine(engineName, engine):
+    '''Register an engine (dict of step functions, see dict_referenceEngine) under a name.'''
+    unknownSteps = [_ for _ in engine if _ not in dict_referenceEngine]
+    if len(unknownSteps) > 0:
+        raise ValueError('Unknown assembly steps: %s' % unknownSteps)
+    dict_assemblyEngines[engineName] = engine
+
+def assemblePlanWithEngine(resStr, engineName='reference', **kwargs):
+    '''convertChatPlanResToSpatParams with the engine selected by name (plot and verbose default to False).'''
+    if engineName not in dict_assemblyEngines:
+        raise ValueError('Unknown assembly engine: %s' % engineName)
+    kwargs = dict({'plot': False, 'verbose': False}, **kwargs)
+    return convertChatPlanResToSpatParams(resStr, engine=dict_assemblyEngines[engineName], **kwargs)
+
+# 【Shadow mode】
+
+def compareAssemblyResults(resOfChat2SPaT, resOfShadow):
+    '''Fields (SHADOW_COMPARED_KEYS) that differ between two plan objs, as a list of field names.'''
+    return [k for k in SHADOW_COMPARED_KEYS if resOfChat2SPaT.get(k) != resOfShadow.get(k)]
+
+def runShadowComparison(resStr, resOfChat2SPaT, secondsOfEngine, shadowEngineName):
+    '''
+    Assemble resStr again with the shadow engine and compare with the result of the serving engine.
+    Exceptions of the shadow engine are recorded, never raised.
+
+    Returns:
+    shadowRecord(dict): shadowEngine, latencyRatio (shadow time / serving time), mismatches (field names), error (None if no exception),
+                  and resStr if there is a mismatch or an error.
+    '''
+    t0 = time.perf_counter()
+    try:
+        resOfShadow = assemblePlanWithEngine(resStr, shadowEngineName)
+        error = None
+    except Exception as e:
+        resOfShadow = None
+        error = '%s: %s' % (type(e).__name__, e)
+    secondsOfShadow = time.perf_counter() - t0
+    mismatches = compareAssemblyResults(resOfChat2SPaT, resOfShadow) if resOfShadow != None else []
+    shadowRecord = {'shadowEngine': shadowEngineName, 'latencyRatio': secondsOfShadow / secondsOfEngine if secondsOfEngine > 0 else None,
+                    'mismatches': mismatches, 'error': error}
+    if len(mismatches) > 0 or error != None:
+        shadowRecord.update({'resStr': resStr})  # keep the input to reproduce the mismatch
+    return shadowRecord
+
+def assemblePlanTimed(resStr, engineName='reference'):
+    '''assemblePlanWithEngine, also returning the seconds it takes: (resOfChat2SPaT, secondsOfEngine).'''
+    t0 = time.perf_counter()
+    resOfChat2SPaT = assemblePlanWithEngine(resStr, engineName)
+    return resOfChat2SPaT, time.perf_counter() - t0
+
+def assemblePlanWithShadow(resStr, engineName='reference', shadowEngineName=None, shadowRate=0.0, rnd=random):
+    '''
+    Assemble with the serving engine, and for a sampled fraction (shadowRate) of the calls also with the shadow engine.
+    The returned plan obj is always the one of the serving engine.
+    Both run in the calling process, one after the other; assemblyService.py runs the shadow comparison as a separate pool job instead.
+
+    Returns:
+    (resOfChat2SPaT, shadowRecord); shadowRecord is None if the call is not sampled (see runShadowComparison).
+    '''
+    if type(resStr) != str:
+        resStr = json.dumps(resStr, ensure_ascii=False)
+    resOfChat2SPaT, secondsOfEngine = assemblePlanTimed(resStr, engineName)
+    shadowRecord = None
+    if shadowEngineName != None and rnd.random() < shadowRate:
+        shadowRecord = runShadowComparison(resStr, resOfChat2SPaT, secondsOfEngine, shadowEngineName)
+    return resOfChat2SPaT, shadowRecord
+
+class ShadowStats:
+    '''Aggregates shadow records: number of comparisons, mismatches and errors, latency ratio percentiles, and the latest mismatched inputs.'''
+    def __init__(self, maxMismatchRecords=100, latencyWindow=10000):
+        self.compared = 0
+        self.mismatched = 0
+        self.errors = 0
+        self.dict_mismatchedKeys = collections.Counter()
+        self.latencyRatios = collections.deque(maxlen=latencyWindow)
+        self.mismatchRecords = collections.deque(maxlen=maxMismatchRecords)
+
+    def record(self, shadowRecord):
+        if shadowRecord == None:
+            return
+        self.compared += 1
+        if shadowRecord['latencyRatio'] != None:
+            self.latencyRatios.append(shadowRecord['latencyRatio'])
+        if shadowRecord['error'] != None:
+            self.errors += 1
+        if len(shadowRecord['mismatches']) > 0:
+            self.mismatched += 1
+            self.dict_mismatchedKeys.update(shadowRecord['mismatches'])
+        if len(shadowRecord['mismatches']) > 0 or shadowRecord['error'] != None:
+            self.mismatchRecords.append(shadowRecord)
+
+    def getSummary(self):
+        ratiosSorted = sorted(self.latencyRatios)
+        def percentile(q):
+            return ratiosSorted[min(len(ratiosSorted) - 1, int(q / 100 * len(ratiosSorted)))] if len(ratiosSorted) > 0 else None
+        return {'compared': self.compared, 'mismatched': self.mismatched, 'errors': self.errors,
+                'mismatchedKeys': dict(self.dict_mismatchedKeys),
+                'latencyRatio': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99)}}
@@ -0,0 +1,273 @@
+# Local HTTP service for plan assembly (stdlib only), with a pre-warmed process pool
+#
+# Run: python assemblyService.py --port 8080 --workers 4
+#   POST /assemble          body: LLM outputs (json object), or a json list of them for a batch
+#   POST /render?format=svg body: LLM outputs; format=svg (default) or png (needs matplotlib in the workers)
+#   GET  /metrics           request counts and latency percentiles (and shadow comparisons)
+#   Accept: application/x-chat2spat-plan (or -batch for a list of plans): /assemble answers in the binary format of planSerialization.py
+#   --engine fast --shadow-engine reference --shadow-rate 0.05: serve with the fast engine, and compare 5% of the plans with the reference
+import argparse
+import asyncio
+import collections
+import json
+import random
+import time
+from urllib.parse import urlsplit, parse_qs
+
+from assemblyEngines import dict_assemblyEngines, assemblePlanTimed, runShadowComparison, ShadowStats
+from batchAssembly import createAssemblyPool, assemblePlan, renderPlan
+from planSchemaValidation import validateLlmOutputs
+from planSerialization import CONTENT_TYPE_PLAN, CONTENT_TYPE_BATCH, serializePlan, serializePlanBatch
+
+HTTP_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+                422: 'Unprocessable Entity', 500: 'Internal Server Error', 501: 'Not Implemented',
+                503: 'Service Unavailable', 504: 'Gateway Timeout'}
+
+class AssemblyService:
+    '''
+    HTTP/1.1 server (keep-alive supported) dispatching plan assembly to a process pool.
+
+    Parameters:
+    workers: number of worker processes, started and warmed up before serving.
+    maxPending: maximum number of plans queued or running in the pool; further requests get 503 (backpressure).
+    timeout: seconds allowed for one request; 504 if exceeded.
+    maxBodyBytes: largest accepted request body.
+    engineName: assembly engine serving the requests (see assemblyEngines.dict_assemblyEngines).
+    shadowEngineName, shadowRate: engine run in shadow on a sampled fraction of the /assemble plans; its results are only compared
+                                  with the served ones (see /metrics), never returned. The comparison is a separate pool job
+                                  submitted after the response is ready, and skipped if maxShadowPending comparisons are
+                                  already queued or running (they do not count in maxPending).
+    '''
+    def __init__(self, workers=None, maxPending=64, timeout=10, maxBodyBytes=8*1024*1024, latencyWindow=10000,
+                 engineName='reference', shadowEngineName=None, shadowRate=0.0, maxShadowPending=4):
+        for name in (engineName, shadowEngineName):
+            if name != None and name not in dict_assemblyEngines:
+                raise ValueError('Unknown assembly engine: %s' % name)
+        self.engineName = engineName
+        self.shadowEngineName = shadowEngineName
+        self.shadowRate = shadowRate
+        self.shadowStats = ShadowStats()
+        self.pool = createAssemblyPool(workers)
+        self.maxPending = maxPending
+        self.timeout = timeout
+        self.maxBodyBytes = maxBodyBytes
+        self.pending = 0  # plans queued or running in the pool
+        self.maxShadowPending = maxShadowPending
+        self.shadowPending = 0  # shadow comparisons queued or running in the pool
+        self.shadowSkipped = 0  # sampled plans not compared as maxShadowPending is reached
+        self.startTime = time.time()
+        self.dict_latencies = collections.defaultdict(lambda: collections.deque(maxlen=latencyWindow))  # endpoint -> seconds
+        self.dict_statusCount = collections.Counter()
+
+    # Request handling
+    async def handleConnection(self, reader, writer):
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                method, target, version = requestLine.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, v = line.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+                contentLength = int(headers.get('content-length', 0))
+                t0 = time.perf_counter()
+                if contentLength > self.maxBodyBytes:
+                    status, contentType, body = self.errorResponse(413, 'Request body too large.')
+                    keepAlive = False
+                else:
+                    requestBody = await reader.readexactly(contentLength) if contentLength > 0 else b''
+                    status, contentType, body = await self.dispatch(method, target, requestBody, headers.get('accept', ''))
+                    keepAlive = headers.get('connection', '').lower() != 'close' and version.strip() == 'HTTP/1.1'
+                path = urlsplit(target).path
+                path = path if path in ('/assemble', '/render', '/metrics') else 'other'
+                self.dict_latencies[path].append(time.perf_counter() - t0)
+                self.dict_statusCount[status] += 1
+                writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: %s\r\n%s\r\n'
+                              % (status, HTTP_REASONS.get(status, ''), contentType, len(body), 'keep-alive' if keepAlive else 'close',
+                                 'Retry-After: 1\r\n' if status == 503 else '')).encode('latin-1') + body)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, target, requestBody, accept=''):
+        url = urlsplit(target)
+        if url.path == '/metrics':
+            if method != 'GET':
+                return self.errorResponse(405, 'Use GET.')
+            return self.jsonResponse(200, self.getMetrics())
+        if url.path not in ('/assemble', '/render'):
+            return self.errorResponse(404, 'Unknown endpoint: %s' % url.path)
+        if method != 'POST':
+            return self.errorResponse(405, 'Use POST.')
+        try:
+            res = json.loads(requestBody)
+        except ValueError:
+            return self.errorResponse(400, 'Request body is not valid json.')
+
+        if url.path == '/assemble':
+            resList = res if type(res) == list else [res]
+            # Plans not matching the schema are answered right away, without assembly
+            results = [helper_getSchemaErrorResult(_) for _ in resList]
+            indicesToAssemble = [i for i in range(len(resList)) if results[i] == None]
+            if type(res) != list and len(indicesToAssemble) == 0:
+                return self.jsonResponse(422, results[0])
+            resListToAssemble = [resList[i] for i in indicesToAssemble]
+            if self.shadowEngineName != None and self.shadowRate > 0:
+                status, resultsAssembled = await self.runInPool(assemblePlanTimed, resListToAssemble, self.engineName)
+                if status == 200:
+                    for i in range(len(resultsAssembled)):
+                        if type(resultsAssembled[i]) == tuple:
+                            resultsAssembled[i], secondsOfEngine = resultsAssembled[i]
+                            if random.random() < self.shadowRate:
+                                self.submitShadowComparison(resListToAssemble[i], resultsAssembled[i], secondsOfEngine)
+            else:
+                status, resultsAssembled = await self.runInPool(assemblePlan, resListToAssemble, self.engineName)
+            if status != 200:
+                return self.errorResponse(status, resultsAssembled)
+            for i, result in zip(indicesToAssemble, resultsAssembled):
+                results[i] = result
+            if type(res) == list and CONTENT_TYPE_BATCH in accept:
+                return 200, CONTENT_TYPE_BATCH, serializePlanBatch(results)
+            if type(res) != list and CONTENT_TYPE_PLAN in accept:
+                return 200, CONTENT_TYPE_PLAN, serializePlan(results[0])
+            return self.jsonResponse(200, results if type(res) == list else results[0])
+
+        # /render
+        imageFormat = parse_qs(url.query).get('format', ['svg'])[0]
+        if imageFormat not in ('svg', 'png'):
+            return self.errorResponse(400, 'format should be svg or png.')
+        schemaErrorResult = helper_getSchemaErrorResult(res)
+        if schemaErrorResult != None:
+            return self.jsonResponse(422, schemaErrorResult)
+        status, results = await self.runInPool(renderPlan, [res], imageFormat, self.engineName)
+        if status != 200:
+            return self.errorResponse(status, results)
+        if type(results[0]) == dict:  # the plan cannot be assembled or drawn
+            return self.jsonResponse(422 if 'error' in results[0] else 500, results[0])
+        return 200, 'image/svg+xml' if imageFormat == 'svg' else 'image/png', results[0]
+
+    async def runInPool(self, func, resList, *args):
+        '''Run func for each plan in the pool, with backpressure and timeout.
+        Returns (200, list of results) where a plan that fails has {'error': msg} as its result, or (status, msg) for 503/504.'''
+        if self.pending + len(resList) > self.maxPending:
+            return 503, 'Too many pending plans (%d), retry later.' % self.pending
+        self.pending += len(resList)
+        loop = asyncio.get_running_loop()
+        poolFutures = [self.pool.submit(func, res, *args) for res in resList]
+        try:
+            results = await asyncio.wait_for(asyncio.gather(*[asyncio.wrap_future(_) for _ in poolFutures], return_exceptions=True),
+                                             self.timeout)
+        except asyncio.TimeoutError:
+            # Queued plans are cancelled, a running one cannot be interrupted: each pending count is released when its plan is done
+            # (the callback runs in a thread of the pool)
+            for future in poolFutures:
+                future.cancel()
+                future.add_done_callback(lambda _: loop.call_soon_threadsafe(self.releasePending))
+            return 504, 'Plan assembly takes longer than %s s.' % self.timeout
+        self.pending -= len(resList)
+        for i in range(len(results)):
+            if isinstance(results[i], ImportError):
+                return 501, str(results[i])
+            if isinstance(results[i], Exception):
+                results[i] = {'error': 'TSC plan cannot be assembled using the inputs. Please check your LLM outputs and use valid inputs.',
+                              'detail': '%s: %s' % (type(results[i]).__name__, results[i])}
+        return 200, results
+
+    def releasePending(self):
+        self.pending -= 1
+
+    def submitShadowComparison(self, res, resOfChat2SPaT, secondsOfEngine):
+        '''Run the shadow comparison of one served plan as a pool job, not awaited: its record goes to shadowStats when done.'''
+        if self.shadowPending + 1 > self.maxShadowPending:
+            self.shadowSkipped += 1
+            return
+        self.shadowPending += 1
+        loop = asyncio.get_running_loop()
+        poolFuture = self.pool.submit(runShadowComparison, res, resOfChat2SPaT, secondsOfEngine, self.shadowEngineName)
+        poolFuture.add_done_callback(lambda _: loop.call_soon_threadsafe(self.recordShadowComparison, _))
+
+    def recordShadowComparison(self, poolFuture):
+        self.shadowPending -= 1
+        if poolFuture.cancelled():
+            return
+        if poolFuture.exception() != None:  # the worker failed (runShadowComparison records the errors of the engine itself)
+            e = poolFuture.exception()
+            self.shadowStats.record({'shadowEngine': self.shadowEngineName, 'latencyRatio': None, 'mismatches': [],
+                                     'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        self.shadowStats.record(poolFuture.result())
+
+    # Responses and metrics
+    def jsonResponse(self, status, obj):
+        return status, 'application/json; charset=utf-8', json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    def errorResponse(self, status, msg):
+        return self.jsonResponse(status, {'error': msg})
+
+    def getMetrics(self):
+        metrics = {'uptime': round(time.time() - self.startTime, 1), 'pendingPlans': self.pending,
+                   'statusCount': {str(k): v for k, v in sorted(self.dict_statusCount.items())}, 'latencyMs': {}}
+        for path, latencies in self.dict_latencies.items():
+            latenciesSorted = sorted(latencies)
+            n = len(latenciesSorted)
+            metrics['latencyMs'][path] = {'count': n, 'p50': round(calcPercentile(latenciesSorted, 50) * 1000, 3),
+                                          'p90': round(calcPercentile(latenciesSorted, 90) * 1000, 3),
+                                          'p99': round(calcPercentile(latenciesSorted, 99) * 1000, 3),
+                                          'max': round(latenciesSorted[-1] * 1000, 3)}
+        if self.shadowEngineName != None:
+            metrics['shadow'] = dict({'engine': self.engineName, 'shadowEngine': self.shadowEngineName, 'shadowRate': self.shadowRate,
+                                      'pending': self.shadowPending, 'skipped': self.shadowSkipped}, **self.shadowStats.getSummary())
+        return metrics
+
+    async def serve(self, host='127.0.0.1', port=8080):
+        server = await asyncio.start_server(self.handleConnection, host, port)
+        print('Plan assembly service on http://%s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+# helper: error result of LLM outputs not matching the schema (None if they match), with the errors to feed back to the LLM
+def helper_getSchemaErrorResult(res):
+    schemaErrors = validateLlmOutputs(res)
+    if len(schemaErrors) == 0:
+        return None
+    return {'error': 'LLM outputs do not match the output format.', 'schemaErrors': schemaErrors}
+
+# helper: percentile of sorted values (nearest rank)
+def calcPercentile(valuesSorted, q):
+    '''valuesSorted = [1, 2, 3, 4], q = 50 -> 2'''
+    if len(valuesSorted) == 0:
+        return 0
+    rank = max(1, -(-q * len(valuesSorted) // 100))  # ceil
+    return valuesSorted[int(rank) - 1]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local HTTP service for Chat2SPaT plan assembly.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--max-pending', type=int, default=64, help='maximum plans queued in the pool before answering 503')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds per request before answering 504')
+    parser.add_argument('--engine', default='reference', help='assembly engine: %s' % ', '.join(dict_assemblyEngines))
+    parser.add_argument('--shadow-engine', default=None, help='engine run in shadow mode, compared with --engine')
+    parser.add_argument('--shadow-rate', type=float, default=0.0, help='fraction of the /assemble plans also run by the shadow engine')
+    parser.add_argument('--max-shadow-pending', type=int, default=4, help='maximum shadow comparisons queued in the pool, others are skipped')
+    args = parser.parse_args()
+
+    service = AssemblyService(workers=args.workers, maxPending=args.max_pending, timeout=args.timeout,
+                              engineName=args.engine, shadowEngineName=args.shadow_engine, shadowRate=args.shadow_rate,
+                              maxShadowPending=args.max_shadow_pending)
+    try:
+        asyncio.run(service.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.pool.shutdown()
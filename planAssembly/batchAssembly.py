@@ -0,0 +1,110 @@
+# Plan assembly in worker processes, for batches of LLM outputs and for the assembly service
+import collections
+import io
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+
+# LLM outputs used to warm up a worker (the example in main.py)
+WARM_UP_RES_STR = json.dumps({
+    "result1": {"stageStyle": [[{"NBL": {"split": 21}}, {"SBL": {"split": 21}}], [{"SBL": {"split": 18}}, {"SBT": {"split": 18}}],
+                               [{"NBT": {"split": 26}}, {"SBT": {"split": 26}}], [{"EBL": {"split": 17}}, {"WBL": {"split": 17}}],
+                               [{"EBT": {"split": 22}}, {"WBT": {"split": 22}}]]},
+    "result2": [{"NBL": {"phaseOrder": 1, "greenFlash": 3}}, {"SBL": {"phaseOrder": 1, "greenFlash": 3, "lateStart": 5}},
+                {"SBL": {"phaseOrder": 2, "greenFlash": 3}}, {"SBT": {"phaseOrder": 1, "greenFlash": 3}},
+                {"NBT": {"phaseOrder": 1, "greenFlash": 3}}, {"SBT": {"phaseOrder": 2, "greenFlash": 3}},
+                {"EBL": {"phaseOrder": 1, "greenFlash": 3}}, {"WBL": {"phaseOrder": 1, "greenFlash": 3, "earlyCutOff": 4}},
+                {"EBT": {"phaseOrder": 1, "greenFlash": 3, "redAmber": 3}}, {"WBT": {"phaseOrder": 1, "greenFlash": 3, "redAmber": 3}}],
+    "result3": None})
+
+def initAssemblyWorker():
+    '''Initializer of a worker process: import the assembly modules and run one assembly, so the first request is not a cold start.'''
+    import Chat2SPaT
+    import assemblyEngines
+    import svgPlot
+    Chat2SPaT.convertChatPlanResToSpatParams(WARM_UP_RES_STR, plot=False, verbose=False)
+
+def warmUpWorker(_=None):
+    '''No-op task, submitted once per worker to start the worker processes in advance.'''
+    return os.getpid()
+
+def assemblePlan(resStr, engineName='reference'):
+    '''Assemble one plan in a worker. resStr could be the LLM outputs as str, or already parsed as dict.
+    engineName selects the assembly engine (see assemblyEngines.dict_assemblyEngines).'''
+    from assemblyEngines import assemblePlanWithEngine
+    return assemblePlanWithEngine(resStr, engineName)
+
+def assemblePlanOrNone(resStr):
+    '''Same as assemblePlan, but returns None for LLM outputs that cannot be assembled (as in main.py), so one bad plan does not stop a batch.'''
+    try:
+        return assemblePlan(resStr)
+    except Exception:
+        return None
+
+def renderPlan(resStr, imageFormat='svg', engineName='reference'):
+    '''Assemble one plan and draw its signal times table. Returns the image as bytes (svg or png).'''
+    resOfChat2SPaT = assemblePlan(resStr, engineName)
+    if imageFormat == 'svg':
+        from svgPlot import convertPlanResToSvg
+        return convertPlanResToSvg(resOfChat2SPaT).encode('utf-8')
+    if imageFormat == 'png':
+        from Chat2SPaT import plotPlanScheme  # a figure outside pyplot, rendered by the Agg canvas (no display needed)
+        planScheme = resOfChat2SPaT['planSchemeMinorMerged']
+        cycleLength = len(next(iter(resOfChat2SPaT['dict_lightColorRec'].values())))
+        fig = plotPlanScheme(planScheme, cycleLength)
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png')
+        return buf.getvalue()
+    raise ValueError('Unknown image format: %s' % imageFormat)
+
+def createAssemblyPool(workers=None):
+    '''Create a process pool with the assembly modules imported in every worker, and start all workers now.'''
+    workers = workers if workers != None else os.cpu_count()
+    resource_tracker.ensure_running()  # shared by the workers, for the shared memory blocks of sharedMemoryBatch.py
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=initAssemblyWorker)
+    list(pool.map(warmUpWorker, range(workers)))
+    return pool
+
+def assemblePlanChunk(resStrList):
+    '''Assemble a chunk of plans in a worker (one inter-process round trip per chunk).'''
+    return [assemblePlanOrNone(resStr) for resStr in resStrList]
+
+def assemblePlanBatch(resStrIter, pool=None, workers=None, chunksize=8, maxPendingChunks=None):
+    '''
+    Assemble a batch of LLM outputs in worker processes.
+
+    Parameters:
+    resStrIter: iterable of LLM outputs (str or dict). It is consumed lazily, so it could be a generator over a large file.
+    pool: an existing pool (e.g. by createAssemblyPool); a new one is created and shut down here if not given.
+    chunksize: number of plans sent to a worker at once.
+    maxPendingChunks: number of chunks submitted ahead of the consumer (default: 2 per worker), which bounds the memory use.
+
+    Returns:
+    A generator of resOfChat2SPaT (None if the plan cannot be assembled), in the order of the inputs.
+    '''
+    ownPool = pool == None
+    if ownPool:
+        pool = createAssemblyPool(workers)
+    if maxPendingChunks == None:
+        maxPendingChunks = 2 * pool._max_workers
+    pendingChunks = collections.deque()
+    resStrIter = iter(resStrIter)
+    try:
+        while True:
+            # Keep the pool busy with a bounded number of chunks
+            while len(pendingChunks) < maxPendingChunks:
+                chunk = list(itertools.islice(resStrIter, chunksize))
+                if len(chunk) == 0:
+                    break
+                pendingChunks.append(pool.submit(assemblePlanChunk, chunk))
+            if len(pendingChunks) == 0:
+                break
+            for resOfChat2SPaT in pendingChunks.popleft().result():
+                yield resOfChat2SPaT
+    finally:
+        for future in pendingChunks:
+            future.cancel()
+        if ownPool:
+            pool.shutdown()
@@ -0,0 +1,62 @@
+# Memory benchmark of plan assembly: peak memory per plan, and memory retained when holding many plans
+#
+# Run: python benchMemory.py [--input plans.jsonl] [--repeat 200]
+#   plans.jsonl has one LLM output (json object) per line; the example in main.py is used if not given.
+import argparse
+import time
+import tracemalloc
+
+from Chat2SPaT import convertChatPlanResToSpatParams
+from batchAssembly import WARM_UP_RES_STR
+
+def measurePlanMemory(resStrList, slim=False):
+    '''
+    Assemble the plans one by one and hold all results, under tracemalloc.
+
+    Returns:
+    dict of peakBytesPerPlan (mean and max of the peak memory during the assembly of one plan, above the memory before it),
+    retainedBytesPerPlan (memory held by the results, per plan), plans (number of plans assembled) and seconds.
+    '''
+    resOfPlans = []
+    peaks = []
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    memoryBefore = tracemalloc.get_traced_memory()[0]
+    for resStr in resStrList:
+        tracemalloc.reset_peak()
+        memoryBeforePlan = tracemalloc.get_traced_memory()[0]
+        try:
+            resOfChat2SPaT = convertChatPlanResToSpatParams(resStr, plot=False, verbose=False, slim=slim)
+        except Exception:
+            continue
+        peaks.append(tracemalloc.get_traced_memory()[1] - memoryBeforePlan)
+        resOfPlans.append(resOfChat2SPaT)
+    retainedBytes = tracemalloc.get_traced_memory()[0] - memoryBefore
+    seconds = time.perf_counter() - t0
+    tracemalloc.stop()
+    n = max(len(resOfPlans), 1)
+    return {'plans': len(resOfPlans), 'seconds': seconds,
+            'peakBytesPerPlan': {'mean': sum(peaks) / n, 'max': max(peaks) if len(peaks) > 0 else 0},
+            'retainedBytesPerPlan': retainedBytes / n}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='tracemalloc benchmark of plan assembly, full vs slim plan obj.')
+    parser.add_argument('--input', default=None, help='jsonl file of LLM outputs, one per line')
+    parser.add_argument('--repeat', type=int, default=200, help='number of times the inputs are assembled (and held)')
+    args = parser.parse_args()
+
+    if args.input != None:
+        with open(args.input, encoding='utf-8') as f:
+            resStrList = [line.strip() for line in f if line.strip() != '']
+    else:
+        resStrList = [WARM_UP_RES_STR]
+    resStrList = resStrList * max(1, args.repeat // len(resStrList))
+
+    res = {'full': measurePlanMemory(resStrList, slim=False), 'slim': measurePlanMemory(resStrList, slim=True)}
+    print('%-6s %8s %16s %16s %20s' % ('mode', 'plans', 'peak/plan (KB)', 'max peak (KB)', 'retained/plan (KB)'))
+    for mode in res:
+        print('%-6s %8d %16.1f %16.1f %20.2f' % (mode, res[mode]['plans'], res[mode]['peakBytesPerPlan']['mean'] / 1024,
+                                                  res[mode]['peakBytesPerPlan']['max'] / 1024, res[mode]['retainedBytesPerPlan'] / 1024))
+    if res['full']['retainedBytesPerPlan'] > 0:
+        print('Retained memory reduction of slim mode: %.1f%%'
+              % (100 * (1 - res['slim']['retainedBytesPerPlan'] / res['full']['retainedBytesPerPlan'])))
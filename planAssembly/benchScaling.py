@@ -0,0 +1,107 @@
+# Scaling benchmark of plan assembly on synthetic plans: assembly time against each knob of planGenerator
+#
+# Run: python benchScaling.py [--plans 5] [--repeat 3] [--engine fast] [--plot scaling.png]
+import argparse
+import math
+import time
+
+from assemblyEngines import assemblePlanWithEngine
+from planGenerator import generateSyntheticPlan
+
+# knob -> (values to sweep, other knobs needed for the sweep)
+dict_knobSweeps = {
+    'cycleLength': ([60, 120, 240, 480, 960, 1920], {}),
+    'numStages': ([2, 4, 8, 16, 32, 64], {'cycleLength': 1280}),
+    'numRings': ([1, 2, 3, 4], {'numStages': 8, 'cycleLength': 240}),
+    'numNestedStagesInRing': ([0, 2, 4, 8, 16], {'numRings': 2, 'numStages': 16, 'cycleLength': 480}),
+    'numOverlapPhases': ([0, 1, 2, 4, 8], {'numStages': 8, 'cycleLength': 240}),
+    'numPedPhases': ([0, 1, 2, 4], {}),
+    'numTwoStagePedPhases': ([0, 1, 2, 4], {}),
+    'numPermissivePhases': ([0, 1, 2, 4], {}),
+    'formatErrorRate': ([0.0, 0.5, 1.0], {'language': 'zh'}),
+}
+
+def measureAssemblyTime(resStrList, repeat=3, engineName='reference'):
+    '''Best of repeat runs of the mean assembly time per plan (seconds).'''
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        for resStr in resStrList:
+            assemblePlanWithEngine(resStr, engineName)
+        seconds = (time.perf_counter() - t0) / len(resStrList)
+        best = seconds if best == None else min(best, seconds)
+    return best
+
+def runScalingBenchmark(plans=5, repeat=3, knobs=None, engineName='reference'):
+    '''
+    Sweep each knob (others at their defaults), and measure the assembly time per plan.
+
+    Returns:
+    dict of knob -> {'values': [...], 'seconds': [...], 'exponent': slope of log(time) against log(knob value)}.
+    An exponent near 2 points to a quadratic hot spot.
+    '''
+    res = {}
+    for knob in (knobs if knobs != None else dict_knobSweeps):
+        values, otherKnobs = dict_knobSweeps[knob]
+        secondsList = []
+        for value in values:
+            kwargs = dict(otherKnobs)
+            kwargs.update({knob: value})
+            resStrList = [generateSyntheticPlan(seed=seed, **kwargs) for seed in range(plans)]
+            secondsList.append(measureAssemblyTime(resStrList, repeat, engineName))
+        res[knob] = {'values': values, 'seconds': secondsList, 'exponent': helper_calcScalingExponent(values, secondsList)}
+    return res
+
+def plotScalingBenchmark(res, fileName):
+    '''One log-log panel (linear x for knobs starting at 0) per knob.'''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    n = len(res)
+    cols = 3
+    rows = (n + cols - 1) // cols
+    fig, axes = plt.subplots(rows, cols, figsize=(5*cols, 3.5*rows), squeeze=False)
+    for i, knob in enumerate(res):
+        ax = axes[i // cols][i % cols]
+        ax.plot(res[knob]['values'], [_ * 1000 for _ in res[knob]['seconds']], marker='o')
+        if min(res[knob]['values']) > 0:
+            ax.set_xscale('log')
+            ax.set_yscale('log')
+        exponent = res[knob]['exponent']
+        ax.set_title('%s (exponent %s)' % (knob, '%.2f' % exponent if exponent != None else '-'))
+        ax.set_ylabel('ms per plan')
+    for i in range(n, rows*cols):
+        axes[i // cols][i % cols].axis('off')
+    fig.tight_layout()
+    fig.savefig(fileName)
+    plt.close(fig)
+
+# helper: least-squares slope of log(seconds) over log(value), for positive values only
+def helper_calcScalingExponent(values, secondsList):
+    points = [[math.log(v), math.log(s)] for v, s in zip(values, secondsList) if v > 0 and s > 0]
+    if len(points) < 2:
+        return None
+    xMean = sum(_[0] for _ in points) / len(points)
+    yMean = sum(_[1] for _ in points) / len(points)
+    sxx = sum((_[0] - xMean) ** 2 for _ in points)
+    if sxx == 0:
+        return None
+    return sum((_[0] - xMean) * (_[1] - yMean) for _ in points) / sxx
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assembly time against the knobs of the synthetic plan generator.')
+    parser.add_argument('--plans', type=int, default=5, help='synthetic plans (seeds) per knob value')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--knob', action='append', default=None, help='knob(s) to sweep (default: all)')
+    parser.add_argument('--engine', default='reference', help='assembly engine (see assemblyEngines.py)')
+    parser.add_argument('--plot', default=None, help='file name of the plot (png), needs matplotlib')
+    args = parser.parse_args()
+
+    res = runScalingBenchmark(args.plans, args.repeat, args.knob, args.engine)
+    for knob in res:
+        exponent = res[knob]['exponent']
+        print('%s (exponent %s)' % (knob, '%.2f' % exponent if exponent != None else '-'))
+        for value, seconds in zip(res[knob]['values'], res[knob]['seconds']):
+            print('    %8s  %10.3f ms' % (value, seconds * 1000))
+    if args.plot != None:
+        plotScalingBenchmark(res, args.plot)
@@ -0,0 +1,232 @@
+# Time-of-day schedule: the plans of a day (with offsets and transitions) compiled into a 24-hour SPaT timeline
+#
+# A day plan is a list of (startClock, resStr, offset): the plan of resStr runs from startClock (seconds after midnight, or 'HH:MM[:SS]')
+# until the next entry, with its cycle starting at offset (seconds after midnight, modulo the cycle length). Before the first entry,
+# the last plan of the day runs (carried over from the previous day).
+#
+# Run: python dayPlanSchedule.py [--intersections 1000] [--plans 50] [--memmap day.int8]
+import argparse
+import functools
+import itertools
+import json
+import time
+
+import numpy as np
+
+from assemblyEngines import assemblePlanWithEngine
+
+SECONDS_PER_DAY = 86400
+# Distinct plans kept assembled (least recently used ones are dropped); a day plan of many intersections reuses a few plans
+MAX_CACHED_PLANS = 4096
+
+def assemblePlanCached(resStr, engineName='fast'):
+    '''Assemble the plan once per distinct LLM outputs (up to MAX_CACHED_PLANS kept, see helper_assemblePlanCached.cache_info()).
+    Returns (phaseNames, cycle color codes as int8 array (phases, cycleLength)).'''
+    if type(resStr) != str:
+        resStr = json.dumps(resStr, ensure_ascii=False)
+    return helper_assemblePlanCached(resStr, engineName)
+
+def compileDaySchedule(dayPlan, transition='immediate', engineName='fast', out=None, phaseNames=None):
+    '''
+    Compile a day plan into the per-second color codes of each phase over the day.
+
+    Parameters:
+    dayPlan: list of (startClock, resStr, offset), see above.
+    transition: 'immediate' - the next plan takes over at its startClock, at the position of its own cycle given by its offset;
+                'endOfCycle' - the running plan completes its current cycle first (the next plan takes over at the end of that cycle).
+    out: optional int8 array (e.g. rows of a numpy.memmap) of shape (phases, SECONDS_PER_DAY) to write into.
+    phaseNames: optional order of the rows (all phases of the running plans); by default, the phases in order of appearance
+                in the periods of the day (see getPhaseNamesOfDay).
+
+    Returns:
+    dict of phaseNames (the phases of the rows) and lightColorDay (int8 array (phases, SECONDS_PER_DAY);
+    a phase not in the running plan is red, 0), and periods (list of [startSecond, endSecond, index in dayPlan]).
+    '''
+    periods = helper_getPeriods(dayPlan, transition, engineName)
+    if phaseNames == None:
+        phaseNames = helper_getPhaseNamesOfPeriods(dayPlan, periods, engineName)
+    dict_rowOfPhases = {phaseName: row for row, phaseName in enumerate(phaseNames)}
+
+    lightColorDay = out if out is not None else np.zeros((len(phaseNames), SECONDS_PER_DAY), dtype=np.int8)
+    lightColorDay[:] = 0
+    for startSecond, endSecond, i in periods:
+        planPhaseNames, cycleColorArray = assemblePlanCached(dayPlan[i][1], engineName)
+        cycleLength = cycleColorArray.shape[1]
+        positionsInCycle = (np.arange(startSecond, endSecond) - dayPlan[i][2]) % cycleLength
+        rows = [dict_rowOfPhases[_] for _ in planPhaseNames]
+        lightColorDay[rows, startSecond:endSecond] = cycleColorArray[:, positionsInCycle]
+    return {'phaseNames': phaseNames, 'lightColorDay': lightColorDay, 'periods': periods}
+
+def getPhaseNamesOfDay(dayPlan, transition='immediate', engineName='fast'):
+    '''Phases of the plans running in the day (a plan left no time by the transitions is not), in order of appearance from 00:00:
+    the rows of compileDaySchedule.'''
+    return helper_getPhaseNamesOfPeriods(dayPlan, helper_getPeriods(dayPlan, transition, engineName), engineName)
+
+def getRunLengthSegments(lightColorDay, phaseNames):
+    '''
+    Run-length segments of the day timeline of each phase.
+
+    Returns:
+    dict of phaseName -> (startSeconds, colorCodes) as numpy arrays; segment k lasts from startSeconds[k] to startSeconds[k+1]
+    (the last one to SECONDS_PER_DAY).
+    '''
+    res = {}
+    for row, phaseName in enumerate(phaseNames):
+        colors = lightColorDay[row]
+        startSeconds = np.concatenate([[0], np.flatnonzero(colors[1:] != colors[:-1]) + 1]).astype(np.int32)
+        res[phaseName] = (startSeconds, colors[startSeconds])
+    return res
+
+def compileDaySchedulesToMemmap(dict_dayPlans, fileName, transition='immediate', engineName='fast'):
+    '''
+    Compile the day plans of many intersections into one int8 numpy.memmap file of shape (rows, SECONDS_PER_DAY),
+    with an index (fileName + '.json') of intersection -> [first row, phaseNames].
+
+    Parameters:
+    dict_dayPlans: intersection id -> day plan (see compileDaySchedule).
+
+    Returns:
+    dict_index: intersection id -> {'row': first row, 'phaseNames': [...]} (the phases take consecutive rows).
+    '''
+    # Step 1: rows of each intersection (assembles each distinct plan once)
+    dict_index = {}
+    rows = 0
+    for intersectionId, dayPlan in dict_dayPlans.items():
+        phaseNames = getPhaseNamesOfDay(dayPlan, transition, engineName)
+        dict_index[intersectionId] = {'row': rows, 'phaseNames': phaseNames}
+        rows += len(phaseNames)
+
+    # Step 2: write the timelines into the memmap
+    lightColorDays = np.memmap(fileName, dtype=np.int8, mode='w+', shape=(max(rows, 1), SECONDS_PER_DAY))
+    for intersectionId, dayPlan in dict_dayPlans.items():
+        row, phaseNames = dict_index[intersectionId]['row'], dict_index[intersectionId]['phaseNames']
+        compileDaySchedule(dayPlan, transition, engineName, out=lightColorDays[row:row + len(phaseNames)], phaseNames=phaseNames)
+    lightColorDays.flush()
+    del lightColorDays
+    with open(fileName + '.json', 'w', encoding='utf-8') as f:
+        json.dump({'rows': rows, 'index': dict_index}, f, ensure_ascii=False)
+    return dict_index
+
+def openDaySchedulesMemmap(fileName):
+    '''Open a file written by compileDaySchedulesToMemmap (read only). Returns (memmap of shape (rows, SECONDS_PER_DAY), dict_index).'''
+    with open(fileName + '.json', encoding='utf-8') as f:
+        meta = json.load(f)
+    lightColorDays = np.memmap(fileName, dtype=np.int8, mode='r', shape=(max(meta['rows'], 1), SECONDS_PER_DAY))
+    return lightColorDays, meta['index']
+
+# helper: LLM outputs (str) -> (phaseNames, color codes of one cycle as int8 array of shape (phases, cycleLength))
+@functools.lru_cache(maxsize=MAX_CACHED_PLANS)
+def helper_assemblePlanCached(resStr, engineName):
+    phaseNames, cycleColorArray = helper_getCycleColorArray(assemblePlanWithEngine(resStr, engineName))
+    cycleColorArray.setflags(write=False)  # shared by the callers of the cache
+    return phaseNames, cycleColorArray
+
+# helper: cycle color codes of an assembled plan as an int8 array
+def helper_getCycleColorArray(resOfChat2SPaT):
+    dict_lightColorRec = resOfChat2SPaT['dict_lightColorRec']
+    phaseNames = sorted(dict_lightColorRec)  # sorted, as the phases of dict_lightColorRec are in no particular order
+    return phaseNames, np.array([list(dict_lightColorRec[_]) for _ in phaseNames], dtype=np.int8).reshape(len(phaseNames), -1)
+
+# helper: phases of the plans of the periods, in order of appearance
+def helper_getPhaseNamesOfPeriods(dayPlan, periods, engineName):
+    phaseNames = []
+    for _, _, i in periods:
+        for phaseName in assemblePlanCached(dayPlan[i][1], engineName)[0]:
+            if phaseName not in phaseNames:
+                phaseNames.append(phaseName)
+    return phaseNames
+
+# helper: seconds after midnight of a clock time
+def helper_parseClock(clock):
+    '''6 * 3600 -> 21600; '06:30' -> 23400; '06:30:15' -> 23415'''
+    if type(clock) != str:
+        return int(clock)
+    parts = [int(_) for _ in clock.split(':')]
+    return parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
+
+# helper: periods of the day, [startSecond, endSecond, index in dayPlan]
+def helper_getPeriods(dayPlan, transition, engineName):
+    if len(dayPlan) == 0:
+        raise ValueError('The day plan is empty.')
+    if transition not in ('immediate', 'endOfCycle'):
+        raise ValueError('Unknown transition: %s' % transition)
+    order = sorted(range(len(dayPlan)), key=lambda i: helper_parseClock(dayPlan[i][0]))
+    starts = [helper_parseClock(dayPlan[i][0]) for i in order]
+    if min(starts) < 0 or max(starts) >= SECONDS_PER_DAY:
+        raise ValueError('Start clocks should be within the day.')
+    # the last plan of the day runs from midnight until the first entry
+    if starts[0] > 0:
+        order = [order[-1]] + order
+        starts = [0] + starts
+    periods = []
+    for k in range(len(order)):
+        startSecond = starts[k]
+        if transition == 'endOfCycle' and k > 0:
+            # the previous plan completes its cycle (cycle starts at its offset)
+            i = order[k - 1]
+            cycleLength = assemblePlanCached(dayPlan[i][1], engineName)[1].shape[1]
+            startSecond = startSecond + (dayPlan[i][2] - startSecond) % cycleLength
+        startSecond = max(startSecond, periods[-1][0] if len(periods) > 0 else 0)
+        endSecond = starts[k + 1] if k + 1 < len(order) else SECONDS_PER_DAY
+        if len(periods) > 0:
+            periods[-1][1] = min(startSecond, SECONDS_PER_DAY)
+        periods.append([min(startSecond, SECONDS_PER_DAY), endSecond, order[k]])
+    # a transition past the next entry leaves no time to a plan; such periods are dropped
+    return [_ for _ in periods if _[1] > _[0]]
+
+if __name__ == '__main__':
+    import os
+    import random
+    import tempfile
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='Compile synthetic day plans of many intersections into a 24-hour SPaT timeline.')
+    parser.add_argument('--intersections', type=int, default=1000)
+    parser.add_argument('--plans', type=int, default=50, help='distinct plans shared by the intersections')
+    parser.add_argument('--transition', default='immediate', choices=['immediate', 'endOfCycle'])
+    parser.add_argument('--memmap', default=None, help='file of the int8 timeline (default: a temporary file)')
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    plans = [generateSyntheticPlan(seed=i, cycleLength=rnd.choice([90, 100, 120, 150]), numStages=rnd.choice([2, 3, 4]),
+                                   numPedPhases=rnd.choice([0, 2])) for i in range(args.plans)]
+    dict_dayPlans = {}
+    for n in range(args.intersections):
+        clocks = ['00:00', '06:30', '09:00', '16:30', '19:00', '22:00']
+        dict_dayPlans['intersection%d' % n] = [(clock, rnd.choice(plans), rnd.randrange(0, 150)) for clock in clocks]
+
+    fileName = args.memmap if args.memmap != None else os.path.join(tempfile.mkdtemp(), 'day.int8')
+    t0 = time.perf_counter()
+    dict_index = compileDaySchedulesToMemmap(dict_dayPlans, fileName, args.transition)
+    seconds = time.perf_counter() - t0
+    lightColorDays, dict_index = openDaySchedulesMemmap(fileName)
+    print('%d intersections, %d timeline rows (%.1f MB) compiled in %.2f s; %d plans assembled'
+          % (len(dict_index), lightColorDays.shape[0], lightColorDays.nbytes / 1e6, seconds, helper_assemblePlanCached.cache_info().misses))
+
+    t0 = time.perf_counter()
+    resOfSchedule = compileDaySchedule(dict_dayPlans['intersection0'], args.transition)
+    segments = getRunLengthSegments(resOfSchedule['lightColorDay'], resOfSchedule['phaseNames'])
+    row = dict_index['intersection0']['row']
+    assert (lightColorDays[row:row + len(resOfSchedule['phaseNames'])] == resOfSchedule['lightColorDay']).all()
+    print('intersection0: %d periods, %d run-length segments over %d phases (%.1f ms)'
+          % (len(resOfSchedule['periods']), sum(len(_[0]) for _ in segments.values()), len(segments), (time.perf_counter() - t0) * 1000))
+
+    # Rows under the names of the index, with a day plan not starting at 00:00 (the last plan runs first, from midnight)
+    planA = next(_ for _ in plans if 'EASTPED' not in assemblePlanCached(_)[0])
+    planB = next(_ for _ in plans if 'EASTPED' in assemblePlanCached(_)[0])
+    dayPlan = [('06:00', planA, 0), ('18:00', planB, 0)]
+    dict_indexAB = compileDaySchedulesToMemmap({'AB': dayPlan}, fileName + '.AB', args.transition)
+    lightColorDaysAB, _ = openDaySchedulesMemmap(fileName + '.AB')
+    for second, resStr in [(3 * 3600, planB), (12 * 3600, planA), (20 * 3600, planB)]:
+        planPhaseNames, cycleColorArray = assemblePlanCached(resStr)
+        for phaseName, row in zip(dict_indexAB['AB']['phaseNames'], itertools.count(dict_indexAB['AB']['row'])):
+            color = cycleColorArray[planPhaseNames.index(phaseName), second % cycleColorArray.shape[1]] if phaseName in planPhaseNames else 0
+            assert lightColorDaysAB[row, second] == color, (phaseName, second)
+    del lightColorDaysAB
+    os.remove(fileName + '.AB')
+    os.remove(fileName + '.AB.json')
+
+    del lightColorDays
+    if args.memmap == None:
+        os.remove(fileName)
+        os.remove(fileName + '.json')
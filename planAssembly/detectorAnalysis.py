@@ -0,0 +1,239 @@
+# Performance measures of an assembled plan from high-resolution detector logs: arrival on green, arrivals on red,
+# and a split failure proxy, per movement
+#
+# A detector log is a CSV of (timestamp, detector, movement) events, one per vehicle arrival; timestamps are epoch seconds
+# (or date-time strings), movements are the phase names of dict_lightColorRec. Each event is mapped to its position in the cycle
+# (which starts at cycleReferenceTime + offset, as in signalStateQuery) and its color is looked up in the color matrix of the plan,
+# one numpy fancy index per chunk. The log is read in chunks, in time order; the memory held between chunks is a few counters
+# per movement, and the arrival counts of the cycles not complete yet.
+#
+# Split failure proxy: the cycle of a movement is taken from the end of its green (red / yellow first, then the green that serves
+# the queue); it fails when its arrivals exceed what the green can discharge, green seconds / saturationHeadway.
+#
+# Run: python detectorAnalysis.py [--input log.csv --plan plan.json] [--events 2000000] [--chunksize 500000]
+import collections
+import math
+
+import numpy as np
+import pandas as pd
+
+from planEvaluation import helper_getColorMatrixOfCycle
+
+LOG_COLUMNS = ('timestamp', 'detector', 'movement')
+
+class DetectorAnalysis:
+    '''
+    Accumulator of detector events against an assembled plan; add chunks of events with update, read the measures with getReport.
+
+    Parameters:
+    resOfChat2SPaT(dict): the assembled plan obj (full or slim).
+    cycleReferenceTime: epoch time (s) of a cycle start, without offset.
+    offset: seconds from cycleReferenceTime to the cycle start.
+    saturationHeadway: seconds per vehicle discharged in green, for the split failure proxy.
+    greenCodes, yellowCodes: color codes counted as green (default green / WALK and permissive) and yellow (yellow and flash);
+                             the other codes (red, redAmber) count as red.
+    '''
+    def __init__(self, resOfChat2SPaT, cycleReferenceTime=0, offset=0, saturationHeadway=2.0, greenCodes=(2, -1), yellowCodes=(1, 3)):
+        self.movementNames, colors = helper_getColorMatrixOfCycle(resOfChat2SPaT['dict_lightColorRec'])
+        if colors.shape[1] == 0:
+            raise ValueError('The plan has no color codes.')
+        self.movementIndex = pd.Index(self.movementNames)
+        self.cycleStart = cycleReferenceTime + offset
+        self.cycleLength = C = colors.shape[1]
+        M = len(self.movementNames)
+        # Step 1: Color class of each second (0 green, 1 yellow, 2 red), per movement
+        self.colorClass = np.full((M, C), 2, dtype=np.int8)
+        self.colorClass[np.isin(colors, yellowCodes)] = 1
+        self.colorClass[np.isin(colors, greenCodes)] = 0
+        self.greenSeconds = (self.colorClass == 0).sum(axis=1)
+        # Step 2: Start of the split failure cycle of each movement, the end of its (first) green
+        isGreen = self.colorClass == 0
+        isGreenEnd = isGreen & ~np.roll(isGreen, -1, axis=1)
+        self.cycleAnchor = np.where(isGreenEnd.any(axis=1), isGreenEnd.argmax(axis=1) + 1, 0) % C
+        self.capacity = self.greenSeconds / saturationHeadway
+
+        self.arrivalsOfClass = np.zeros((M, 3), dtype=np.int64)
+        self.dict_arrivalsOfCycle = collections.Counter()  # (movement row, cycle number) -> arrivals, of the cycles not complete yet
+        self.splitFailures = np.zeros(M, dtype=np.int64)  # of the complete cycles
+        self.unmatchedEvents = 0
+        self.firstTime, self.lastTime = math.inf, -math.inf
+
+    def update(self, times, movements):
+        '''
+        Add a chunk of events. Chunks come in time order: the cycles before the first event of a chunk are complete.
+
+        Parameters:
+        times: epoch times (s) of the arrivals, array-like of floats.
+        movements: movement names of the arrivals, same length; names not in the plan are counted as unmatched.
+        '''
+        times = np.asarray(times, dtype=float)
+        rows = self.movementIndex.get_indexer(movements).astype(np.int64)
+        isMatched = rows >= 0
+        self.unmatchedEvents += int(len(rows) - isMatched.sum())
+        times, rows = times[isMatched], rows[isMatched]
+        if len(times) == 0:
+            return
+        self.firstTime, self.lastTime = min(self.firstTime, times.min()), max(self.lastTime, times.max())
+        M, C = len(self.movementNames), self.cycleLength
+        # Step 1: Position in the cycle, and the color class at it
+        sinceCycleStart = times - self.cycleStart
+        seconds = np.mod(sinceCycleStart, C).astype(np.int64)
+        classes = self.colorClass[rows, seconds]
+        self.arrivalsOfClass += np.bincount(rows * 3 + classes, minlength=M * 3).reshape(M, 3)
+        # Step 2: Arrivals of each split failure cycle
+        cycles = np.floor_divide(sinceCycleStart - self.cycleAnchor[rows], C).astype(np.int64)
+        keys, counts = np.unique(cycles * M + rows, return_counts=True)
+        self.dict_arrivalsOfCycle.update(dict(zip(zip((keys % M).tolist(), (keys // M).tolist()), counts.tolist())))
+        # Step 3: Cycles complete before this chunk are counted, and dropped; each movement has its own cycles (cycleAnchor),
+        # complete when they end before the first event of the chunk, whatever the movements of the events
+        firstCycles = np.floor_divide(times.min() - self.cycleStart - self.cycleAnchor, C).astype(np.int64)
+        for m, cycle in [_ for _ in self.dict_arrivalsOfCycle if _[1] < firstCycles[_[0]]]:
+            self.splitFailures[m] += self.dict_arrivalsOfCycle.pop((m, cycle)) > self.capacity[m]
+
+    def getReport(self):
+        '''
+        Measures per movement, as a DataFrame indexed by movement name: arrivals, arrivalsOnGreen / OnYellow / OnRed,
+        percentOnGreen (arrival on green), percentOnRed, greenRatio (green seconds / cycle length), platoonRatio
+        (percentOnGreen / greenRatio, > 1 when arrivals come in platoons on green), cycles (split failure cycles spanned by the log),
+        splitFailures and percentSplitFailures (NaN for a movement that is never green).
+        '''
+        M, C = len(self.movementNames), self.cycleLength
+        arrivals = self.arrivalsOfClass.sum(axis=1)
+        splitFailures = self.splitFailures.copy()
+        for (m, _), count in self.dict_arrivalsOfCycle.items():
+            splitFailures[m] += count > self.capacity[m]
+        if self.firstTime <= self.lastTime:
+            firstCycles = np.floor_divide(self.firstTime - self.cycleStart - self.cycleAnchor, C)
+            cycles = np.floor_divide(self.lastTime - self.cycleStart - self.cycleAnchor, C) - firstCycles + 1
+        else:
+            cycles = np.zeros(M)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            res = pd.DataFrame({'arrivals': arrivals, 'arrivalsOnGreen': self.arrivalsOfClass[:, 0],
+                                'arrivalsOnYellow': self.arrivalsOfClass[:, 1], 'arrivalsOnRed': self.arrivalsOfClass[:, 2],
+                                'percentOnGreen': 100 * self.arrivalsOfClass[:, 0] / arrivals,
+                                'percentOnRed': 100 * self.arrivalsOfClass[:, 2] / arrivals,
+                                'greenRatio': self.greenSeconds / C, 'cycles': cycles.astype(np.int64),
+                                'splitFailures': splitFailures}, index=pd.Index(self.movementNames, name='movement'))
+            res['platoonRatio'] = res['percentOnGreen'] / 100 / res['greenRatio']
+            res['percentSplitFailures'] = np.where(self.greenSeconds > 0, 100 * splitFailures / res['cycles'], np.nan)
+        return res
+
+def analyzeDetectorLog(resOfChat2SPaT, csvFile, cycleReferenceTime=0, offset=0, chunksize=500000, columns=LOG_COLUMNS,
+                       detectors=None, **kwargs):
+    '''
+    Stream a detector log CSV in chunks and compute the measures of each movement (see DetectorAnalysis.getReport).
+
+    Parameters:
+    csvFile: path or file obj of the CSV, with a header row.
+    columns: names of the (timestamp, detector, movement) columns.
+    detectors: optional collection of detector ids to keep (e.g. the stop-bar detectors); all events if None.
+    kwargs: saturationHeadway, greenCodes, yellowCodes of DetectorAnalysis.
+
+    Returns:
+    (DataFrame of the measures, dict of events (read), unmatchedEvents (movement not in the plan) and chunks)
+    '''
+    timestampColumn, detectorColumn, movementColumn = columns
+    analysis = DetectorAnalysis(resOfChat2SPaT, cycleReferenceTime, offset, **kwargs)
+    usecols = [timestampColumn, movementColumn] + ([detectorColumn] if detectors != None else [])
+    numEvents = numChunks = 0
+    for chunk in pd.read_csv(csvFile, usecols=usecols, chunksize=chunksize, dtype={movementColumn: str, detectorColumn: str}):
+        numEvents += len(chunk)
+        numChunks += 1
+        if detectors != None:
+            chunk = chunk[chunk[detectorColumn].isin([str(_) for _ in detectors])]
+        analysis.update(helper_getEpochSeconds(chunk[timestampColumn]), chunk[movementColumn].to_numpy())
+    return analysis.getReport(), {'events': numEvents, 'unmatchedEvents': analysis.unmatchedEvents, 'chunks': numChunks}
+
+# helper: epoch seconds of a timestamp column, numeric or date-time strings (naive ones are taken as UTC)
+def helper_getEpochSeconds(column):
+    if pd.api.types.is_numeric_dtype(column):
+        return column.to_numpy(dtype=float)
+    stamps = pd.to_datetime(column, utc=True)
+    return (stamps - pd.Timestamp(0, tz='UTC')).dt.total_seconds().to_numpy()
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import os
+    import tempfile
+    import time
+    import tracemalloc
+    from Chat2SPaT import convertChatPlanResToSpatParams
+    from batchAssembly import WARM_UP_RES_STR
+    from signalStateQuery import SignalStateIndex
+
+    parser = argparse.ArgumentParser(description='Arrival on green and split failures of a plan from a detector log CSV.')
+    parser.add_argument('--input', help='detector log CSV (timestamp, detector, movement); a synthetic log is generated if not given')
+    parser.add_argument('--plan', help='json file of the LLM outputs of the plan; the example of batchAssembly if not given')
+    parser.add_argument('--offset', type=float, default=0)
+    parser.add_argument('--events', type=int, default=2000000)
+    parser.add_argument('--chunksize', type=int, default=500000)
+    parser.add_argument('--saturation-headway', type=float, default=2.0)
+    args = parser.parse_args()
+
+    resStr = WARM_UP_RES_STR if args.plan == None else open(args.plan, encoding='utf-8').read()
+    resOfChat2SPaT = convertChatPlanResToSpatParams(resStr, plot=False, verbose=False)
+    if args.input != None:
+        report, stats = analyzeDetectorLog(resOfChat2SPaT, args.input, offset=args.offset, chunksize=args.chunksize,
+                                           saturationHeadway=args.saturation_headway)
+        print(report.round(2).to_string())
+        print(json.dumps(stats))
+        raise SystemExit
+
+    # Synthetic log: arrivals of each movement, half at random and half in platoons on its green
+    rng = np.random.default_rng(0)
+    index = SignalStateIndex(resOfChat2SPaT, offset=args.offset)
+    movementNames, C = index.movementNames, index.cycleLength
+    startTime = 1.7e9
+    rows = rng.integers(0, len(movementNames), args.events)
+    times = startTime + rng.uniform(0, args.events * 2, args.events)  # an arrival every 2 s, over the movements
+    isPlatoon = rng.random(args.events) < 0.5
+    res = index.queryBatch(rows[isPlatoon], times[isPlatoon])
+    shifts = res['timeToGreen'] + rng.uniform(0, 1, isPlatoon.sum()) * (res['timeToEndOfGreen'] - res['timeToGreen'])
+    times[isPlatoon] += np.where(np.isfinite(shifts), shifts, 0)  # a movement never green keeps its random arrivals
+    order = np.argsort(times)
+    log = pd.DataFrame({'timestamp': times[order].round(1), 'detector': rows[order] * 10 + rng.integers(1, 3, args.events),
+                        'movement': np.array(movementNames, dtype=object)[rows[order]]})
+    csvFile = os.path.join(tempfile.mkdtemp(), 'detectorLog.csv')
+    log.to_csv(csvFile, index=False)
+    print('synthetic log: %d events, %.1f MB, %d movements, cycle %d s' % (args.events, os.path.getsize(csvFile) / 1e6, len(movementNames), C))
+
+    # Streamed; then again under tracemalloc, for the peak memory
+    t0 = time.perf_counter()
+    report, stats = analyzeDetectorLog(resOfChat2SPaT, csvFile, offset=args.offset, chunksize=args.chunksize,
+                                       saturationHeadway=args.saturation_headway)
+    seconds = time.perf_counter() - t0
+    tracemalloc.start()
+    analyzeDetectorLog(resOfChat2SPaT, csvFile, offset=args.offset, chunksize=args.chunksize, saturationHeadway=args.saturation_headway)
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(report.round(2).to_string())
+    print('%d events in %d chunks: %.2f s (%.2fM events/s), peak memory %.1f MB'
+          % (stats['events'], stats['chunks'], seconds, stats['events'] / seconds / 1e6, peakBytes / 1e6))
+
+    # Same measures from the whole log in memory, with the colors of signalStateQuery
+    log['color'] = index.queryBatch(index.getMovementIndices(log['movement']), log['timestamp'].to_numpy())['color']
+    for movementName, group in log.groupby('movement'):
+        isGreen = group['color'].isin([2, -1])
+        isRed = ~group['color'].isin([2, -1, 1, 3])
+        assert report.loc[movementName, 'arrivals'] == len(group)
+        assert report.loc[movementName, 'arrivalsOnGreen'] == isGreen.sum()
+        assert report.loc[movementName, 'arrivalsOnRed'] == isRed.sum()
+    assert stats['events'] == args.events and stats['unmatchedEvents'] == 0
+    # Date-time strings give the same measures as epoch seconds
+    log['timestamp'] = pd.to_datetime(log['timestamp'], unit='s').dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+    log.head(100000).drop(columns='color').to_csv(csvFile, index=False)
+    reportOfStrings, _ = analyzeDetectorLog(resOfChat2SPaT, csvFile, offset=args.offset, chunksize=30000)
+    analysis = DetectorAnalysis(resOfChat2SPaT, offset=args.offset)
+    analysis.update(times[order][:100000].round(1), log['movement'].head(100000).to_numpy())
+    assert (reportOfStrings[['arrivalsOnGreen', 'arrivalsOnRed', 'splitFailures']] ==
+            analysis.getReport()[['arrivalsOnGreen', 'arrivalsOnRed', 'splitFailures']]).all().all()
+    # Small chunks (cut inside the cycles of the movements) count the same split failures as one chunk
+    timesHead, movementsHead = times[order][:20000].round(1), log['movement'].head(20000).to_numpy()
+    analysisOfChunks = DetectorAnalysis(resOfChat2SPaT, offset=args.offset)
+    for i in range(0, len(timesHead), 7):
+        analysisOfChunks.update(timesHead[i:i + 7], movementsHead[i:i + 7])
+    analysis = DetectorAnalysis(resOfChat2SPaT, offset=args.offset)
+    analysis.update(timesHead, movementsHead)
+    assert (analysisOfChunks.getReport()['splitFailures'] == analysis.getReport()['splitFailures']).all()
+    os.remove(csvFile)
@@ -0,0 +1,255 @@
+# Intersection layouts (legs, movements, crosswalks) compiled into conflict bitsets and default parent phases
+#
+# A layout is a json-like dict:
+#   'legs': leg -> angle (degrees clockwise from north), e.g. {'N': 0, 'E': 90, 'S': 180, 'W': 270}
+#   'movements': vehicle movement -> [from leg, to leg], e.g. {'SBT': ['N', 'S']}
+#   'crosswalks': ped phase -> [leg, half]; half is None for a one-stage crossing, 'A' for the half across the approach
+#                 lanes and 'B' for the half across the exit lanes of a two-stage crossing (as NORTHPEDA / NORTHPEDB)
+#   'conflicts' (optional): movement -> conflicting movements and crosswalks, instead of the conflicts from the geometry
+#   'defaultParents' (optional): ped phase -> default parent phases, instead of the ones from the geometry
+#
+# With right-hand traffic, each leg has an approach point and, clockwise after it, an exit point on a circle around the
+# intersection: two movements conflict if their paths (chords) cross or merge into the same exit, and a crosswalk conflicts
+# with the movements from (and half A) or to (and half B) its leg. Turns are classified by the change of heading.
+# A compiled layout gives each movement an id and holds, per movement, the int bitset of its conflicts; DEFAULT_LAYOUT is
+# conflictMatrix and helper_getDefaultParentPhaseList of Chat2SPaT.py, FOUR_LEG_LAYOUT the same intersection from its geometry
+# (with right turns, U-turns and both halves of the two-stage crossings).
+#
+# Run: python intersectionLayout.py
+import json
+
+from Chat2SPaT import conflictMatrix, helper_getDefaultParentPhaseList
+from assemblyEngines import dict_assemblyEngines, helper_findConflictIntervalsWithExemptions
+
+THROUGH_ANGLE = 45  # a movement turning by less than this angle (degrees) is a through movement
+
+# Layout of Chat2SPaT.py (the one in 'Intersection layout and phase coding.jpg')
+DEFAULT_LAYOUT = {'conflicts': conflictMatrix}
+
+# The four-leg intersection from its geometry, with the English phase names
+dict_approachOfLeg = {'S': 'NB', 'W': 'EB', 'N': 'SB', 'E': 'WB'}
+dict_pedOfLeg = {'N': 'NORTHPED', 'E': 'EASTPED', 'S': 'SOUTHPED', 'W': 'WESTPED'}
+FOUR_LEG_LAYOUT = {'legs': {'N': 0, 'E': 90, 'S': 180, 'W': 270},
+                   'movements': {dict_approachOfLeg[leg] + turn: [leg, toLeg] for leg, toLegs in
+                                 {'N': 'SEWN', 'E': 'WSNE', 'S': 'NWES', 'W': 'ENSW'}.items() for turn, toLeg in zip('TLRU', toLegs)},
+                   'crosswalks': dict({dict_pedOfLeg[leg]: [leg, None] for leg in 'NESW'},
+                                      **{dict_pedOfLeg[leg] + half: [leg, half] for leg in 'NESW' for half in 'AB'})}
+
+class IntersectionLayout:
+    '''
+    Compiled layout (see compileLayout): movement ids, conflict bitsets, permissive exemptions and default parent phases.
+
+    Parameters:
+    layout(dict): layout description (see the top of this file).
+    '''
+    def __init__(self, layout):
+        # Step 1: Conflicts by name, from the layout or its geometry
+        if 'conflicts' in layout:
+            dict_conflicts = {k: list(v) for k, v in layout['conflicts'].items()}
+            dict_turns = {}
+        else:
+            dict_conflicts, dict_turns = helper_getGeometricConflicts(layout)
+
+        # Step 2: Movement ids and bitsets
+        self.movementNames = []
+        for k, v in dict_conflicts.items():
+            for phaseName in [k] + v:
+                if phaseName not in self.movementNames:
+                    self.movementNames.append(phaseName)
+        self.dict_idOfMovement = {k: i for i, k in enumerate(self.movementNames)}
+        self.hasConflictRow = [k in dict_conflicts for k in self.movementNames]  # phases checked as phaseName, as the rows of conflictMatrix
+        self.conflictBits = [sum(1 << self.dict_idOfMovement[_] for _ in set(dict_conflicts.get(k, []))) for k in self.movementNames]
+        # exemptionBits[i]: movements j that do not conflict with i while j is permissive or yellow
+        # (opposite permissive left-turns of a through movement, and vice versa)
+        self.exemptionBits = [0] * len(self.movementNames)
+        for i, phaseName in enumerate(self.movementNames):
+            for j, phaseConflictName in enumerate(self.movementNames):
+                if helper_isPermissiveExemption(phaseName, phaseConflictName, dict_turns, layout):
+                    self.exemptionBits[i] |= 1 << j
+
+        # Step 3: Default parent phases of the ped phases
+        if 'defaultParents' in layout:
+            self.dict_defaultParents = {k: list(v) for k, v in layout['defaultParents'].items()}
+        elif 'crosswalks' in layout:
+            self.dict_defaultParents = helper_getGeometricDefaultParents(layout, dict_turns)
+        else:
+            self.dict_defaultParents = None  # as Chat2SPaT.py
+
+    def isConflicting(self, phaseName, phaseConflictName):
+        '''Whether phaseConflictName is in the conflicts of phaseName.'''
+        i, j = self.dict_idOfMovement.get(phaseName), self.dict_idOfMovement.get(phaseConflictName)
+        return i != None and j != None and self.conflictBits[i] >> j & 1 == 1
+
+    def getConflicts(self, phaseName):
+        '''Conflicting movements and crosswalks of a phase (in id order).'''
+        i = self.dict_idOfMovement.get(phaseName)
+        return [] if i == None else helper_getNamesOfBits(self.conflictBits[i], self.movementNames)
+
+    def getDefaultParentPhaseList(self, phaseName):
+        '''Default parent phases of a ped phase, as helper_getDefaultParentPhaseList.'''
+        if self.dict_defaultParents == None:
+            return helper_getDefaultParentPhaseList(phaseName)
+        return list(self.dict_defaultParents.get(phaseName, []))
+
+    def checkConflictPhases(self, dict_lightColorRec):
+        '''
+        Same as checkConflictPhases of Chat2SPaT.py, with the conflicts of the layout: the conflicting phases in the plan,
+        not checked yet, are found with bitwise operations over the movement ids.
+        '''
+        warningMsgConflictPhases = {}
+        inPlanBits = 0
+        for phaseName in dict_lightColorRec:
+            i = self.dict_idOfMovement.get(phaseName)
+            if i != None:
+                inPlanBits |= 1 << i
+        checkedBits = 0
+        for phaseName in dict_lightColorRec:
+            i = self.dict_idOfMovement.get(phaseName)
+            if i == None or not self.hasConflictRow[i]:
+                continue
+            bits = self.conflictBits[i] & inPlanBits & ~checkedBits
+            while bits:
+                j = (bits & -bits).bit_length() - 1
+                bits &= bits - 1
+                phaseConflictName = self.movementNames[j]
+                conflictTimeIntervals = helper_findConflictIntervalsWithExemptions(dict_lightColorRec[phaseName], dict_lightColorRec[phaseConflictName],
+                                                                                   self.exemptionBits[j] >> i & 1 == 1, self.exemptionBits[i] >> j & 1 == 1)
+                if len(conflictTimeIntervals) > 0:
+                    warningMsgConflictPhases.update({'%s|%s' % (phaseName, phaseConflictName): conflictTimeIntervals})
+            checkedBits |= 1 << i
+        return warningMsgConflictPhases
+
+    def getEngine(self, engineName='reference'):
+        '''Assembly engine (see assemblyEngines.py) with the conflict check and the default parent phases of the layout.'''
+        return dict(dict_assemblyEngines[engineName], checkConflictPhases=self.checkConflictPhases,
+                    getDefaultParentPhaseList=self.getDefaultParentPhaseList)
+
+# Compiled layouts by their json, so each layout is compiled once
+dict_compiledLayouts = {}
+
+def compileLayout(layout=DEFAULT_LAYOUT):
+    '''Compiled layout (IntersectionLayout), cached per layout description.'''
+    k = json.dumps(layout, sort_keys=True, ensure_ascii=False)
+    if k not in dict_compiledLayouts:
+        dict_compiledLayouts[k] = IntersectionLayout(layout)
+    return dict_compiledLayouts[k]
+
+# helper: turn of each movement ('T', 'L', 'R' or 'U' from the change of heading), and the conflicts of the movements and crosswalks
+def helper_getGeometricConflicts(layout):
+    legs, movements, crosswalks = layout['legs'], layout['movements'], layout.get('crosswalks', {})
+    for phaseName, (fromLeg, toLeg) in movements.items():
+        if fromLeg not in legs or toLeg not in legs:
+            raise ValueError('Unknown leg of movement %s: %s' % (phaseName, [fromLeg, toLeg]))
+    dict_turns = {}
+    for phaseName, (fromLeg, toLeg) in movements.items():
+        turn = (legs[toLeg] - (legs[fromLeg] + 180) + 180) % 360 - 180  # heading change, clockwise positive (right)
+        dict_turns[phaseName] = 'U' if fromLeg == toLeg else 'T' if abs(turn) < layout.get('throughAngle', THROUGH_ANGLE) else 'R' if turn > 0 else 'L'
+    # approach and exit points of the legs, in clockwise order
+    legsSorted = sorted(legs, key=lambda _: legs[_] % 360)
+    dict_approachPoint = {leg: 2 * n for n, leg in enumerate(legsSorted)}
+    dict_exitPoint = {leg: 2 * n + 1 for n, leg in enumerate(legsSorted)}
+    def crossOrMerge(movement1, movement2):
+        (a1, b1), (a2, b2) = movement1, movement2
+        if a1 == a2:  # diverging from the same approach
+            return False
+        if b1 == b2:  # merging into the same exit
+            return True
+        p1, q1 = sorted([dict_approachPoint[a1], dict_exitPoint[b1]])
+        return (p1 < dict_approachPoint[a2] < q1) != (p1 < dict_exitPoint[b2] < q1)
+    dict_conflicts = {k: [] for k in list(movements) + list(crosswalks)}
+    for phaseName, movement in movements.items():
+        for phaseConflictName, movementConflict in movements.items():
+            if phaseName != phaseConflictName and crossOrMerge(movement, movementConflict):
+                dict_conflicts[phaseName].append(phaseConflictName)
+        for pedName, (leg, half) in crosswalks.items():
+            if (movement[0] == leg and half in (None, 'A')) or (movement[1] == leg and half in (None, 'B')):
+                dict_conflicts[phaseName].append(pedName)
+                dict_conflicts[pedName].append(phaseName)
+    return dict_conflicts, dict_turns
+
+# helper: whether phaseName (a through movement) does not conflict with phaseConflictName (the opposite left-turn) while the
+# left-turn is permissive or yellow; by the turns of the layout, or by the names as checkConflictPhases without geometry
+def helper_isPermissiveExemption(phaseName, phaseConflictName, dict_turns, layout):
+    if len(dict_turns) > 0:
+        if dict_turns.get(phaseName) != 'T' or dict_turns.get(phaseConflictName) != 'L':
+            return False
+        return layout['movements'][phaseName][1] == layout['movements'][phaseConflictName][0]  # the left-turn comes from the exit leg
+    dictOpposite = {'东': '西', '西': '东', '北': '南', '南': '北', 'E': 'W', 'W': 'E', 'N': 'S', 'S': 'N'}
+    return (('直行' in phaseName and '左转' in phaseConflictName) or ('BT' in phaseName and 'BL' in phaseConflictName))\
+        and dictOpposite.get(phaseName[0]) == phaseConflictName[0]
+
+# helper: default parent phases of the crosswalks: the through movement parallel to the crosswalk, from the next leg clockwise
+# (as WBT for NORTHPED), and for half A the left-turn into the leg, for half B the left-turn from the leg (as EBL / SBL for NORTHPEDA / B)
+def helper_getGeometricDefaultParents(layout, dict_turns):
+    legs, movements = layout['legs'], layout['movements']
+    legsSorted = sorted(legs, key=lambda _: legs[_] % 360)
+    res = {}
+    for pedName, (leg, half) in layout['crosswalks'].items():
+        n = legsSorted.index(leg)
+        nextLeg, previousLeg = legsSorted[(n + 1) % len(legsSorted)], legsSorted[n - 1]
+        parents = [k for k, (a, b) in movements.items() if dict_turns[k] == 'T' and a == nextLeg and b != leg]
+        if half == 'A':
+            parents += [k for k, (a, b) in movements.items() if dict_turns[k] == 'L' and a == previousLeg and b == leg]
+        elif half == 'B':
+            parents += [k for k, (a, b) in movements.items() if dict_turns[k] == 'L' and a == leg and b == nextLeg]
+        res[pedName] = parents
+    return res
+
+# helper: names of the set bits of a bitset
+def helper_getNamesOfBits(bits, names):
+    res = []
+    while bits:
+        res.append(names[(bits & -bits).bit_length() - 1])
+        bits &= bits - 1
+    return res
+
+if __name__ == '__main__':
+    import time
+    from Chat2SPaT import checkConflictPhases, convertChatPlanResToSpatParams
+    from assemblyEngines import assemblePlanWithEngine
+    from planGenerator import generateSyntheticPlan, PED_PHASES
+
+    # The default layout gives the plan objs of Chat2SPaT.py
+    layoutDefault = compileLayout()
+    resStrList = []
+    for i in range(300):
+        try:
+            resStrList.append(generateSyntheticPlan(seed=i, numRings=i % 3, numPedPhases=i % 5, numPermissivePhases=i % 3,
+                                                    numOverlapPhases=i % 4, language='zh' if i % 2 else 'en'))
+        except ValueError:  # a combination of knobs the generator does not support
+            pass
+    mismatches = 0
+    secondsOfReference = secondsOfLayout = 0
+    for resStr in resStrList:
+        res = assemblePlanWithEngine(resStr)
+        t0 = time.perf_counter()
+        warningMsgConflictPhases = checkConflictPhases(res['dict_lightColorRec'])
+        t1 = time.perf_counter()
+        warningMsgConflictPhasesOfLayout = layoutDefault.checkConflictPhases(res['dict_lightColorRec'])
+        secondsOfReference, secondsOfLayout = secondsOfReference + t1 - t0, secondsOfLayout + time.perf_counter() - t1
+        mismatches += warningMsgConflictPhasesOfLayout != warningMsgConflictPhases
+        mismatches += convertChatPlanResToSpatParams(resStr, plot=False, verbose=False, engine=layoutDefault.getEngine()) != res
+    print('default layout: %d mismatches with checkConflictPhases; %.1f ms (reference %.1f ms) for %d plans'
+          % (mismatches, secondsOfLayout * 1000, secondsOfReference * 1000, len(resStrList)))
+    assert mismatches == 0
+
+    # The four-leg geometry compared with conflictMatrix
+    layoutFourLeg = compileLayout(FOUR_LEG_LAYOUT)
+    for phaseName in ['SBT', 'SBL', 'SBR', 'SBU']:
+        print('  %s conflicts: %s' % (phaseName, ' '.join(layoutFourLeg.getConflicts(phaseName))))
+        if phaseName in conflictMatrix:
+            print('      conflictMatrix: %s' % ' '.join(conflictMatrix[phaseName]))
+    for pedName in PED_PHASES[:1] + ['NORTHPEDA', 'NORTHPEDB']:
+        print('  %s default parents: %s (Chat2SPaT.py: %s)' % (pedName, layoutFourLeg.getDefaultParentPhaseList(pedName),
+                                                              helper_getDefaultParentPhaseList(pedName)))
+
+    # A T-junction (no west leg) and a five-leg intersection
+    layoutT = compileLayout({'legs': {'N': 0, 'E': 90, 'S': 180},
+                             'movements': {'SBT': ['N', 'S'], 'SBL': ['N', 'E'], 'NBT': ['S', 'N'], 'NBR': ['S', 'E'],
+                                           'WBL': ['E', 'S'], 'WBR': ['E', 'N']},
+                             'crosswalks': {'NORTHPED': ['N', None], 'SOUTHPED': ['S', None], 'EASTPED': ['E', None]}})
+    print('T-junction:', {k: layoutT.getConflicts(k) for k in ['SBL', 'NBR', 'WBL']}, 'EASTPED parents', layoutT.getDefaultParentPhaseList('EASTPED'))
+    layoutFiveLeg = compileLayout({'legs': {'N': 0, 'NE': 60, 'E': 110, 'S': 180, 'W': 270},
+                                   'movements': {'%s-%s' % (a, b): [a, b] for a in ['N', 'NE', 'E', 'S', 'W'] for b in ['N', 'NE', 'E', 'S', 'W'] if a != b}})
+    print('five-leg: %d movements, %d conflicting pairs; N-S conflicts %s'
+          % (len(layoutFiveLeg.movementNames), sum(bin(_).count('1') for _ in layoutFiveLeg.conflictBits) // 2, layoutFiveLeg.getConflicts('N-S')))
@@ -1,5 +1,6 @@
 # Main fuction
 from Chat2SPaT import convertChatPlanResToSpatParams
+from planSchemaValidation import validateLlmOutputs
 
 if __name__ == '__main__':
     '''Use LLM outputs as inputs - resStr, to generate SPaT results.
@@ -47,7 +48,14 @@ if __name__ == '__main__':
     '''
     
     try:
-        resOfChat2SPaT = convertChatPlanResToSpatParams(resStr)
+        schemaErrors = validateLlmOutputs(resStr)
+        if len(schemaErrors) > 0:
+            resOfChat2SPaT = None
+            print("LLM outputs do not match the output format:")
+            for error in schemaErrors:
+                print("  %s: %s" % (error['path'], error['reason']))
+        else:
+            resOfChat2SPaT = convertChatPlanResToSpatParams(resStr)
     except:
         resOfChat2SPaT = None
         print("TSC plan cannot be assembled using the inputs. \nPlease check your LLM outputs and use valid inputs.")
@@ -0,0 +1,264 @@
+# Append-only archive of assembled plans (resOfChat2SPaT), readable with zero copies through numpy.memmap
+#
+# An archive is a folder of three append-only files:
+#   colors.int8  - the color codes of each plan, as a (phases, cycleLength) int8 block
+#   phases.int32 - one row of PHASE_COLUMNS per phase stage of planSchemeMinorMerged
+#   index.jsonl  - one line per plan: planId, intersectionId, contentHash, offsets and shapes in the two files above, phase names,
+#                  isValid and warning msgs
+# The data is written before the index line, so a plan is visible to readers only once it is complete.
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from Chat2SPaT import helper_getSubValueFromPhase
+
+# Columns of the phase table (int32; -1 if the attribute is None)
+PHASE_COLUMNS = ['phaseOrder', 'startTime', 'endTime', 'split', 'startOfGreen', 'endOfGreen', 'greenTime', 'lateStart', 'earlyCutOff',
+                 'yellow', 'allRed', 'redAmber', 'greenFlash', 'isPermissive']
+
+class PlanArchiveWriter:
+    '''
+    Appends plans to an archive folder (created if needed).
+
+    Parameters:
+    path: folder of the archive.
+    dedup: if True, a plan with the same content hash as an archived one shares its color block.
+    '''
+    def __init__(self, path, dedup=True):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.dedup = dedup
+        self.fileColors = open(os.path.join(path, 'colors.int8'), 'ab')
+        self.filePhases = open(os.path.join(path, 'phases.int32'), 'ab')
+        helper_truncateIncompleteLine(os.path.join(path, 'index.jsonl'))  # the first record written starts on a line of its own
+        self.fileIndex = open(os.path.join(path, 'index.jsonl'), 'a', encoding='utf-8')
+        self.dict_colorOffsetOfHash = {}
+        self.planIds = set([])
+        for record in helper_readIndex(path):
+            self.dict_colorOffsetOfHash.setdefault(record['contentHash'], record['colorOffset'])
+            self.planIds.add(record['planId'])
+
+    def append(self, resOfChat2SPaT, planId=None, intersectionId=None):
+        '''Append one plan (full or slim plan obj). planId defaults to the number of plans in the archive. Returns the index record.'''
+        planId = str(planId) if planId != None else str(len(self.planIds))
+        if planId in self.planIds:
+            raise ValueError('Plan %s is already in the archive.' % planId)
+        phaseNames, colors = helper_getColorMatrix(resOfChat2SPaT['dict_lightColorRec'])
+        contentHash = helper_calcContentHash(phaseNames, colors)
+
+        # Step 1: color block (shared with an identical plan if dedup)
+        if self.dedup and contentHash in self.dict_colorOffsetOfHash:
+            colorOffset = self.dict_colorOffsetOfHash[contentHash]
+        else:
+            colorOffset = self.fileColors.tell()
+            self.fileColors.write(colors.tobytes())
+            self.fileColors.flush()
+            self.dict_colorOffsetOfHash.setdefault(contentHash, colorOffset)
+
+        # Step 2: phase table rows
+        phaseRows = helper_getPhaseTableRows(resOfChat2SPaT['planSchemeMinorMerged'])
+        phaseOffset = self.filePhases.tell() // (4 * len(PHASE_COLUMNS))
+        self.filePhases.write(phaseRows.tobytes())
+        self.filePhases.flush()
+
+        # Step 3: index line, written last
+        record = {'planId': planId, 'intersectionId': intersectionId, 'contentHash': contentHash,
+                  'colorOffset': colorOffset, 'phaseNames': phaseNames, 'cycleLength': int(colors.shape[1]),
+                  'phaseOffset': phaseOffset, 'phaseStageNames': [helper_getSubValueFromPhase('phaseName', _) for _ in
+                                                                  resOfChat2SPaT['planSchemeMinorMerged'] if 'DUMMYPHASE' not in _],
+                  'isValid': resOfChat2SPaT['isValid'], 'warningMsgCycleLength': resOfChat2SPaT['warningMsgCycleLength'],
+                  'warningMsgConflictPhases': resOfChat2SPaT['warningMsgConflictPhases'], 'warningMsgPedWalk': resOfChat2SPaT['warningMsgPedWalk']}
+        self.fileIndex.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.fileIndex.flush()
+        self.planIds.add(planId)
+        return record
+
+    def appendBatch(self, resOfPlans, planIds=None, intersectionIds=None):
+        '''
+        Append plans from an iterable (e.g. the generator of batchAssembly.assemblePlanBatch), as they come.
+        Plans that could not be assembled (None) are skipped. Returns the number of plans appended.
+        '''
+        planIds = iter(planIds) if planIds != None else None
+        intersectionIds = iter(intersectionIds) if intersectionIds != None else None
+        n = 0
+        for resOfChat2SPaT in resOfPlans:
+            planId = next(planIds) if planIds != None else None
+            intersectionId = next(intersectionIds) if intersectionIds != None else None
+            if resOfChat2SPaT == None:
+                continue
+            self.append(resOfChat2SPaT, planId, intersectionId)
+            n += 1
+        return n
+
+    def close(self):
+        for f in (self.fileColors, self.filePhases, self.fileIndex):
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class PlanArchiveReader:
+    '''
+    Reads an archive folder. The color codes and phase table are memory-mapped; the color rows of a plan are views into the file.
+    Plans appended after opening are seen after refresh().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        self.records = helper_readIndex(self.path)
+        self.dict_recordOfPlan = {_['planId']: _ for _ in self.records}
+        self.dict_plansOfIntersection = {}
+        self.dict_plansOfHash = {}
+        for record in self.records:
+            self.dict_plansOfIntersection.setdefault(record['intersectionId'], []).append(record['planId'])
+            self.dict_plansOfHash.setdefault(record['contentHash'], []).append(record['planId'])
+        self.colors = helper_openMemmap(os.path.join(self.path, 'colors.int8'), np.int8, 1)
+        self.phases = helper_openMemmap(os.path.join(self.path, 'phases.int32'), np.int32, len(PHASE_COLUMNS))
+
+    def __len__(self):
+        return len(self.records)
+
+    def getColorRows(self, planId):
+        '''Returns (phaseNames, color codes as an int8 view of shape (phases, cycleLength)); no data is copied.'''
+        record = self.dict_recordOfPlan[str(planId)]
+        n, cycleLength = len(record['phaseNames']), record['cycleLength']
+        block = self.colors[record['colorOffset']:record['colorOffset'] + n * cycleLength]
+        return record['phaseNames'], block.reshape(n, cycleLength)
+
+    def getPhaseTable(self, planId):
+        '''Returns (phase stage names, int32 view of shape (phase stages, len(PHASE_COLUMNS))).'''
+        record = self.dict_recordOfPlan[str(planId)]
+        return record['phaseStageNames'], self.phases[record['phaseOffset']:record['phaseOffset'] + len(record['phaseStageNames'])]
+
+    def getPlan(self, planId):
+        '''The plan as a (slim) plan obj: planSchemeMinorMerged from the phase table, dict_lightColorRec of int8 views, warnings and isValid.'''
+        record = self.dict_recordOfPlan[str(planId)]
+        phaseNames, colors = self.getColorRows(planId)
+        phaseStageNames, phaseTable = self.getPhaseTable(planId)
+        planScheme = []
+        for phaseName, row in zip(phaseStageNames, phaseTable):
+            planScheme.append({phaseName: {k: int(v) for k, v in zip(PHASE_COLUMNS, row) if v != -1}})
+        res = {'planSchemeMinorMerged': planScheme, 'dict_lightColorRec': {k: colors[i] for i, k in enumerate(phaseNames)}}
+        for k in ['warningMsgCycleLength', 'warningMsgConflictPhases', 'warningMsgPedWalk', 'isValid']:
+            res[k] = record[k]
+        return res
+
+    def findPlansOfIntersection(self, intersectionId):
+        return list(self.dict_plansOfIntersection.get(intersectionId, []))
+
+    def findPlansOfHash(self, contentHash):
+        return list(self.dict_plansOfHash.get(contentHash, []))
+
+def writeArchiveFromBatch(path, resStrIter, planIds=None, intersectionIds=None, pool=None, workers=None, chunksize=8):
+    '''Assemble LLM outputs in worker processes (batchAssembly.assemblePlanBatch) and stream the results into an archive.
+    Returns the number of plans appended.'''
+    from batchAssembly import assemblePlanBatch
+    with PlanArchiveWriter(path) as writer:
+        return writer.appendBatch(assemblePlanBatch(resStrIter, pool=pool, workers=workers, chunksize=chunksize), planIds, intersectionIds)
+
+# helper: phase names (sorted) and color codes of dict_lightColorRec as an int8 matrix
+def helper_getColorMatrix(dict_lightColorRec):
+    phaseNames = sorted(dict_lightColorRec)
+    colors = np.array([list(dict_lightColorRec[_]) for _ in phaseNames], dtype=np.int8).reshape(len(phaseNames), -1)
+    return phaseNames, colors
+
+# helper: hash of the SPaT content of a plan (phase names and color codes)
+def helper_calcContentHash(phaseNames, colors):
+    h = hashlib.sha1(json.dumps(phaseNames, ensure_ascii=False).encode('utf-8'))
+    h.update(np.int32(colors.shape[1]).tobytes())
+    h.update(colors.tobytes())
+    return h.hexdigest()
+
+# helper: phase table rows of planSchemeMinorMerged (dummy phases excluded)
+def helper_getPhaseTableRows(planScheme):
+    rows = []
+    for phase in planScheme:
+        if 'DUMMYPHASE' in phase:
+            continue
+        row = [helper_getSubValueFromPhase(k, phase) for k in PHASE_COLUMNS]
+        rows.append([v if type(v) == int else -1 for v in row])
+    return np.array(rows, dtype=np.int32).reshape(len(rows), len(PHASE_COLUMNS))
+
+# helper: records of index.jsonl (an incomplete last line, from an interrupted writer, is ignored)
+def helper_readIndex(path):
+    fileName = os.path.join(path, 'index.jsonl')
+    if not os.path.exists(fileName):
+        return []
+    records = []
+    with open(fileName, encoding='utf-8') as f:
+        for line in f:
+            if line.endswith('\n'):
+                records.append(json.loads(line))
+    return records
+
+# helper: cut the incomplete last line of a file (left by an interrupted writer) back to the last newline
+def helper_truncateIncompleteLine(fileName, blockSize=65536):
+    if not os.path.exists(fileName):
+        return
+    with open(fileName, 'r+b') as f:
+        size = end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - blockSize)
+            f.seek(start)
+            i = f.read(end - start).rfind(b'\n')
+            if i >= 0:
+                end = start + i + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+
+# helper: read-only memmap of an append-only file, as a flat (or rows x columns) array
+def helper_openMemmap(fileName, dtype, columns):
+    size = os.path.getsize(fileName) if os.path.exists(fileName) else 0
+    rows = size // (np.dtype(dtype).itemsize * columns)
+    if rows == 0:
+        return np.zeros((0,) if columns == 1 else (0, columns), dtype=dtype)
+    return np.memmap(fileName, dtype=dtype, mode='r', shape=(rows,) if columns == 1 else (rows, columns))
+
+if __name__ == '__main__':
+    import argparse
+    import shutil
+    import tempfile
+    import time
+    from planGenerator import generateSyntheticPlans
+
+    parser = argparse.ArgumentParser(description='Write synthetic plans to an archive through the batch assembler, and read them back.')
+    parser.add_argument('--plans', type=int, default=200)
+    parser.add_argument('--path', default=None, help='archive folder (default: a temporary folder, removed afterwards)')
+    args = parser.parse_args()
+
+    path = args.path if args.path != None else tempfile.mkdtemp()
+    resStrList = generateSyntheticPlans(args.plans, numStages=4, numPedPhases=2)
+    t0 = time.perf_counter()
+    n = writeArchiveFromBatch(path, resStrList, planIds=['plan%d' % i for i in range(args.plans)],
+                              intersectionIds=['intersection%d' % (i % 50) for i in range(args.plans)])
+    print('%d plans assembled and archived in %.2f s' % (n, time.perf_counter() - t0))
+
+    t0 = time.perf_counter()
+    reader = PlanArchiveReader(path)
+    print('archive opened in %.1f ms: %d plans, %.1f KB of color codes' % ((time.perf_counter() - t0) * 1000, len(reader), reader.colors.nbytes / 1024))
+    phaseNames, colors = reader.getColorRows('plan7')
+    assert not colors.flags['OWNDATA']  # a view into the memmap
+    resOfChat2SPaT = reader.getPlan('plan7')
+    print('plan7: %d phases, cycle %d s, valid %d; intersection7 has plans %s'
+          % (len(phaseNames), colors.shape[1], resOfChat2SPaT['isValid'], reader.findPlansOfIntersection('intersection7')))
+
+    # A writer interrupted in the middle of an index line: the next writer appends after the last complete line
+    with open(os.path.join(path, 'index.jsonl'), 'a', encoding='utf-8') as f:
+        f.write('{"planId": "partial", "intersec')
+    with PlanArchiveWriter(path) as writer:
+        writer.append(resOfChat2SPaT, planId='plan7again', intersectionId='intersection7')
+    reader.refresh()
+    assert len(reader) == n + 1 and reader.findPlansOfIntersection('intersection7')[-1] == 'plan7again'
+    assert reader.getColorRows('plan7again')[1].tolist() == colors.tolist()
+    if args.path == None:
+        del reader, colors, resOfChat2SPaT
+        shutil.rmtree(path)
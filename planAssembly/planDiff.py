@@ -0,0 +1,148 @@
+# Structural diff of two assembled plans, e.g. before and after a "further..." instruction in chat editing
+#
+# Phases are matched by phaseName (dict_lightColorRec) and phase stages by (phaseName, phaseOrder) (planSchemeMinorMerged).
+# The color rows of both plans are compared as two int8 matrices in one numpy comparison, and the changed seconds of each
+# phase are turned into [start, end) intervals (end excluded, as the intervals of warningMsgConflictPhases).
+#
+# Run: python planDiff.py [--pairs 1000]
+import numpy as np
+
+from Chat2SPaT import helper_getSubValueFromPhase
+
+WARNING_KEYS = ['warningMsgCycleLength', 'warningMsgConflictPhases', 'warningMsgPedWalk', 'isValid']
+
+def diffPlans(resBefore, resAfter):
+    '''
+    Differences between two assembled plans (full or slim plan objs).
+
+    Returns:
+    dict of
+    isIdentical: True if the phases, phase attributes, color codes and warnings are all the same.
+    cycleLength: [before, after] (the same value twice if unchanged).
+    addedPhases, removedPhases: phase names only in the plan after / before.
+    addedPhaseStages, removedPhaseStages: 'phaseName|phaseOrder' of phase stages only in the plan after / before.
+    changedAttributes: 'phaseName|phaseOrder' -> {attribute: [before, after]} for the phase stages in both plans.
+    changedSeconds: phaseName -> [[start, end], ...] seconds of the cycle where the color code changed (phases in both plans;
+                    with different cycle lengths, the seconds beyond the shorter cycle are changed).
+    changedWarnings: field -> [before, after], for the warningMsg* fields and isValid that changed.
+    '''
+    # Step 1: Phases
+    phaseNamesBefore, phaseNamesAfter = list(resBefore['dict_lightColorRec']), list(resAfter['dict_lightColorRec'])
+    setBefore, setAfter = set(phaseNamesBefore), set(phaseNamesAfter)
+    res = {'cycleLength': [helper_getCycleLength(resBefore), helper_getCycleLength(resAfter)],
+           'addedPhases': [_ for _ in phaseNamesAfter if _ not in setBefore],
+           'removedPhases': [_ for _ in phaseNamesBefore if _ not in setAfter]}
+
+    # Step 2: Phase stages and their attributes
+    dict_stagesBefore, dict_stagesAfter = helper_getPhaseStages(resBefore), helper_getPhaseStages(resAfter)
+    res['addedPhaseStages'] = [k for k in dict_stagesAfter if k not in dict_stagesBefore]
+    res['removedPhaseStages'] = [k for k in dict_stagesBefore if k not in dict_stagesAfter]
+    res['changedAttributes'] = {}
+    for k, attributesBefore in dict_stagesBefore.items():
+        attributesAfter = dict_stagesAfter.get(k)
+        if attributesAfter == None or attributesAfter == attributesBefore:
+            continue
+        res['changedAttributes'][k] = {attr: [attributesBefore.get(attr), attributesAfter.get(attr)]
+                                       for attr in list(attributesBefore) + [_ for _ in attributesAfter if _ not in attributesBefore]
+                                       if attributesBefore.get(attr) != attributesAfter.get(attr)}
+
+    # Step 3: Changed seconds of the phases in both plans
+    commonPhaseNames = [_ for _ in phaseNamesBefore if _ in setAfter]
+    res['changedSeconds'] = {}
+    if len(commonPhaseNames) > 0:
+        colorsBefore = helper_getColorRows(resBefore['dict_lightColorRec'], commonPhaseNames)
+        colorsAfter = helper_getColorRows(resAfter['dict_lightColorRec'], commonPhaseNames)
+        T = max(colorsBefore.shape[1], colorsAfter.shape[1])
+        changed = np.ones((len(commonPhaseNames), T + 2), dtype=np.int8)  # one unchanged second of padding at both ends
+        changed[:, [0, -1]] = 0
+        width = min(colorsBefore.shape[1], colorsAfter.shape[1])
+        changed[:, 1:width + 1] = colorsBefore[:, :width] != colorsAfter[:, :width]
+        edges = np.diff(changed, axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        _, ends = np.nonzero(edges == -1)
+        for i, t1, t2 in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+            res['changedSeconds'].setdefault(commonPhaseNames[i], []).append([t1, t2])
+
+    # Step 4: Warnings and validation result
+    res['changedWarnings'] = {k: [resBefore.get(k), resAfter.get(k)] for k in WARNING_KEYS if resBefore.get(k) != resAfter.get(k)}
+    res['isIdentical'] = res['cycleLength'][0] == res['cycleLength'][1] and all(len(res[k]) == 0 for k in
+        ['addedPhases', 'removedPhases', 'addedPhaseStages', 'removedPhaseStages', 'changedAttributes', 'changedSeconds', 'changedWarnings'])
+    return res
+
+def diffPlanBatch(resOfPlansBefore, resOfPlansAfter):
+    '''diffPlans of each (before, after) pair of two lists of plan objs; None for a pair with a plan missing (None).'''
+    return [diffPlans(before, after) if before != None and after != None else None for before, after in zip(resOfPlansBefore, resOfPlansAfter)]
+
+def formatPlanDiff(resOfDiff):
+    '''Text summary of a diff, one line per change, e.g. for the answer of a chat editing turn.'''
+    if resOfDiff['isIdentical']:
+        return 'No change.'
+    lines = []
+    if resOfDiff['cycleLength'][0] != resOfDiff['cycleLength'][1]:
+        lines.append('cycle length: %s -> %s' % tuple(resOfDiff['cycleLength']))
+    for k, label in [('addedPhases', 'added phase'), ('removedPhases', 'removed phase'),
+                     ('addedPhaseStages', 'added phase stage'), ('removedPhaseStages', 'removed phase stage')]:
+        lines += ['%s: %s' % (label, _) for _ in resOfDiff[k]]
+    for k, attributes in resOfDiff['changedAttributes'].items():
+        lines.append('%s: %s' % (k, ', '.join('%s %s -> %s' % (attr, v[0], v[1]) for attr, v in attributes.items())))
+    for phaseName, intervals in resOfDiff['changedSeconds'].items():
+        lines.append('%s colors changed at seconds %s' % (phaseName, ', '.join('%d-%d' % (t1, t2) for t1, t2 in intervals)))
+    for k, v in resOfDiff['changedWarnings'].items():
+        lines.append('%s: %s -> %s' % (k, v[0], v[1]))
+    return '\n'.join(lines)
+
+# helper: cycle length of a plan obj (length of its color rows)
+def helper_getCycleLength(resOfChat2SPaT):
+    return max((len(_) for _ in resOfChat2SPaT['dict_lightColorRec'].values()), default=0)
+
+# helper: 'phaseName|phaseOrder' -> attributes of each phase stage (dummy phases excluded); a repeated key gets a suffix '#2', '#3', ...
+def helper_getPhaseStages(resOfChat2SPaT):
+    res = {}
+    for phase in resOfChat2SPaT['planSchemeMinorMerged']:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        if phaseName == 'DUMMYPHASE':
+            continue
+        k = '%s|%s' % (phaseName, helper_getSubValueFromPhase('phaseOrder', phase))
+        n = 1
+        while (k if n == 1 else '%s#%d' % (k, n)) in res:
+            n += 1
+        res[k if n == 1 else '%s#%d' % (k, n)] = phase[phaseName]
+    return res
+
+# helper: color rows of the given phases as an int8 matrix, padded with -2 (no color) to the longest row
+def helper_getColorRows(dict_lightColorRec, phaseNames):
+    T = max(len(dict_lightColorRec[_]) for _ in phaseNames)
+    colors = np.full((len(phaseNames), T), -2, dtype=np.int8)
+    for i, phaseName in enumerate(phaseNames):
+        colors[i, :len(dict_lightColorRec[phaseName])] = dict_lightColorRec[phaseName]
+    return colors
+
+if __name__ == '__main__':
+    import argparse
+    import json
+    import time
+    from assemblyEngines import assemblePlanWithEngine
+    from batchAssembly import WARM_UP_RES_STR
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='Diff plans before and after an edit.')
+    parser.add_argument('--pairs', type=int, default=1000)
+    args = parser.parse_args()
+
+    # An edit turn: "further extend the NBT split by 4 s"
+    res = json.loads(WARM_UP_RES_STR)
+    res['result1']['stageStyle'][2] = [{'NBT': {'split': 30}}, {'SBT': {'split': 30}}]
+    resBefore, resAfter = assemblePlanWithEngine(WARM_UP_RES_STR, 'fast'), assemblePlanWithEngine(res, 'fast')
+    print(formatPlanDiff(diffPlans(resBefore, resAfter)))
+    assert diffPlans(resBefore, resBefore)['isIdentical']
+
+    # Batch of before / after plans: each synthetic plan against the plan with a different cycle length
+    resOfPlansBefore, resOfPlansAfter = [], []
+    for i in range(args.pairs):
+        resOfPlansBefore.append(assemblePlanWithEngine(generateSyntheticPlan(seed=i, cycleLength=120), 'fast'))
+        resOfPlansAfter.append(assemblePlanWithEngine(generateSyntheticPlan(seed=i, cycleLength=120 + 10 * (i % 3)), 'fast'))
+    t0 = time.perf_counter()
+    resOfDiffs = diffPlanBatch(resOfPlansBefore, resOfPlansAfter)
+    seconds = time.perf_counter() - t0
+    print('%d pairs diffed in %.1f ms (%.0f us per pair), %d identical'
+          % (len(resOfDiffs), seconds * 1000, seconds / max(len(resOfDiffs), 1) * 1e6, sum(1 for _ in resOfDiffs if _['isIdentical'])))
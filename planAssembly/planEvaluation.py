@@ -0,0 +1,148 @@
+# Capacity, v/c ratio and HCM uniform delay of the movements of assembled plans, evaluated for a batch of plans at once
+#
+# The color codes of all plans are stacked into one (plans, movements, seconds) array, padded to the longest cycle, and each
+# quantity is computed for all plans and movements in one pass:
+#   effective green g = displayed green (green, green flash, permissive x permissiveFactor) + (extensionOfGreen - startupLostTime)
+#                       per green occurrence in the cycle
+#   capacity c = s * g / C;  v/c X = v / c;  uniform delay d1 = 0.5 * C * (1 - g/C)^2 / (1 - min(1, X) * g/C)
+#
+# Run: python planEvaluation.py [--plans 1000]
+import collections
+
+import numpy as np
+
+from splitOptimizer import helper_getFlow
+
+def evaluatePlans(resOfPlans, dict_movementFlows, startupLostTime=2, extensionOfGreen=2, permissiveFactor=0.5, maxDegreeOfSaturation=1.0):
+    '''
+    Evaluate the movements of a batch of assembled plans.
+
+    Parameters:
+    resOfPlans(list): plan objs (full or slim, e.g. from PlanArchiveReader.getPlan); None entries give rows of nan.
+    dict_movementFlows(dict or list): movement -> flow (veh/h) or {'flow': veh/h, 'saturationFlow': veh/h (default 1800)},
+                                      as in splitOptimizer; one dict for all plans, or a list with one dict per plan.
+    startupLostTime, extensionOfGreen: lost time at the start and green extension into yellow of each green occurrence (s).
+    permissiveFactor: share of a permissive second (-1) counted as effective green.
+    maxDegreeOfSaturation: movements with a higher v/c are flagged in warningMsgCapacity.
+
+    Returns:
+    dict of movementNames (M, all vehicle movements of the batch) and arrays: cycleLength (P,), effectiveGreen, capacity (veh/h),
+    degreeOfSaturation, uniformDelay (s/veh), all (P, M), nan where a movement has no right of way in a plan;
+    and warningMsgCapacity: one dict per plan of movement -> v/c above maxDegreeOfSaturation (or 'not served' for a movement
+    with a flow but no right of way in the plan).
+    '''
+    P = len(resOfPlans)
+    flowsOfPlans = dict_movementFlows if type(dict_movementFlows) == list else [dict_movementFlows] * P
+
+    # Step 1: Color codes of all plans as one (plans, movements, seconds) array
+    matrices = [helper_getColorMatrixOfCycle(_['dict_lightColorRec']) if _ != None else ([], np.zeros((0, 0), dtype=np.int8)) for _ in resOfPlans]
+    movementNames = sorted(set(k for phaseNames, _ in matrices for k in phaseNames if '行人' not in k and 'PED' not in k))
+    dict_columnOfMovement = {k: m for m, k in enumerate(movementNames)}
+    cycleLengths = np.array([colors.shape[1] for _, colors in matrices])
+    T = max(int(cycleLengths.max()) if P > 0 else 0, 1)
+    colors = np.zeros((P, len(movementNames), T), dtype=np.int8)
+    inPlan = np.zeros((P, len(movementNames)), dtype=bool)
+    flows = np.zeros((P, len(movementNames)))
+    saturationFlows = np.full((P, len(movementNames)), 1800.0)
+    for p, (phaseNames, colorsOfPlan) in enumerate(matrices):
+        rows = [i for i, k in enumerate(phaseNames) if k in dict_columnOfMovement]
+        columns = [dict_columnOfMovement[phaseNames[i]] for i in rows]
+        colors[p, columns, :colorsOfPlan.shape[1]] = colorsOfPlan[rows]
+        inPlan[p, columns] = True
+        for k, flowOfMovement in flowsOfPlans[p].items():
+            if k in dict_columnOfMovement:
+                flows[p, dict_columnOfMovement[k]], saturationFlows[p, dict_columnOfMovement[k]] = helper_getFlow(flowOfMovement)
+
+    # Step 2: Effective green (the padding after the end of a cycle is red, 0)
+    green = ((colors == 2) | (colors == 3)).astype(float) + (colors == -1) * permissiveFactor
+    hasRightOfWay = green > 0
+    previousSecond = (np.arange(T)[None, :] - 1) % np.maximum(cycleLengths, 1)[:, None]  # (P, T), cyclic within each plan's cycle
+    hadRightOfWay = np.take_along_axis(hasRightOfWay, np.broadcast_to(previousSecond[:, None, :], hasRightOfWay.shape), axis=2)
+    greenOccurrences = (hasRightOfWay & ~hadRightOfWay).sum(axis=2)
+    effectiveGreen = green.sum(axis=2) + (extensionOfGreen - startupLostTime) * greenOccurrences
+    served = inPlan & (effectiveGreen > 0)
+
+    # Step 3: Capacity, v/c and uniform delay
+    C = cycleLengths[:, None].astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        greenRatio = np.where(served, np.clip(effectiveGreen, 0, C) / C, np.nan)
+        capacity = saturationFlows * greenRatio
+        degreeOfSaturation = flows / capacity
+        uniformDelay = 0.5 * C * (1 - greenRatio) ** 2 / (1 - np.minimum(1, degreeOfSaturation) * greenRatio)
+    effectiveGreen = np.where(served, effectiveGreen, np.nan)
+
+    # Step 4: Over-capacity warnings
+    warningMsgCapacity = []
+    for p in range(P):
+        msg = {}
+        if resOfPlans[p] != None:
+            for m in np.flatnonzero(degreeOfSaturation[p] > maxDegreeOfSaturation):
+                msg[movementNames[m]] = round(float(degreeOfSaturation[p, m]), 3)
+            for k in flowsOfPlans[p]:
+                if helper_getFlow(flowsOfPlans[p][k])[0] > 0 and (k not in dict_columnOfMovement or not served[p, dict_columnOfMovement[k]]):
+                    msg[k] = 'not served'
+        warningMsgCapacity.append(msg)
+    return {'movementNames': movementNames, 'cycleLength': cycleLengths, 'effectiveGreen': effectiveGreen, 'capacity': capacity,
+            'degreeOfSaturation': degreeOfSaturation, 'uniformDelay': uniformDelay, 'warningMsgCapacity': warningMsgCapacity}
+
+def addCapacityWarnings(resOfPlans, resOfEvaluation):
+    '''Write warningMsgCapacity of the evaluation into each plan obj, next to its warningMsg* fields (isValid is not changed).'''
+    for resOfChat2SPaT, msg in zip(resOfPlans, resOfEvaluation['warningMsgCapacity']):
+        if resOfChat2SPaT != None:
+            resOfChat2SPaT['warningMsgCapacity'] = msg
+    return resOfPlans
+
+def getMovementTable(resOfEvaluation, p):
+    '''Rows of plan p: movementName -> {effectiveGreen, capacity, degreeOfSaturation, uniformDelay}, for the movements in the plan.'''
+    res = {}
+    for m, movementName in enumerate(resOfEvaluation['movementNames']):
+        if np.isnan(resOfEvaluation['effectiveGreen'][p, m]):
+            continue
+        res[movementName] = {k: round(float(resOfEvaluation[k][p, m]), 3) for k in ['effectiveGreen', 'capacity', 'degreeOfSaturation', 'uniformDelay']}
+    return res
+
+# helper: phase names (sorted) and color codes of one cycle as an int8 matrix. The cycle length is the length of most of the phases;
+# longer records (e.g. of an overlap phase whose parent is not in the plan) are cut, shorter ones padded with red
+def helper_getColorMatrixOfCycle(dict_lightColorRec):
+    phaseNames = sorted(dict_lightColorRec)
+    if len(phaseNames) == 0:
+        return phaseNames, np.zeros((0, 0), dtype=np.int8)
+    cycleLength = collections.Counter(len(dict_lightColorRec[_]) for _ in phaseNames).most_common(1)[0][0]
+    colors = np.zeros((len(phaseNames), cycleLength), dtype=np.int8)
+    for i, phaseName in enumerate(phaseNames):
+        colorsOfPhase = list(dict_lightColorRec[phaseName])[:cycleLength]
+        colors[i, :len(colorsOfPhase)] = colorsOfPhase
+    return phaseNames, colors
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    import time
+    from assemblyEngines import assemblePlanWithEngine
+    from batchAssembly import WARM_UP_RES_STR
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='Evaluate capacity, v/c and uniform delay of a batch of synthetic plans.')
+    parser.add_argument('--plans', type=int, default=1000)
+    args = parser.parse_args()
+
+    dict_movementFlows = {'NBL': 180, 'SBL': 260, 'SBT': {'flow': 900, 'saturationFlow': 3600}, 'NBT': {'flow': 700, 'saturationFlow': 3600},
+                          'EBL': 150, 'WBL': 120, 'EBT': {'flow': 800, 'saturationFlow': 3600}, 'WBT': {'flow': 650, 'saturationFlow': 3600}}
+    resOfEvaluation = evaluatePlans([assemblePlanWithEngine(WARM_UP_RES_STR, 'fast')], dict_movementFlows)
+    print('example plan, cycle %d s' % resOfEvaluation['cycleLength'][0])
+    for movementName, row in getMovementTable(resOfEvaluation, 0).items():
+        print('  %-4s g %5.1f s  c %7.1f veh/h  v/c %5.3f  d1 %5.1f s/veh' % (movementName, row['effectiveGreen'], row['capacity'],
+                                                                          row['degreeOfSaturation'], row['uniformDelay']))
+    print('  warnings: %s' % resOfEvaluation['warningMsgCapacity'][0])
+
+    rnd = random.Random(0)
+    resOfPlans = [assemblePlanWithEngine(generateSyntheticPlan(seed=i, cycleLength=rnd.choice([90, 100, 120, 150]), numStages=rnd.choice([2, 3, 4]),
+                                                               numRings=rnd.choice([0, 0, 2]), numOverlapPhases=rnd.choice([0, 2]),
+                                                               numPermissivePhases=rnd.choice([0, 2])), 'fast') for i in range(args.plans)]
+    t0 = time.perf_counter()
+    resOfEvaluation = evaluatePlans(resOfPlans, dict_movementFlows)
+    seconds = time.perf_counter() - t0
+    addCapacityWarnings(resOfPlans, resOfEvaluation)
+    overCapacity = sum(1 for _ in resOfPlans if len(_['warningMsgCapacity']) > 0)
+    print('%d plans x %d movements evaluated in %.1f ms; %d plans with over-capacity or unserved movements'
+          % (len(resOfPlans), len(resOfEvaluation['movementNames']), seconds * 1000, overCapacity))
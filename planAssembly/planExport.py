@@ -0,0 +1,260 @@
+# Export of assembled plans to timing tables for controllers and simulators, streamed plan by plan
+#
+# Formats:
+#   split   - NEMA ring-barrier split table, one row per phase stage of planSchemeMinorMerged
+#   stage   - per-stage interval table (green / flash / yellow / redAmber / all-red durations of each stage), from dict_lightColorRec
+#   timing  - CSV timing table with all the phase times needed to rebuild the plan (importTimingCsv reads it back)
+#   utdf    - UTDF-like [Phases] table: one record per attribute, one column per NEMA phase
+# The exporters take an iterable of (planId, resOfChat2SPaT) pairs, e.g. zip(ids, batchAssembly.assemblePlanBatch(resStrIter)),
+# and write each plan as soon as it comes, so a whole city of plans is never held in memory.
+#
+# Run: python planExport.py [--plans 100]  (round-trip check of the timing format)
+import csv
+import itertools
+import json
+
+from Chat2SPaT import helper_getSubValueFromPhase, helper_getDefaultParentPhaseList
+
+# Standard NEMA phase numbers, north-south being the major street (not the numbering of phaseNameFormatting, PHASE2 = SBT):
+# the through phases 2, 4, 6, 8 are NBT, EBT, SBT, WBT, and each left turn 1, 3, 5, 7 opposes the through phase of its own ring,
+# so ring 1 runs SBL, NBT | WBL, EBT and ring 2 runs NBL, SBT | EBL, WBT (the rings of planGenerator.RING_SEQUENCES).
+# Right turns and U-turns are numbered 9-16, outside the rings.
+dict_nemaPhaseNumber = {'SBL': 1, 'NBT': 2, 'WBL': 3, 'EBT': 4, 'NBL': 5, 'SBT': 6, 'EBL': 7, 'WBT': 8,
+                        'SBR': 9, 'WBR': 10, 'NBR': 11, 'EBR': 12, 'SBU': 13, 'WBU': 14, 'NBU': 15, 'EBU': 16,
+                        '北左转': 1, '南直行': 2, '东左转': 3, '西直行': 4, '南左转': 5, '北直行': 6, '西左转': 7, '东直行': 8,
+                        '北右转': 9, '东右转': 10, '南右转': 11, '西右转': 12, '北掉头': 13, '东掉头': 14, '南掉头': 15, '西掉头': 16}
+
+SPLIT_TABLE_FIELDS = ['planId', 'nemaPhase', 'ring', 'barrier', 'phaseName', 'phaseOrder', 'startTime', 'endTime', 'split',
+                      'greenTime', 'greenFlash', 'yellow', 'allRed', 'redAmber', 'isPermissive']
+STAGE_TABLE_FIELDS = ['planId', 'stage', 'startTime', 'endTime', 'phases', 'redAmber', 'green', 'flash', 'yellow', 'allRed']
+TIMING_FIELDS = ['planId', 'cycleLength', 'phaseName', 'phaseOrder', 'startTime', 'endTime', 'split',
+                 'lateStart', 'earlyCutOff', 'greenFlash', 'yellow', 'allRed', 'redAmber', 'countDown', 'isPermissive']
+UTDF_RECORDS = ['BRP', 'Split', 'Start', 'End', 'MinGreen', 'Yellow', 'AllRed', 'Walk', 'DontWalk', 'Cycle']
+
+# 【Rows of each format】
+
+def iterSplitTableRows(planId, resOfChat2SPaT):
+    '''NEMA ring-barrier split table (see dict_nemaPhaseNumber): ring 1 runs phases 1-4, ring 2 phases 5-8, with the barrier
+    between 2|6 and 3|7.
+    Phases other than 1-8 (overlaps, peds) have no ring and barrier; a ped phase takes the NEMA phase of its default parent.'''
+    rows = []
+    for phase in resOfChat2SPaT['planSchemeMinorMerged']:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        if phaseName == 'DUMMYPHASE':
+            continue
+        nemaPhase = helper_getNemaPhaseNumber(phaseName)
+        isRingPhase = phaseName in dict_nemaPhaseNumber and nemaPhase <= 8
+        row = {'planId': planId, 'nemaPhase': nemaPhase if nemaPhase != None else '', 'phaseName': phaseName,
+               'ring': (1 if nemaPhase <= 4 else 2) if isRingPhase else '',
+               'barrier': (1 if nemaPhase in (1, 2, 5, 6) else 2) if isRingPhase else ''}
+        for k in SPLIT_TABLE_FIELDS[5:]:
+            row[k] = helper_getSubValueFromPhase(k, phase)
+        rows.append(row)
+    rows.sort(key=lambda _: (_['ring'] if _['ring'] != '' else 3, _['startTime'] if type(_['startTime']) == int else 0))
+    for row in rows:
+        yield row
+
+def iterStageTableRows(planId, resOfChat2SPaT):
+    '''
+    Per-stage interval table. A stage starts when a vehicle phase gets the right of way (redAmber, green or permissive),
+    and lasts until the next stage; its intervals are counted on the phases ending in the stage (all its phases if none ends):
+    redAmber of any phase of the stage, then green, flash, yellow and all-red.
+    '''
+    dict_lightColorRec = resOfChat2SPaT['dict_lightColorRec']
+    phaseNames = sorted(_ for _ in dict_lightColorRec if '行人' not in _ and 'PED' not in _)
+    if len(phaseNames) == 0:
+        return
+    cycleLength = len(dict_lightColorRec[phaseNames[0]])
+    rightOfWay = {k: [c in (2, 3, -1, 4) for c in dict_lightColorRec[k]] for k in phaseNames}
+    starts = sorted(set(t for k in phaseNames for t in range(cycleLength) if rightOfWay[k][t] and not rightOfWay[k][t - 1]))
+    if len(starts) == 0:
+        return
+    for s in range(len(starts)):
+        startTime, endTime = starts[s], starts[(s + 1) % len(starts)]
+        endTime = endTime if endTime > startTime else endTime + cycleLength  # the last stage ends at the start of the first one
+        seconds = [t % cycleLength for t in range(startTime, endTime)]
+        phasesOfStage = [k for k in phaseNames if rightOfWay[k][startTime]]
+        phasesEnding = [k for k in phasesOfStage if not rightOfWay[k][endTime % cycleLength]]
+        phasesCounted = phasesEnding if len(phasesEnding) > 0 else phasesOfStage
+        row = {'planId': planId, 'stage': s + 1, 'startTime': startTime, 'endTime': endTime, 'phases': '|'.join(phasesOfStage),
+               'redAmber': 0, 'green': 0, 'flash': 0, 'yellow': 0, 'allRed': 0}
+        for t in seconds:
+            colors = [dict_lightColorRec[k][t] for k in phasesCounted]
+            if any(dict_lightColorRec[k][t] == 4 for k in phasesOfStage):
+                row['redAmber'] += 1
+            elif 2 in colors or -1 in colors:
+                row['green'] += 1
+            elif 3 in colors:
+                row['flash'] += 1
+            elif 1 in colors:
+                row['yellow'] += 1
+            else:
+                row['allRed'] += 1
+        yield row
+
+def iterTimingRows(planId, resOfChat2SPaT):
+    '''CSV timing table: the times and attributes of each phase stage of planSchemeMinorMerged.'''
+    cycleLength = len(next(iter(resOfChat2SPaT['dict_lightColorRec'].values())))
+    for phase in resOfChat2SPaT['planSchemeMinorMerged']:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        if phaseName == 'DUMMYPHASE':
+            continue
+        row = {'planId': planId, 'cycleLength': cycleLength, 'phaseName': phaseName}
+        for k in TIMING_FIELDS[3:]:
+            row[k] = helper_getSubValueFromPhase(k, phase)
+        yield row
+
+def iterUtdfRows(planId, resOfChat2SPaT):
+    '''UTDF-like [Phases] records of a plan: [RECORDNAME, INTID, D1, ..., D16], from the first phase stage of each NEMA phase.'''
+    cycleLength = len(next(iter(resOfChat2SPaT['dict_lightColorRec'].values())))
+    dict_phaseOfNema = {}
+    dict_pedOfNema = {}
+    for phase in resOfChat2SPaT['planSchemeMinorMerged']:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        nemaPhase = helper_getNemaPhaseNumber(phaseName)
+        if nemaPhase == None:
+            continue
+        if phaseName in dict_nemaPhaseNumber:
+            dict_phaseOfNema.setdefault(nemaPhase, phase)
+        else:
+            dict_pedOfNema.setdefault(nemaPhase, phase)
+    for record in UTDF_RECORDS:
+        row = [record, planId]
+        for nemaPhase in range(1, 17):
+            phase = dict_phaseOfNema.get(nemaPhase)
+            ped = dict_pedOfNema.get(nemaPhase)
+            if record == 'Cycle':
+                value = cycleLength if nemaPhase == 1 else ''
+            elif record in ('Walk', 'DontWalk'):
+                if ped == None:
+                    value = ''
+                else:
+                    countDown = helper_getSubValueFromPhase('countDown', ped)
+                    value = countDown if record == 'DontWalk' else\
+                        helper_getSubValueFromPhase('split', ped) - helper_getSubValueFromPhase('lateStart', ped) - countDown -\
+                        helper_getSubValueFromPhase('allRed', ped) - helper_getSubValueFromPhase('earlyCutOff', ped)
+            elif phase == None:
+                value = ''
+            elif record == 'BRP':
+                value = '' if nemaPhase > 8 else '%d%d%d' % (1 if nemaPhase in (1, 2, 5, 6) else 2, 1 if nemaPhase <= 4 else 2,
+                                                             1 if nemaPhase in (1, 3, 5, 7) else 2)  # barrier, ring, position
+            else:
+                k = {'Split': 'split', 'Start': 'startTime', 'End': 'endTime', 'MinGreen': 'minGreen', 'Yellow': 'yellow', 'AllRed': 'allRed'}[record]
+                value = helper_getSubValueFromPhase(k, phase)
+            row.append(value)
+        yield row
+
+# 【Streaming writers】
+
+dict_csvFormats = {'split': (SPLIT_TABLE_FIELDS, iterSplitTableRows),
+                   'stage': (STAGE_TABLE_FIELDS, iterStageTableRows),
+                   'timing': (TIMING_FIELDS, iterTimingRows)}
+
+def writePlans(planIter, f, exportFormat='timing'):
+    '''
+    Write plans to an open text file (newline='') plan by plan.
+
+    Parameters:
+    planIter: iterable of (planId, resOfChat2SPaT); plans that could not be assembled (None) are skipped.
+    exportFormat: 'split', 'stage', 'timing' or 'utdf'.
+
+    Returns:
+    The number of plans written.
+    '''
+    writer = csv.writer(f)
+    if exportFormat == 'utdf':
+        f.write('[Phases]\r\nPhases Data\r\n')
+        writer.writerow(['RECORDNAME', 'INTID'] + ['D%d' % _ for _ in range(1, 17)])
+        iterRows = iterUtdfRows
+    elif exportFormat in dict_csvFormats:
+        fields, iterRows = dict_csvFormats[exportFormat]
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+    else:
+        raise ValueError('Unknown export format: %s' % exportFormat)
+    n = 0
+    for planId, resOfChat2SPaT in planIter:
+        if resOfChat2SPaT == None:
+            continue
+        writer.writerows(iterRows(planId, resOfChat2SPaT))
+        n += 1
+    return n
+
+def exportPlans(planIter, fileName, exportFormat='timing'):
+    '''Write plans to a file (see writePlans). Returns the number of plans written.'''
+    with open(fileName, 'w', encoding='utf-8', newline='') as f:
+        return writePlans(planIter, f, exportFormat)
+
+# 【Import】
+
+def importTimingCsv(f):
+    '''
+    Read a timing table (exportFormat='timing') from an open text file, plan by plan.
+
+    Returns:
+    A generator of (planId, resStr); resStr holds the phases with their times in result1 (one stage, explicit start times)
+    and the cycle length in result3, to be assembled by convertChatPlanResToSpatParams.
+    '''
+    for planId, rows in itertools.groupby(csv.DictReader(f), key=lambda _: _['planId']):
+        result1 = []
+        cycleLength = None
+        for row in rows:
+            cycleLength = int(row['cycleLength'])
+            phaseInfo = {k: int(row[k]) for k in TIMING_FIELDS[3:] if row[k] != ''}
+            result1.append({row['phaseName']: phaseInfo})
+        yield planId, json.dumps({'result1': [{'stageStyle': [result1]}], 'result2': [], 'result3': cycleLength}, ensure_ascii=False)
+
+# helper: NEMA phase number of a phase (peds: of the default parent phase)
+def helper_getNemaPhaseNumber(phaseName):
+    if phaseName in dict_nemaPhaseNumber:
+        return dict_nemaPhaseNumber[phaseName]
+    parentPhaseNames = helper_getDefaultParentPhaseList(phaseName)
+    if len(parentPhaseNames) > 0:
+        return dict_nemaPhaseNumber.get(parentPhaseNames[0])
+    return None
+
+if __name__ == '__main__':
+    import argparse
+    import io
+    import time
+    from Chat2SPaT import convertChatPlanResToSpatParams
+    from planGenerator import generateSyntheticPlan
+    from batchAssembly import WARM_UP_RES_STR
+
+    parser = argparse.ArgumentParser(description='Round-trip check of the timing CSV format, and export speed of each format.')
+    parser.add_argument('--plans', type=int, default=100)
+    args = parser.parse_args()
+
+    resStrList = [WARM_UP_RES_STR]
+    for i in range(args.plans - 1):
+        try:
+            resStrList.append(generateSyntheticPlan(seed=i, numStages=2 + i % 5, numPedPhases=i % 3, numOverlapPhases=i % 2,
+                                                    numPermissivePhases=i % 2, language='zh' if i % 4 == 0 else 'en'))
+        except ValueError:  # a combination of knobs the generator does not support
+            pass
+    resOfPlans = [convertChatPlanResToSpatParams(resStr, plot=False, verbose=False) for resStr in resStrList]
+
+    # Ring and barrier of a dual-ring plan: ring 1 SBL, NBT | WBL, EBT and ring 2 NBL, SBT | EBL, WBT
+    resOfDualRing = convertChatPlanResToSpatParams(generateSyntheticPlan(numStages=4, numRings=2), plot=False, verbose=False)
+    dict_ringBarrierOfPhases = {row['phaseName']: (row['ring'], row['barrier']) for row in iterSplitTableRows(0, resOfDualRing)}
+    assert dict_ringBarrierOfPhases == {'SBL': (1, 1), 'NBT': (1, 1), 'WBL': (1, 2), 'EBT': (1, 2),
+                                        'NBL': (2, 1), 'SBT': (2, 1), 'EBL': (2, 2), 'WBT': (2, 2)}, dict_ringBarrierOfPhases
+    dict_brpOfNema = dict(zip(range(1, 9), next(_ for _ in iterUtdfRows(0, resOfDualRing) if _[0] == 'BRP')[2:10]))
+    assert dict_brpOfNema == {1: '111', 2: '112', 3: '211', 4: '212', 5: '121', 6: '122', 7: '221', 8: '222'}, dict_brpOfNema
+
+    # Round trip: export the timing table, import it, assemble again and compare the color codes
+    f = io.StringIO(newline='')
+    writePlans(zip(range(len(resOfPlans)), resOfPlans), f, 'timing')
+    f.seek(0)
+    mismatches = 0
+    for planId, resStr in importTimingCsv(f):
+        resOfImported = convertChatPlanResToSpatParams(resStr, plot=False, verbose=False)
+        mismatches += resOfImported['dict_lightColorRec'] != resOfPlans[int(planId)]['dict_lightColorRec']
+    print('timing round trip: %d of %d plans differ' % (mismatches, len(resOfPlans)))
+    assert mismatches == 0
+
+    for exportFormat in ['split', 'stage', 'timing', 'utdf']:
+        f = io.StringIO(newline='')
+        t0 = time.perf_counter()
+        writePlans(((i, res) for i, res in enumerate(resOfPlans)), f, exportFormat)
+        print('%-6s %6.2f ms per plan, %7d bytes' % (exportFormat, (time.perf_counter() - t0) * 1000 / len(resOfPlans), len(f.getvalue())))
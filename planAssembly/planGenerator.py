@@ -0,0 +1,203 @@
+# Synthetic LLM outputs (result1 / result2 / result3) for scaling and stress tests of plan assembly
+import json
+import random
+
+from Chat2SPaT import helper_getDefaultParentPhaseList
+
+# Concurrent movement pairs of a four-leg intersection (one pair per stage), and the dual-ring sequences with the same pairing
+STAGE_PAIRS = [['NBT', 'SBT'], ['NBL', 'SBL'], ['EBT', 'WBT'], ['EBL', 'WBL'],
+               ['NBT', 'NBL'], ['SBT', 'SBL'], ['EBT', 'EBL'], ['WBT', 'WBL']]
+RING_SEQUENCES = [['SBL', 'NBT', 'WBL', 'EBT'], ['NBL', 'SBT', 'EBL', 'WBT'],
+                  ['SBR', 'NBR', 'WBR', 'EBR'], ['SBU', 'NBU', 'WBU', 'EBU']]  # rings 3 and 4 run the non-conflicting minor movements
+# Permissive left turns run with the through movements of the same approaches
+PERMISSIVE_LEFT_TURNS = {'NBT': 'SBL', 'SBT': 'NBL', 'EBT': 'WBL', 'WBT': 'EBL'}
+OVERLAP_CANDIDATES = [['NBR', 'WBL'], ['EBR', 'NBL'], ['SBR', 'EBL'], ['WBR', 'SBL'],
+                      ['NBU', 'NBL'], ['EBU', 'EBL'], ['SBU', 'SBL'], ['WBU', 'WBL']]  # [overlapped phase, parent phase]
+PED_PHASES = ['NORTHPED', 'EASTPED', 'SOUTHPED', 'WESTPED']
+# Shortest split of the parent (through) phase of a ped phase: WALK of at least 7 s (the check of the assembler) and 9 s of countdown
+MIN_PED_PARENT_SPLIT = 16
+# English phase name -> Chinese phase name (the Chinese name is by approach, e.g. southbound through = 北直行)
+dict_phaseNameZh = {'SBT': '北直行', 'SBL': '北左转', 'SBR': '北右转', 'SBU': '北掉头',
+                    'WBT': '东直行', 'WBL': '东左转', 'WBR': '东右转', 'WBU': '东掉头',
+                    'NBT': '南直行', 'NBL': '南左转', 'NBR': '南右转', 'NBU': '南掉头',
+                    'EBT': '西直行', 'EBL': '西左转', 'EBR': '西右转', 'EBU': '西掉头',
+                    'NORTHPED': '北行人', 'EASTPED': '东行人', 'SOUTHPED': '南行人', 'WESTPED': '西行人',
+                    'NORTHPEDA': '北行人二次过街A', 'NORTHPEDB': '北行人二次过街B', 'EASTPEDA': '东行人二次过街A', 'EASTPEDB': '东行人二次过街B',
+                    'SOUTHPEDA': '南行人二次过街A', 'SOUTHPEDB': '南行人二次过街B', 'WESTPEDA': '西行人二次过街A', 'WESTPEDB': '西行人二次过街B'}
+
+def generateSyntheticPlan(seed=0, cycleLength=120, numStages=4, numRings=0, numNestedStagesInRing=0, numOverlapPhases=0,
+                          numPedPhases=0, numTwoStagePedPhases=0, numPermissivePhases=0, formatErrorRate=0.0, language='en'):
+    '''
+    Generate the LLM outputs of a synthetic plan, in the json format specified by the prompt.
+
+    Parameters:
+    seed: random seed; the same arguments and seed always give the same plan.
+    cycleLength: cycle length (result3), split evenly (+-20% jitter) over the stages.
+    numStages: number of stages (stage style), or number of phases per ring (ring style). Movement pairs repeat after 8 stages,
+               so phases occur with several phaseOrders.
+    numRings: 0 for a stage style plan; 1-4 for a ring style plan with barriers aligned across the rings.
+    numNestedStagesInRing: in ring style, number of positions of the rings written as nested stageStyle objects.
+    numOverlapPhases: number of right-turn / U-turn phases overlapping a primary phase (0-8).
+    numPedPhases: number of one-stage ped phases with the default parent phase (0-4).
+    numTwoStagePedPhases: number of directions with two-stage ped crossings (A and B) with default parent phases (0-4);
+                          they take the directions not used by numPedPhases.
+                          A ped phase only takes a direction whose default parent phases are all protected phases of the plan
+                          (never permissive), with a through split of at least MIN_PED_PARENT_SPLIT; ValueError if the plan
+                          has fewer such directions than the ped phases requested.
+    numPermissivePhases: number of permissive left turns added to the through stages of the same approaches (0-4, stage style).
+    formatErrorRate: probability of injecting each of the Type 0-3 format errors handled by convertChatPlanResToSpatParams
+                     (Type 3, combined opposite phase names, needs language='zh').
+    language: 'en' for phase names such as 'NBT', 'zh' for phase names such as '南直行'.
+
+    Returns:
+    resStr(str): the LLM outputs; the plan assembles with isValid 1 (without format errors, and for any seed) for the supported
+                 combinations of the knobs, which are the ones not rejected with ValueError.
+    '''
+    rnd = random.Random(seed)
+    if numStages < 2:
+        raise ValueError('numStages should be at least 2.')
+    splits = helper_jitterSplits(rnd, cycleLength, numStages)
+    if min(splits) < 8:
+        raise ValueError('Cycle length %d is too short for %d stages.' % (cycleLength, numStages))
+
+    result1 = []
+    result2 = []
+    dict_phaseOrder = {}  # phaseName -> occurrences so far, for phaseOrder in result2
+    dict_splitsOfProtectedPhase = {}  # phaseName -> {stage index: split} as a protected phase
+    permissivePhaseNames = set([])
+
+    def addPhaseInfo(phaseName, info):
+        phaseOrder = dict_phaseOrder.get(phaseName, 0) + 1
+        dict_phaseOrder[phaseName] = phaseOrder
+        phaseInfo = {'phaseOrder': phaseOrder}
+        phaseInfo.update(info)
+        result2.append({phaseName: phaseInfo})
+
+    primaryPhaseNames = set([])
+    if numRings == 0:
+        # Stage style
+        permissiveLeftTurns = [PERMISSIVE_LEFT_TURNS[_] for _ in ['NBT', 'SBT', 'EBT', 'WBT'][:numPermissivePhases]]
+        stageList = []
+        for i in range(numStages):
+            stage = []
+            for phaseName in STAGE_PAIRS[i % len(STAGE_PAIRS)]:
+                stage.append({phaseName: {'split': splits[i]}})
+                addPhaseInfo(phaseName, {'greenFlash': rnd.choice([0, 3])})
+                primaryPhaseNames.add(phaseName)
+                dict_splitsOfProtectedPhase.setdefault(phaseName, {}).update({i: splits[i]})
+            for phaseName in STAGE_PAIRS[i % len(STAGE_PAIRS)]:
+                if phaseName in PERMISSIVE_LEFT_TURNS and PERMISSIVE_LEFT_TURNS[phaseName] in permissiveLeftTurns:
+                    stage.append({PERMISSIVE_LEFT_TURNS[phaseName]: {'split': splits[i]}})
+                    addPhaseInfo(PERMISSIVE_LEFT_TURNS[phaseName], {'isPermissive': 1})
+                    permissivePhaseNames.add(PERMISSIVE_LEFT_TURNS[phaseName])
+            stageList.append(stage)
+        result1.append({'stageStyle': stageList})
+    else:
+        # Ring style, with barriers aligned: the i-th phases of all rings have the same split
+        ringList = []
+        nestedPositions = set(rnd.sample(range(numStages), min(numNestedStagesInRing, numStages)))
+        for r in range(min(numRings, len(RING_SEQUENCES))):
+            ring = []
+            for i in range(numStages):
+                phaseName = RING_SEQUENCES[r][i % len(RING_SEQUENCES[r])]
+                phase = {phaseName: {'split': splits[i]}}
+                ring.append({'stageStyle': [[phase]]} if i in nestedPositions else phase)
+                addPhaseInfo(phaseName, {'greenFlash': rnd.choice([0, 3])})
+                primaryPhaseNames.add(phaseName)
+                dict_splitsOfProtectedPhase.setdefault(phaseName, {}).update({i: splits[i]})
+            ringList.append(ring)
+        result1.append({'ringStyle': ringList})
+
+    # Overlapped phases, following primary phases in the plan
+    overlapCandidates = [_ for _ in OVERLAP_CANDIDATES if _[0] not in primaryPhaseNames and
+                         helper_isParentPhaseSupported(_[1], dict_splitsOfProtectedPhase, permissivePhaseNames, numStages)]
+    for phaseName, parentPhaseName in overlapCandidates[:numOverlapPhases]:
+        addPhaseInfo(phaseName, {'parentPhase': parentPhaseName, 'overlapNum': 0})
+    # Ped phases, following the default parent phases, on the directions where these run long enough as protected phases
+    def isPedPhaseSupported(pedPhaseNames):
+        return all(helper_isParentPhaseSupported(_, dict_splitsOfProtectedPhase, permissivePhaseNames, numStages, MIN_PED_PARENT_SPLIT)
+                   for _ in sum([helper_getDefaultParentPhaseList(_) for _ in pedPhaseNames], []))
+    pedPhaseNames = [_ for _ in PED_PHASES if isPedPhaseSupported([_])]
+    if numPedPhases > len(pedPhaseNames):
+        raise ValueError('The plan supports one-stage ped phases on %d directions, %d requested.' % (len(pedPhaseNames), numPedPhases))
+    twoStagePedPhaseNames = [_ for _ in PED_PHASES if _ not in pedPhaseNames[:numPedPhases] and
+                             isPedPhaseSupported([_ + 'A', _ + 'B'])]
+    if numTwoStagePedPhases > len(twoStagePedPhaseNames):
+        raise ValueError('The plan supports two-stage ped phases on %d other directions, %d requested.'
+                         % (len(twoStagePedPhaseNames), numTwoStagePedPhases))
+    for phaseName in pedPhaseNames[:numPedPhases]:
+        addPhaseInfo(phaseName, {'parentPhase': 'default'})
+    for phaseName in twoStagePedPhaseNames[:numTwoStagePedPhases]:
+        addPhaseInfo(phaseName + 'A', {'parentPhase': 'default'})
+        addPhaseInfo(phaseName + 'B', {'parentPhase': 'default'})
+
+    res = {'result1': result1, 'result2': result2, 'result3': cycleLength}
+    if language == 'zh':
+        res = helper_translatePhaseNames(res)
+    res = helper_injectFormatErrors(rnd, res, formatErrorRate, language)
+    return json.dumps(res, ensure_ascii=False)
+
+def generateSyntheticPlans(n, seed=0, **kwargs):
+    '''Generate n synthetic plans with seeds seed, seed+1, ..., and the same knobs (see generateSyntheticPlan).'''
+    return [generateSyntheticPlan(seed=seed + i, **kwargs) for i in range(n)]
+
+# helper: split the cycle length over the stages, with jitter
+def helper_jitterSplits(rnd, cycleLength, numStages):
+    '''Splits are integers summing up to cycleLength, each within +-20% of the even split.'''
+    weights = [1 + rnd.uniform(-0.2, 0.2) for _ in range(numStages)]
+    splits = [int(cycleLength * w / sum(weights)) for w in weights]
+    splits[0] += cycleLength - sum(splits)
+    return splits
+
+# helper: whether an overlapped or ped phase can follow the parent phase in the plan
+def helper_isParentPhaseSupported(parentPhaseName, dict_splitsOfProtectedPhase, permissivePhaseNames, numStages, minSplit=0):
+    '''The parent phase runs as a protected phase only, each stage of it with at least minSplit (for a ped phase, each one gives
+    a WALK), and not over the end of the cycle (in both the first and the last stage), which the assembler does not follow.'''
+    dict_splitOfStages = dict_splitsOfProtectedPhase.get(parentPhaseName, {})
+    return len(dict_splitOfStages) > 0 and parentPhaseName not in permissivePhaseNames and\
+           min(dict_splitOfStages.values()) >= minSplit and not (0 in dict_splitOfStages and numStages - 1 in dict_splitOfStages)
+
+# helper: rename the phases in the LLM outputs to Chinese phase names
+def helper_translatePhaseNames(obj):
+    if type(obj) == dict:
+        return {dict_phaseNameZh.get(k, k): helper_translatePhaseNames(v) for k, v in obj.items()}
+    if type(obj) == list:
+        return [helper_translatePhaseNames(_) for _ in obj]
+    if type(obj) == str:
+        return dict_phaseNameZh.get(obj, obj)
+    return obj
+
+# helper: inject Type 0-3 format errors
+def helper_injectFormatErrors(rnd, res, formatErrorRate, language):
+    '''Each error type is injected with probability formatErrorRate, if applicable to the plan.'''
+    result1, result2 = res['result1'], res['result2']
+    isStageStyle = 'stageStyle' in result1[0]
+    # Type 3: the same movements of two opposing directions recorded as one phase, e.g. '南北直行'
+    if language == 'zh' and isStageStyle and rnd.random() < formatErrorRate:
+        stageList = result1[0]['stageStyle']
+        namesInEarlierStages = set([])
+        for stage in stageList:
+            names = [list(_.keys())[0] for _ in stage]
+            # the first stage of both phases, so that the attributes merged below (phaseOrder 1) are the ones of this stage
+            if len(stage) == 2 and names[0][1:] == names[1][1:] and {names[0][0], names[1][0]} in ({'南', '北'}, {'东', '西'}) and\
+               len(namesInEarlierStages.intersection(names)) == 0:
+                combinedName = names[0][0] + names[1]
+                stage[:] = [{combinedName: stage[0][names[0]]}]
+                # result2: merge the attributes of the two phases into one combined phase obj
+                for i in range(len(result2)):
+                    if list(result2[i].keys())[0] == names[0] and list(result2[i].values())[0]['phaseOrder'] == 1:
+                        result2[i] = {combinedName: result2[i][names[0]]}
+                        break
+                break
+            namesInEarlierStages.update(names)
+    # Type 2: no nested list in the stage structure (each stage as its own stageStyle object)
+    if isStageStyle and rnd.random() < formatErrorRate:
+        result1 = [{'stageStyle': stage} for stage in result1[0]['stageStyle']]
+    # Type 1: no stage label (the stages are listed directly in result1)
+    elif isStageStyle and rnd.random() < formatErrorRate:
+        result1 = [stage for stage in result1[0]['stageStyle']]
+    # Type 0: result1 recorded as a dict instead of a list
+    elif len(result1) == 1 and rnd.random() < formatErrorRate:
+        result1 = result1[0]
+    res.update({'result1': result1})
+    return res
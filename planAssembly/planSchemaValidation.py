@@ -0,0 +1,242 @@
+# Schema check of LLM outputs (result1 / result2 / result3), run right after parsing and before plan assembly
+#
+# The schema accepts the format errors the assembler deals with (Type 0: result1 / result2 as a dict; Type 1: no stage or ring label;
+# Type 2: no nested list in a stage or ring structure; Type 3 is about phase names, which are not checked here), and rejects the
+# inputs on which the assembly fails or silently drops phases: missing keys, wrong container types, phase objects that are not
+# {phaseName: {attributes}}, non-integer times, etc.
+# The schema is compiled once into nested predicate functions; validateLlmOutputs returns a list of {'path', 'reason'} errors,
+# empty if the LLM outputs are valid, to be logged or fed back to the LLM.
+import json
+
+# Phase attributes (matched as by helper_getSubValueFromPhase: case and spaces ignored) -> rule
+dict_attributeRules = {'split': 'duration', 'greenTime': 'duration',
+                       'startTime': 'timepoint', 'endTime': 'endTimepoint', 'startOfGreen': 'timepoint', 'endOfGreen': 'endTimepoint',
+                       'lateStart': 'clearance', 'earlyCutOff': 'clearance', 'yellow': 'clearance', 'allRed': 'clearance',
+                       'redAmber': 'clearance', 'greenFlash': 'clearance', 'countDown': 'clearance', 'minGreen': 'clearance',
+                       'maxGreen': 'clearance', 'isPermissive': 'flag', 'isProhibited': 'flag', 'phaseOrder': 'order',
+                       'overlapNum': 'order', 'parentPhase': 'parentPhase'}
+
+# Schema nodes: {'type': 'null' | 'int' | 'list' | 'dict' | 'stageList' | 'ringElement' | 'phase' | 'phaseAttributes', ...},
+# or {'switch': {python type name: node}} choosing the node by the type of the value
+PHASE = {'type': 'phase'}
+STAGE_LIST = {'type': 'stageList', 'items': PHASE, 'minItems': 0}  # list of stages (lists of phases), or one stage (Type 2)
+RING_LIST = {'type': 'stageList', 'items': {'type': 'ringElement', 'stageStyle': dict(STAGE_LIST, minItems=1), 'phase': PHASE},
+             'minItems': 1}
+RESULT1_ITEM = {'switch': {'dict': {'type': 'dict', 'keys': {'stageStyle': STAGE_LIST, 'ringStyle': RING_LIST},
+                                    'values': {'type': 'phaseAttributes'}},  # Type 1: phases without stage label
+                           'list': {'type': 'list', 'items': PHASE}}}   # Type 1: one stage without stage label
+SCHEMA_LLM_OUTPUTS = {'type': 'dict', 'required': ['result1', 'result2', 'result3'],
+                      'keys': {'result1': {'switch': {'NoneType': {'type': 'null'}, 'list': {'type': 'list', 'items': RESULT1_ITEM},
+                                                      'dict': RESULT1_ITEM['switch']['dict']}},  # Type 0
+                               'result2': {'switch': {'list': {'type': 'list', 'items': PHASE},
+                                                      'dict': {'type': 'dict', 'values': {'type': 'phaseAttributes'}}}},  # Type 0
+                               'result3': {'switch': {'NoneType': {'type': 'null'}, 'int': {'type': 'int', 'min': 1}}}}}
+
+class SchemaErrorLimit(Exception):
+    '''Raised inside the predicates when maxErrors errors are found, to stop the check.'''
+
+def compileSchema(node):
+    '''Compile a schema node into a predicate check(value, path, errors); path is a tuple of keys and indices.'''
+    if 'switch' in node:
+        dict_checks = {k: compileSchema(v) for k, v in node['switch'].items()}
+        expected = ' or '.join(helper_describeType(_) for _ in node['switch'])
+        def check(value, path, errors):
+            checkOfType = dict_checks.get(type(value).__name__)
+            if checkOfType == None:
+                helper_addError(errors, path, 'expected %s, got %s' % (expected, helper_describeType(type(value).__name__)))
+            else:
+                checkOfType(value, path, errors)
+        return check
+
+    nodeType = node['type']
+    if nodeType == 'null':
+        return lambda value, path, errors: None
+    if nodeType == 'int':
+        minValue = node.get('min', 0)
+        def check(value, path, errors):
+            if type(value) != int:
+                helper_addError(errors, path, 'expected an integer, got %s' % helper_describeType(type(value).__name__))
+            elif value < minValue:
+                helper_addError(errors, path, 'expected an integer >= %d, got %d' % (minValue, value))
+        return check
+    if nodeType == 'list':
+        checkItem = compileSchema(node['items'])
+        def check(value, path, errors):
+            if type(value) != list:
+                helper_addError(errors, path, 'expected a list, got %s' % helper_describeType(type(value).__name__))
+                return
+            for i, item in enumerate(value):
+                checkItem(item, path + (i,), errors)
+        return check
+    if nodeType == 'stageList':
+        checkItem = compileSchema(node['items'])
+        minItems = node['minItems']
+        def check(value, path, errors):
+            if type(value) != list:
+                helper_addError(errors, path, 'expected a list, got %s' % helper_describeType(type(value).__name__))
+                return
+            if len(value) < minItems:
+                helper_addError(errors, path, 'expected at least %d item(s), got an empty list' % minItems)
+                return
+            if len(value) > 0 and type(value[0]) == list:  # list of stages (or rings)
+                for i, stage in enumerate(value):
+                    if type(stage) != list:
+                        helper_addError(errors, path + (i,), 'expected a list like the other items, got %s' % helper_describeType(type(stage).__name__))
+                        continue
+                    for j, item in enumerate(stage):
+                        checkItem(item, path + (i, j), errors)
+            else:  # one stage (or ring) without nested list (Type 2)
+                for i, item in enumerate(value):
+                    checkItem(item, path + (i,), errors)
+        return check
+    if nodeType == 'ringElement':
+        checkStageStyle, checkPhase = compileSchema(node['stageStyle']), compileSchema(node['phase'])
+        def check(value, path, errors):
+            if type(value) == dict and 'stageStyle' in value:
+                checkStageStyle(value['stageStyle'], path + ('stageStyle',), errors)
+            else:
+                checkPhase(value, path, errors)
+        return check
+    if nodeType == 'dict':
+        required = node.get('required', [])
+        dict_checks = {k: compileSchema(v) for k, v in node.get('keys', {}).items()}
+        checkOtherValue = compileSchema(node['values']) if 'values' in node else None
+        def check(value, path, errors):
+            if type(value) != dict:
+                helper_addError(errors, path, 'expected an object, got %s' % helper_describeType(type(value).__name__))
+                return
+            for k in required:
+                if k not in value:
+                    helper_addError(errors, path + (k,), 'missing key')
+            for k, v in value.items():
+                checkOfKey = dict_checks.get(k, checkOtherValue)
+                if checkOfKey != None:
+                    checkOfKey(v, path + (k,), errors)
+        return check
+    if nodeType == 'phase':
+        checkAttributes = compileSchema({'type': 'phaseAttributes'})
+        def check(value, path, errors):
+            if type(value) != dict:
+                helper_addError(errors, path, 'expected a phase object {phaseName: {attributes}}, got %s' % helper_describeType(type(value).__name__))
+                return
+            if len(value) != 1:
+                helper_addError(errors, path, 'expected one phase name per phase object, got %d' % len(value))
+                return
+            phaseName = next(iter(value))
+            if phaseName.strip() == '':
+                helper_addError(errors, path, 'empty phase name')
+            checkAttributes(value[phaseName], path + (phaseName,), errors)
+        return check
+    if nodeType == 'phaseAttributes':
+        dict_ruleOfKey = {k.upper(): rule for k, rule in dict_attributeRules.items()}
+        def check(value, path, errors):
+            if type(value) != dict:
+                helper_addError(errors, path, 'expected an object of phase attributes, got %s' % helper_describeType(type(value).__name__))
+                return
+            for k, v in value.items():
+                rule = dict_ruleOfKey.get(k.replace(' ', '').upper())
+                if rule == None or v == None and rule in ('duration', 'timepoint', 'endTimepoint', 'order', 'parentPhase'):
+                    continue  # unknown attributes are ignored by the assembler; None is the default value
+                reason = helper_checkAttribute(rule, v)
+                if reason != None:
+                    helper_addError(errors, path + (k,), reason)
+        return check
+    raise ValueError('Unknown schema node type: %s' % nodeType)
+
+def validateLlmOutputs(resStr, maxErrors=None):
+    '''
+    Check LLM outputs against the schema.
+
+    Parameters:
+    resStr(json object as str, or the parsed dict): LLM outputs.
+    maxErrors: stop at this number of errors (1 to fail fast); None to report all errors.
+
+    Returns:
+    errors(list): [{'path': e.g. 'result1[0].stageStyle[2][1].NBT.split', 'reason': e.g. 'expected an integer, got str'}],
+    empty if the LLM outputs are valid.
+    '''
+    errors = []
+    if type(resStr) == str:
+        try:
+            resStr = json.loads(resStr)
+        except ValueError as e:
+            return [{'path': '', 'reason': 'invalid json: %s' % e}]
+    if maxErrors != None:
+        errors = ErrorList(maxErrors)
+    try:
+        checkLlmOutputs(resStr, (), errors)
+    except SchemaErrorLimit:
+        pass
+    return list(errors)
+
+class ErrorList(list):
+    '''Error list raising SchemaErrorLimit when maxErrors errors are found.'''
+    def __init__(self, maxErrors):
+        super().__init__()
+        self.maxErrors = maxErrors
+
+# helper: reason why a phase attribute is invalid, or None
+def helper_checkAttribute(rule, value):
+    if rule == 'flag':
+        return None if value in (0, 1) and type(value) in (int, bool) else 'expected 0 or 1, got %s' % json.dumps(value, ensure_ascii=False)
+    if rule == 'parentPhase':
+        return None if type(value) == str and value.strip() != '' else 'expected a phase name or "default", got %s' % json.dumps(value, ensure_ascii=False)
+    if rule == 'endTimepoint' and value == 'cycleLength':  # the end of the cycle, replaced by the assembler (endTime and endOfGreen only)
+        return None
+    if type(value) != int:
+        return 'expected an integer%s, got %s' % (' or "cycleLength"' if rule == 'endTimepoint' else '', json.dumps(value, ensure_ascii=False))
+    if value < 0:
+        return 'expected an integer >= 0, got %d' % value
+    return None
+
+# helper: add an error with its path formatted as result1[0].stageStyle[2][1].NBT.split
+def helper_addError(errors, path, reason):
+    pathStr = ''
+    for k in path:
+        pathStr += '[%d]' % k if type(k) == int else ('.' if pathStr != '' else '') + str(k)
+    errors.append({'path': pathStr, 'reason': reason})
+    if type(errors) == ErrorList and len(errors) >= errors.maxErrors:
+        raise SchemaErrorLimit()
+
+# helper: readable json type of a python type name
+def helper_describeType(typeName):
+    return {'NoneType': 'null', 'int': 'integer', 'float': 'number', 'str': 'string', 'bool': 'boolean',
+            'list': 'list', 'dict': 'object'}.get(typeName, typeName)
+
+# The schema compiled once, at import
+checkLlmOutputs = compileSchema(SCHEMA_LLM_OUTPUTS)
+
+if __name__ == '__main__':
+    import time
+    from batchAssembly import WARM_UP_RES_STR
+    from planGenerator import generateSyntheticPlans
+
+    examples = {'valid': WARM_UP_RES_STR,
+                'missing result3': json.dumps({'result1': [], 'result2': []}),
+                'stage not a list': json.dumps({'result1': {'stageStyle': [[{'NBT': {'split': 30}}], {'EBT': {'split': 30}}]}, 'result2': [], 'result3': None}),
+                'split as a string': json.dumps({'result1': {'stageStyle': [[{'NBT': {'split': '30s'}}, {'SBT': {'split': 30}}]]},
+                                                 'result2': [{'NBT': {'phaseOrder': 1, 'yellow': None}}], 'result3': 90})}
+    for name, resStr in examples.items():
+        print('%-18s %s' % (name, validateLlmOutputs(resStr)))
+
+    # "cycleLength" is the end of the cycle: accepted for the end times only, the assembler fails on it as a start time
+    from Chat2SPaT import convertChatPlanResToSpatParams
+    for attr, isValid in [('startTime', False), ('startOfGreen', False), ('endTime', True), ('endOfGreen', True)]:
+        res = json.loads(WARM_UP_RES_STR)
+        res['result2'].append({'NBR': {'startTime': 100, 'endTime': 104, attr: 'cycleLength'}})
+        schemaErrors = validateLlmOutputs(res)
+        assert [_['path'] for _ in schemaErrors] == ([] if isValid else ['result2[%d].NBR.%s' % (len(res['result2']) - 1, attr)]), schemaErrors
+        if isValid:
+            convertChatPlanResToSpatParams(res, plot=False, verbose=False)
+
+    resList = [json.loads(_) for _ in generateSyntheticPlans(1000, formatErrorRate=0.3, numPedPhases=2, numOverlapPhases=2)]
+    assert all(len(validateLlmOutputs(_)) == 0 for _ in resList)  # the format errors of the generator are dealt with by the assembler
+    t0 = time.perf_counter()
+    for res in resList:
+        validateLlmOutputs(res)
+    print('valid plans: %.1f us per plan' % ((time.perf_counter() - t0) / len(resList) * 1e6))
+    invalid = json.loads(examples['split as a string'])
+    t0 = time.perf_counter()
+    for _ in range(10000):
+        validateLlmOutputs(invalid, maxErrors=1)
+    print('invalid plan, fail fast: %.1f us per plan' % ((time.perf_counter() - t0) / 10000 * 1e6))
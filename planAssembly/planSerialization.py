@@ -0,0 +1,367 @@
+# Compact, versioned serialization of assembled plans (resOfChat2SPaT), a faster and smaller alternative to json.dumps of the plan obj
+#
+# Binary format (FORMAT_VERSION 1, little-endian), one plan:
+#   header      - HEADER: magic b'C2SP', version, flags, rows, cycleLength, phase stages, and the byte lengths of the sections below
+#   rowIds      - uint16 movement id of each color row (MOVEMENT_NAMES; ids from EXTRA_NAME_ID on index the extra names)
+#   names       - utf-8 extra names (phase names not in MOVEMENT_NAMES), joined by '\n'
+#   colors      - int8 color codes (rows x cycleLength), or run-length encoded (FLAG_RLE): runs per row (uint16), run values (int8),
+#                 run lengths (uint16)
+#   stages      - int32 table of the phase stages of planSchemeMinorMerged: movement id, then STAGE_ATTRIBUTES (MISSING if absent)
+#   countdown   - dict_countdownTables (FLAG_COUNTDOWN): timeToChange (int16) and nextColor (int8), rows x cycleLength each
+#   meta        - utf-8 json of the other fields (warnings, isValid, resStr), and of the stage attributes not in the table
+# A batch is b'C2SB', version, count, the uint32 offsets of the plans and the plans; a result that is not a plan obj (e.g. the
+# {'error': ...} of the assembly service) is kept as a meta-only payload (FLAG_JSON_ONLY), None as an empty one.
+#
+# loadPlan reads without copying: the color rows (and countdown rows) are int8 / int16 numpy views into the buffer (asLists=True
+# gives lists, equal to the original plan obj). serializePlanJson / loadPlanJson are the json-compatible fallback of the same schema.
+#
+# Run: python planSerialization.py [--plans 300] [--repeat 5]
+import json
+import struct
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MAGIC, BATCH_MAGIC = b'C2SP', b'C2SB'
+HEADER = struct.Struct('<4sBBHHHIIIII')  # magic, version, flags, rows, cycleLength, stages, lengths of names, colors, stages, countdown, meta
+BATCH_HEADER = struct.Struct('<4sBxxxI')  # magic, version, count
+FLAG_RLE, FLAG_COUNTDOWN, FLAG_JSON_ONLY = 1, 2, 4
+CONTENT_TYPE_PLAN, CONTENT_TYPE_BATCH = 'application/x-chat2spat-plan', 'application/x-chat2spat-batch'
+
+# Frozen for FORMAT_VERSION 1 (the standard names of phaseNameFormatting, and DUMMYPHASE); append only, with a new version
+MOVEMENT_NAMES = ['北左转', '北直行', '东左转', '东直行', '南左转', '南直行', '西左转', '西直行',
+                  '北右转', '北掉头', '东右转', '东掉头', '南右转', '南掉头', '西右转', '西掉头',
+                  '北行人', '北行人二次过街A', '北行人二次过街B', '东行人', '东行人二次过街A', '东行人二次过街B',
+                  '南行人', '南行人二次过街A', '南行人二次过街B', '西行人', '西行人二次过街A', '西行人二次过街B',
+                  'SBL', 'SBT', 'WBL', 'WBT', 'NBL', 'NBT', 'EBL', 'EBT',
+                  'SBR', 'SBU', 'WBR', 'WBU', 'NBR', 'NBU', 'EBR', 'EBU',
+                  'NORTHPED', 'NORTHPEDA', 'NORTHPEDB', 'EASTPED', 'EASTPEDA', 'EASTPEDB',
+                  'SOUTHPED', 'SOUTHPEDA', 'SOUTHPEDB', 'WESTPED', 'WESTPEDA', 'WESTPEDB', 'DUMMYPHASE']
+dict_idOfMovement = {k: i for i, k in enumerate(MOVEMENT_NAMES)}
+EXTRA_NAME_ID = 1024
+STAGE_ATTRIBUTES = ['phaseOrder', 'startTime', 'endTime', 'split', 'startOfGreen', 'endOfGreen', 'greenTime', 'lateStart', 'earlyCutOff',
+                    'yellow', 'allRed', 'redAmber', 'greenFlash', 'isPermissive']
+MISSING = -2**31
+
+def serializePlan(resOfChat2SPaT, colorEncoding='bytes', includeResStr=True):
+    '''
+    Serialize a plan obj (full or slim) to bytes.
+
+    Parameters:
+    colorEncoding: 'bytes' (one int8 per second, loaded without copying) or 'rle' (run-length encoded, smaller).
+    includeResStr: whether to keep the raw LLM outputs (resStr), usually the largest field.
+
+    Returns:
+    bytes, read back with loadPlan.
+    '''
+    if resOfChat2SPaT == None:
+        return b''
+    if 'dict_lightColorRec' not in resOfChat2SPaT:  # not a plan obj, e.g. {'error': ...}
+        meta = json.dumps(resOfChat2SPaT, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return HEADER.pack(MAGIC, FORMAT_VERSION, FLAG_JSON_ONLY, 0, 0, 0, 0, 0, 0, 0, len(meta)) + meta
+    flags = 0
+
+    # Step 1: Movement ids of the color rows, and the color matrix
+    extraNames = []
+    phaseNames = list(resOfChat2SPaT['dict_lightColorRec'])
+    rowIds = np.array([helper_getMovementId(_, extraNames) for _ in phaseNames], dtype=np.uint16)
+    colors = helper_getRows(resOfChat2SPaT['dict_lightColorRec'], phaseNames, np.int8)
+    if colorEncoding == 'rle':
+        flags |= FLAG_RLE
+        colorsBytes = helper_encodeRuns(colors)
+    elif colorEncoding == 'bytes':
+        colorsBytes = colors.tobytes()
+    else:
+        raise ValueError('Unknown color encoding: %s' % colorEncoding)
+
+    # Step 2: Phase stage table; attributes outside the table (or not int) go to meta
+    planScheme = resOfChat2SPaT.get('planSchemeMinorMerged', [])
+    stages = np.full((len(planScheme), 1 + len(STAGE_ATTRIBUTES)), MISSING, dtype=np.int32)
+    extraAttributes = {}
+    for i, phase in enumerate(planScheme):
+        phaseName = next(iter(phase))
+        stages[i, 0] = helper_getMovementId(phaseName, extraNames)
+        for attr, v in phase[phaseName].items():
+            if attr in dict_columnOfAttribute and type(v) == int and v != MISSING:
+                stages[i, dict_columnOfAttribute[attr]] = v
+            else:
+                extraAttributes.setdefault(str(i), {})[attr] = v
+
+    # Step 3: Countdown tables, in the row order of the colors
+    countdownBytes = b''
+    if 'dict_countdownTables' in resOfChat2SPaT:
+        flags |= FLAG_COUNTDOWN
+        dict_countdownTables = resOfChat2SPaT['dict_countdownTables']
+        countdownBytes = (helper_getRows({k: _['timeToChange'] for k, _ in dict_countdownTables.items()}, phaseNames, np.int16).tobytes()
+                          + helper_getRows({k: _['nextColor'] for k, _ in dict_countdownTables.items()}, phaseNames, np.int8).tobytes())
+
+    # Step 4: Other fields as json, with the key order of the plan obj
+    meta = {k: v for k, v in resOfChat2SPaT.items() if k not in TABLE_KEYS and (includeResStr or k != 'resStr')}
+    meta['_keys'] = [k for k in resOfChat2SPaT if k in meta or k in TABLE_KEYS]
+    if len(extraAttributes) > 0:
+        meta['_extraAttributes'] = extraAttributes
+    if 'planSchemeMinorMerged' not in resOfChat2SPaT:
+        meta['_noPlanScheme'] = True
+    metaBytes = json.dumps(meta, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    namesBytes = '\n'.join(extraNames).encode('utf-8')
+    return b''.join([HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(phaseNames), colors.shape[1], len(planScheme), len(namesBytes),
+                                 len(colorsBytes), stages.nbytes, len(countdownBytes), len(metaBytes)),
+                     rowIds.tobytes(), namesBytes, colorsBytes, stages.tobytes(), countdownBytes, metaBytes])
+
+def loadPlan(buf, asLists=False):
+    '''
+    Plan obj of serializePlan bytes (or any buffer: memoryview, mmap, shared memory).
+
+    Parameters:
+    asLists: False - the rows of dict_lightColorRec (and dict_countdownTables) are read-only numpy views into buf, no data is copied
+                     (run-length encoded colors are decoded into a new array);
+             True  - the rows are lists of int, and the plan obj equals the serialized one.
+
+    Returns:
+    the plan obj; None for an empty buffer.
+    '''
+    view = memoryview(buf)
+    if len(view) == 0:
+        return None
+    magic, version, flags, n, C, nStages, lenNames, lenColors, lenStages, lenCountdown, lenMeta = HEADER.unpack_from(view, 0)
+    if magic != MAGIC:
+        raise ValueError('Not a serialized plan.')
+    if version > FORMAT_VERSION:
+        raise ValueError('Serialized plan of format version %d, newer than the supported version %d.' % (version, FORMAT_VERSION))
+    offset = HEADER.size
+    if flags & FLAG_JSON_ONLY:
+        return json.loads(bytes(view[offset:offset + lenMeta]).decode('utf-8'))
+
+    # Step 1: Names of the color rows
+    rowIds = np.frombuffer(view, dtype=np.uint16, count=n, offset=offset).tolist()
+    offset += 2 * n
+    extraNames = bytes(view[offset:offset + lenNames]).decode('utf-8').split('\n') if lenNames > 0 else []
+    offset += lenNames
+    phaseNames = [helper_getMovementName(_, extraNames) for _ in rowIds]
+
+    # Step 2: Color rows
+    if flags & FLAG_RLE:
+        colors = helper_decodeRuns(view[offset:offset + lenColors], n, C)
+    else:
+        colors = np.frombuffer(view, dtype=np.int8, count=n * C, offset=offset).reshape(n, C)
+    offset += lenColors
+    rows = colors.tolist() if asLists else colors
+    dict_lightColorRec = {phaseName: rows[i] for i, phaseName in enumerate(phaseNames)}
+
+    # Step 3: Phase stages
+    stages = np.frombuffer(view, dtype=np.int32, count=lenStages // 4, offset=offset).reshape(nStages, 1 + len(STAGE_ATTRIBUTES)).tolist()
+    offset += lenStages
+
+    # Step 4: Countdown tables
+    dict_countdownTables = None
+    if flags & FLAG_COUNTDOWN:
+        timeToChange = np.frombuffer(view, dtype=np.int16, count=n * C, offset=offset).reshape(n, C)
+        nextColor = np.frombuffer(view, dtype=np.int8, count=n * C, offset=offset + 2 * n * C).reshape(n, C)
+        if asLists:
+            timeToChange, nextColor = timeToChange.tolist(), nextColor.tolist()
+        dict_countdownTables = {phaseName: {'timeToChange': timeToChange[i], 'nextColor': nextColor[i]} for i, phaseName in enumerate(phaseNames)}
+    offset += lenCountdown
+
+    meta = json.loads(bytes(view[offset:offset + lenMeta]).decode('utf-8'))
+    return helper_assemblePlanObj(meta, dict_lightColorRec, stages, extraNames, dict_countdownTables)
+
+def serializePlanBatch(resOfPlans, colorEncoding='bytes', includeResStr=True):
+    '''Serialize a list of plan objs (None, or results that are not plan objs, are kept as such) to one buffer, read with loadPlanBatch.'''
+    payloads = [serializePlan(_, colorEncoding, includeResStr) for _ in resOfPlans]
+    offsets = np.zeros(len(payloads) + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum([len(_) for _ in payloads])
+    return b''.join([BATCH_HEADER.pack(BATCH_MAGIC, FORMAT_VERSION, len(payloads)), offsets.tobytes()] + payloads)
+
+def loadPlanBatch(buf, asLists=False):
+    '''List of plan objs of a serializePlanBatch buffer; each plan is read as with loadPlan, without copying the buffer.'''
+    view = memoryview(buf)
+    magic, version, count = BATCH_HEADER.unpack_from(view, 0)
+    if magic != BATCH_MAGIC:
+        raise ValueError('Not a serialized plan batch.')
+    if version > FORMAT_VERSION:
+        raise ValueError('Serialized plan batch of format version %d, newer than the supported version %d.' % (version, FORMAT_VERSION))
+    offsets = np.frombuffer(view, dtype=np.uint32, count=count + 1, offset=BATCH_HEADER.size).tolist()
+    start = BATCH_HEADER.size + 4 * (count + 1)
+    return [loadPlan(view[start + offsets[i]:start + offsets[i + 1]], asLists) for i in range(count)]
+
+def serializePlanJson(resOfChat2SPaT, includeResStr=True):
+    '''
+    Json-compatible fallback of serializePlan, with the same schema: movement ids, run-length encoded color rows
+    ([value, length, value, length, ...] per row) and the phase stage table. The countdown tables are not stored but
+    computed again by loadPlanJson. Returns a dict for json.dumps.
+    '''
+    if resOfChat2SPaT == None or 'dict_lightColorRec' not in resOfChat2SPaT:
+        return {'format': 'Chat2SPaT plan', 'version': FORMAT_VERSION, 'meta': resOfChat2SPaT}
+    buf = serializePlan(resOfChat2SPaT, 'rle', includeResStr)
+    view = memoryview(buf)
+    _, _, flags, n, C, nStages, lenNames, lenColors, lenStages, lenCountdown, lenMeta = HEADER.unpack_from(view, 0)
+    offset = HEADER.size
+    rowIds = np.frombuffer(view, dtype=np.uint16, count=n, offset=offset).tolist()
+    offset += 2 * n
+    extraNames = bytes(view[offset:offset + lenNames]).decode('utf-8').split('\n') if lenNames > 0 else []
+    offset += lenNames
+    runsOfRow, values, lengths = helper_splitRuns(view[offset:offset + lenColors], n)
+    offset += lenColors
+    stages = np.frombuffer(view, dtype=np.int32, count=lenStages // 4, offset=offset).reshape(nStages, -1).tolist()
+    offset += lenStages + lenCountdown
+    colorRuns, k = [], 0
+    for runs in runsOfRow:
+        row = np.empty(2 * runs, dtype=np.int64)
+        row[0::2], row[1::2] = values[k:k + runs], lengths[k:k + runs]
+        colorRuns.append(row.tolist())
+        k += runs
+    return {'format': 'Chat2SPaT plan', 'version': FORMAT_VERSION, 'rowIds': rowIds, 'extraNames': extraNames, 'cycleLength': C,
+            'colorRuns': colorRuns, 'stages': [[v if v != MISSING else None for v in row] for row in stages],
+            'countdownTables': bool(flags & FLAG_COUNTDOWN), 'meta': json.loads(bytes(view[offset:offset + lenMeta]).decode('utf-8'))}
+
+def loadPlanJson(obj):
+    '''Plan obj (rows as lists) of a serializePlanJson dict (or its json str).'''
+    if type(obj) == str:
+        obj = json.loads(obj)
+    if obj.get('format') != 'Chat2SPaT plan':
+        raise ValueError('Not a serialized plan.')
+    if obj['version'] > FORMAT_VERSION:
+        raise ValueError('Serialized plan of format version %d, newer than the supported version %d.' % (obj['version'], FORMAT_VERSION))
+    if 'colorRuns' not in obj:
+        return obj['meta']
+    phaseNames = [helper_getMovementName(_, obj['extraNames']) for _ in obj['rowIds']]
+    dict_lightColorRec = {}
+    for phaseName, runs in zip(phaseNames, obj['colorRuns']):
+        row = []
+        for i in range(0, len(runs), 2):
+            row += [runs[i]] * runs[i + 1]
+        dict_lightColorRec[phaseName] = row
+    dict_countdownTables = None
+    if obj['countdownTables']:
+        from Chat2SPaT import getCountdownTables
+        dict_countdownTables = getCountdownTables(dict_lightColorRec)
+    stages = [[v if v != None else MISSING for v in row] for row in obj['stages']]
+    return helper_assemblePlanObj(obj['meta'], dict_lightColorRec, stages, obj['extraNames'], dict_countdownTables)
+
+TABLE_KEYS = ['planSchemeMinorMerged', 'dict_lightColorRec', 'dict_countdownTables']
+dict_columnOfAttribute = {k: i + 1 for i, k in enumerate(STAGE_ATTRIBUTES)}
+
+# helper: movement id of a phase name; a name not in MOVEMENT_NAMES is added to extraNames
+def helper_getMovementId(phaseName, extraNames):
+    if phaseName in dict_idOfMovement:
+        return dict_idOfMovement[phaseName]
+    if phaseName not in extraNames:
+        extraNames.append(phaseName)
+    return EXTRA_NAME_ID + extraNames.index(phaseName)
+
+# helper: phase name of a movement id
+def helper_getMovementName(movementId, extraNames):
+    return extraNames[movementId - EXTRA_NAME_ID] if movementId >= EXTRA_NAME_ID else MOVEMENT_NAMES[movementId]
+
+# helper: rows of a dict (lists, arrays or numpy rows) as a matrix, in the order of phaseNames
+def helper_getRows(dict_rows, phaseNames, dtype):
+    if len(phaseNames) == 0:
+        return np.zeros((0, 0), dtype=dtype)
+    lengths = set(len(dict_rows[_]) for _ in phaseNames)
+    if len(lengths) > 1:
+        raise ValueError('The color rows have different lengths: %s' % sorted(lengths))
+    return np.array([dict_rows[_] for _ in phaseNames], dtype=dtype).reshape(len(phaseNames), lengths.pop())
+
+# helper: run-length encoding of the rows of a matrix: runs per row (uint16), run values (int8), run lengths (uint16)
+def helper_encodeRuns(colors):
+    n, C = colors.shape
+    flat = colors.ravel()
+    isStart = np.ones(flat.size, dtype=bool)
+    isStart[1:] = flat[1:] != flat[:-1]
+    isStart[::max(C, 1)] = True  # a run never crosses the end of a row
+    starts = np.flatnonzero(isStart)
+    lengths = np.diff(np.append(starts, flat.size))
+    runsOfRow = np.bincount(starts // max(C, 1), minlength=n)
+    return runsOfRow.astype(np.uint16).tobytes() + flat[starts].tobytes() + lengths.astype(np.uint16).tobytes()
+
+# helper: runs per row, run values and run lengths of helper_encodeRuns bytes (views into buf)
+def helper_splitRuns(buf, n):
+    runsOfRow = np.frombuffer(buf, dtype=np.uint16, count=n)
+    runs = int(runsOfRow.sum())
+    values = np.frombuffer(buf, dtype=np.int8, count=runs, offset=2 * n)
+    lengths = np.frombuffer(buf, dtype=np.uint16, count=runs, offset=2 * n + runs)
+    return runsOfRow, values, lengths
+
+# helper: color matrix of helper_encodeRuns bytes
+def helper_decodeRuns(buf, n, C):
+    _, values, lengths = helper_splitRuns(buf, n)
+    return np.repeat(values, lengths).reshape(n, C)
+
+# helper: plan obj from the meta fields, the color rows, the phase stage table and the countdown tables
+def helper_assemblePlanObj(meta, dict_lightColorRec, stages, extraNames, dict_countdownTables):
+    extraAttributes = meta.pop('_extraAttributes', {})
+    planScheme = None
+    if not meta.pop('_noPlanScheme', False):
+        planScheme = []
+        for i, row in enumerate(stages):
+            attributes = {attr: v for attr, v in zip(STAGE_ATTRIBUTES, row[1:]) if v != MISSING}
+            attributes.update(extraAttributes.get(str(i), {}))
+            planScheme.append({helper_getMovementName(row[0], extraNames): attributes})
+    tables = {'planSchemeMinorMerged': planScheme, 'dict_lightColorRec': dict_lightColorRec, 'dict_countdownTables': dict_countdownTables}
+    return {k: tables[k] if k in tables else meta[k] for k in meta.pop('_keys')}
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from assemblyEngines import assemblePlanWithEngine
+    from batchAssembly import WARM_UP_RES_STR
+    from Chat2SPaT import slimPlanRes
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='Round trip and benchmark of plan serialization against json.')
+    parser.add_argument('--plans', type=int, default=300, help='plans per batch (the test dataset has about 300 cases)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    # A dataset-sized batch of plans, both languages, with and without countdown tables
+    resOfPlans = [assemblePlanWithEngine(WARM_UP_RES_STR, 'fast', countdownTables=True)]
+    seed = 0
+    while len(resOfPlans) < args.plans:
+        try:
+            resStr = generateSyntheticPlan(seed=seed, language='zh' if seed % 2 else 'en', numPedPhases=seed % 3, numOverlapPhases=seed % 3,
+                                           formatErrorRate=0.3)
+        except ValueError:  # a combination of knobs the generator does not support
+            resStr = None
+        if resStr != None:
+            resOfPlans.append(assemblePlanWithEngine(resStr, 'fast', countdownTables=seed % 4 == 0))
+        seed += 1
+    resOfPlans[1]['planSchemeMinorMerged'][0][next(iter(resOfPlans[1]['planSchemeMinorMerged'][0]))]['note'] = '手动调整'
+    resOfPlans[2]['warningMsgConflictPhases'] = {'北直行|东直行': [[0, 3]]}
+
+    # Round trips
+    for res in resOfPlans:
+        for colorEncoding in ['bytes', 'rle']:
+            assert loadPlan(serializePlan(res, colorEncoding), asLists=True) == res
+        assert loadPlanJson(json.dumps(serializePlanJson(res), ensure_ascii=False)) == res
+        resSlim = slimPlanRes(res)
+        loaded = loadPlan(serializePlan(resSlim))
+        assert {k: list(v) for k, v in loaded['dict_lightColorRec'].items()} == {k: list(v) for k, v in resSlim['dict_lightColorRec'].items()}
+    batch = serializePlanBatch(resOfPlans[:3] + [None, {'error': 'TSC plan cannot be assembled'}])
+    loaded = loadPlanBatch(batch, asLists=True)
+    assert loaded[:3] == resOfPlans[:3] and loaded[3] == None and loaded[4] == {'error': 'TSC plan cannot be assembled'}
+    assert not loadPlanBatch(batch)[0]['dict_lightColorRec']['NBT'].flags['OWNDATA']  # a view into the buffer
+
+    # Benchmark: batch of plans, with and without the raw LLM outputs
+    def measure(func, arg):
+        best = None
+        for _ in range(args.repeat):
+            t0 = time.perf_counter()
+            out = func(arg)
+            seconds = time.perf_counter() - t0
+            best = seconds if best == None else min(best, seconds)
+        return best, out
+
+    for includeResStr in [True, False]:
+        resList = resOfPlans if includeResStr else [{k: v for k, v in _.items() if k != 'resStr'} for _ in resOfPlans]
+        print('%d plans, resStr %s' % (len(resList), 'included' if includeResStr else 'dropped'))
+        print('  %-28s %12s %12s %12s' % ('format', 'dump (ms)', 'load (ms)', 'size (KB)'))
+        rows = [('json', lambda _: json.dumps(_, ensure_ascii=False).encode('utf-8'), lambda _: json.loads(_)),
+                ('binary, bytes', lambda _: serializePlanBatch(_), lambda _: loadPlanBatch(_)),
+                ('binary, bytes, as lists', lambda _: serializePlanBatch(_), lambda _: loadPlanBatch(_, asLists=True)),
+                ('binary, rle', lambda _: serializePlanBatch(_, 'rle'), lambda _: loadPlanBatch(_)),
+                ('json fallback', lambda _: json.dumps([serializePlanJson(p) for p in _], ensure_ascii=False).encode('utf-8'),
+                 lambda _: [loadPlanJson(p) for p in json.loads(_)])]
+        for name, dump, load in rows:
+            secondsDump, buf = measure(dump, resList)
+            secondsLoad, _ = measure(load, buf)
+            print('  %-28s %12.2f %12.2f %12.1f' % (name, secondsDump * 1000, secondsLoad * 1000, len(buf) / 1024))
@@ -0,0 +1,272 @@
+# Profiling of plan assembly: per-function and per-Step time of convertChatPlanResToSpatParams on a set of LLM outputs
+#
+# Two passes over the same plans:
+#   cProfile - exact call counts and own / cumulative time of each function (per-function table, optional .prof file for pstats).
+#   sampling - a background thread samples the stack of the assembling thread every few ms; each sample is assigned to the
+#              '# Step N' block of convertChatPlanResToSpatParams it was taken in (per-Step table), and the stacks are written in
+#              collapsed form ('frame;frame;frame count' lines) for flamegraph.pl or speedscope.
+# The known hot helpers (HOT_HELPERS) are marked in the per-function table and summarized separately.
+#
+# Run: python profileAssembly.py [--input plans.jsonl] [--cases 1,2,5] [--synthetic 50] [--repeat 5] [--engine reference]
+#                                [--profiler both] [--collapsed assembly.folded] [--pstats assembly.prof] [--top 25]
+#   plans.jsonl has one LLM output (json object) per line, or one record {"testCaseId": ..., "resStr": LLM output} per line;
+#   --cases keeps the records of the given test case ids. Without --input, the example in main.py and synthetic plans are used.
+import cProfile
+import inspect
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+
+import Chat2SPaT
+from assemblyEngines import assemblePlanWithEngine
+
+HOT_HELPERS = ['helper_getSubValueFromPhase', 'helper_paintLightColor', 'helper_areConflictingPhasesTimedSimultaneously']
+list_stepsOfSource = []  # filled by getStepsOfSource
+
+def profileAssembly(resStrList, engineName='reference', repeat=1, profiler='both', interval=0.001):
+    '''
+    Profile the assembly of the plans (repeat times each).
+
+    Parameters:
+    resStrList(list): LLM outputs (str or parsed dicts); the ones that cannot be assembled are profiled up to their error.
+    engineName: assembly engine (see assemblyEngines.py).
+    profiler: 'cprofile', 'sampling' or 'both' (two separate passes, so neither profiler slows down the other).
+    interval: sampling interval (s).
+
+    Returns:
+    dict of plans, errors, and, per pass:
+    functions: list of {function, file, line, calls, tottime, cumtime, isHot}, by tottime (cProfile pass).
+    stats: the pstats.Stats of the cProfile pass.
+    steps: list of {step, samples, seconds, share}, in Step order (sampling pass); seconds are the step's fraction of all
+           samples times the wall time of the pass, as the sampler takes fewer samples than one per interval.
+    collapsedStacks: dict of 'frame;frame;...' -> samples (sampling pass).
+    seconds: wall time of each pass.
+    '''
+    res = {'plans': len(resStrList), 'errors': 0}
+
+    # Step 1: cProfile pass
+    if profiler in ['cprofile', 'both']:
+        profile = cProfile.Profile()
+        t0 = time.perf_counter()
+        profile.enable()
+        res['errors'] = helper_assembleAll(resStrList, engineName, repeat)
+        profile.disable()
+        res['secondsCProfile'] = time.perf_counter() - t0
+        res['stats'] = pstats.Stats(profile)
+        res['functions'] = getFunctionAggregates(res['stats'])
+
+    # Step 2: sampling pass
+    if profiler in ['sampling', 'both']:
+        sampler = StackSampler(threading.get_ident(), interval)
+        t0 = time.perf_counter()
+        sampler.start()
+        try:
+            res['errors'] = helper_assembleAll(resStrList, engineName, repeat)
+        finally:
+            sampler.stop()
+        res['secondsSampling'] = time.perf_counter() - t0
+        res['collapsedStacks'] = sampler.collapsedStacks
+        res['steps'] = getStepAggregates(sampler.collapsedStacks, res['secondsSampling'])
+    return res
+
+def getFunctionAggregates(stats):
+    '''Per-function rows of a pstats.Stats, by own time (tottime) descending.'''
+    rows = []
+    for (fileName, line, functionName), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append({'function': functionName, 'file': os.path.basename(fileName), 'line': line, 'calls': calls,
+                     'tottime': tottime, 'cumtime': cumtime, 'isHot': functionName in HOT_HELPERS})
+    rows.sort(key=lambda _: -_['tottime'])
+    return rows
+
+def getStepAggregates(collapsedStacks, secondsSampling):
+    '''Samples, seconds and share of each Step, from the Step frames of the collapsed stacks (samples outside the assembly are
+    left out of the shares). The seconds of a Step are its samples / all samples (outside the assembly included) * secondsSampling.'''
+    dict_samplesOfStep = {}
+    for stack, samples in collapsedStacks.items():
+        step = next((_ for _ in stack.split(';') if _.startswith('Step ')), None)
+        if step != None:
+            dict_samplesOfStep[step] = dict_samplesOfStep.get(step, 0) + samples
+    total = max(sum(dict_samplesOfStep.values()), 1)
+    totalWithOutside = max(sum(collapsedStacks.values()), 1)
+    steps = [label for _, label in getStepsOfSource()]
+    return [{'step': step, 'samples': dict_samplesOfStep[step], 'seconds': dict_samplesOfStep[step] / totalWithOutside * secondsSampling,
+             'share': dict_samplesOfStep[step] / total} for step in steps if step in dict_samplesOfStep]
+
+def getStepsOfSource():
+    '''
+    (first line number, label) of each '# Step N' block of convertChatPlanResToSpatParams, from its source,
+    with a 'Step -: setup' block for the lines before Step 0.
+    '''
+    if len(list_stepsOfSource) == 0:
+        lines, firstLine = inspect.getsourcelines(Chat2SPaT.convertChatPlanResToSpatParams)
+        list_stepsOfSource.append((firstLine, 'Step -: setup'))
+        for i, line in enumerate(lines):
+            m = re.match(r'\s*# Step (\d+(?:\.\d+)?)\s*[:：]\s*(.*)', line)
+            if m != None:
+                list_stepsOfSource.append((firstLine + i, 'Step %s: %s' % (m.group(1), m.group(2).strip())))
+    return list_stepsOfSource
+
+def writeCollapsedStacks(collapsedStacks, fileName):
+    '''Write collapsed stacks, one 'frame;frame;... count' line per stack (input of flamegraph.pl, speedscope, etc.).'''
+    with open(fileName, 'w', encoding='utf-8') as f:
+        for stack, samples in sorted(collapsedStacks.items()):
+            f.write('%s %d\n' % (stack, samples))
+
+def formatProfileReport(res, top=25):
+    '''Text report of profileAssembly: per-function table (hot helpers marked with *), hot helpers, per-Step table.'''
+    lines = ['%d plans, %d errors' % (res['plans'], res['errors'])]
+    if 'functions' in res:
+        total = max(res['stats'].total_tt, 1e-12)
+        lines.append('')
+        lines.append('cProfile pass: %.2f s (%.3f s profiled)' % (res['secondsCProfile'], res['stats'].total_tt))
+        lines.append('%-2s %-52s %10s %10s %7s %10s' % ('', 'function', 'calls', 'tottime', '%', 'cumtime'))
+        for row in res['functions'][:top]:
+            lines.append('%-2s %-52s %10d %10.3f %6.1f%% %10.3f'
+                         % ('*' if row['isHot'] else '', helper_getFunctionLabel(row)[:52], row['calls'], row['tottime'],
+                            100 * row['tottime'] / total, row['cumtime']))
+        lines.append('')
+        lines.append('Hot helpers:')
+        for functionName in HOT_HELPERS:
+            rows = [_ for _ in res['functions'] if _['function'] == functionName]
+            if len(rows) == 0:
+                lines.append('  %-48s not called' % functionName)
+                continue
+            calls, tottime = sum(_['calls'] for _ in rows), sum(_['tottime'] for _ in rows)
+            rank = res['functions'].index(rows[0]) + 1
+            lines.append('  %-48s %10d calls %8.3f s own time (%.1f%%, rank %d), %.2f us per call'
+                         % (functionName, calls, tottime, 100 * tottime / total, rank, tottime / max(calls, 1) * 1e6))
+    if 'steps' in res:
+        lines.append('')
+        samples = sum(res['collapsedStacks'].values())
+        lines.append('Sampling pass: %.2f s, %d samples (one per %.2f ms)' % (res['secondsSampling'], samples,
+                                                                               res['secondsSampling'] / max(samples, 1) * 1000))
+        lines.append('%-64s %8s %10s %7s' % ('step', 'samples', 'seconds', '%'))
+        for row in res['steps']:
+            lines.append('%-64s %8d %10.3f %6.1f%%' % (row['step'][:64], row['samples'], row['seconds'], 100 * row['share']))
+    return '\n'.join(lines)
+
+class StackSampler:
+    '''
+    Background thread sampling the stack of another thread (sys._current_frames) every interval seconds.
+    The stacks are cut at convertChatPlanResToSpatParams, and a 'Step N: ...' frame is inserted below it for the Step block
+    the sample was taken in; samples outside the assembly are counted as '(outside assembly)'.
+    '''
+    def __init__(self, threadId, interval=0.001):
+        self.threadId = threadId
+        self.interval = interval
+        self.collapsedStacks = {}
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.steps = getStepsOfSource()
+        self.switchInterval = None
+
+    def start(self):
+        # the sampled thread has to release the GIL often enough for the sampler to run on time
+        self.switchInterval = sys.getswitchinterval()
+        sys.setswitchinterval(min(self.switchInterval, self.interval / 2))
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+        sys.setswitchinterval(self.switchInterval)
+
+    def run(self):
+        while not self.stopEvent.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            if frame == None:
+                continue
+            stack = helper_getCollapsedStack(frame, self.steps)
+            self.collapsedStacks[stack] = self.collapsedStacks.get(stack, 0) + 1
+
+# helper: 'file:function' label of a per-function row
+def helper_getFunctionLabel(row):
+    if row['file'] == '~':  # built-in functions
+        return row['function']
+    return '%s:%d(%s)' % (row['file'], row['line'], row['function'])
+
+# helper: collapsed stack of a frame, from convertChatPlanResToSpatParams (with its Step frame) down to the frame
+def helper_getCollapsedStack(frame, steps):
+    frames = []
+    while frame != None:
+        code = frame.f_code
+        if code is Chat2SPaT.convertChatPlanResToSpatParams.__code__:
+            step = steps[0][1]
+            for firstLine, label in steps:
+                if frame.f_lineno >= firstLine:
+                    step = label
+            frames.append(step)
+            frames.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+            return ';'.join(reversed(frames))
+        frames.append('%s:%s' % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return '(outside assembly)'
+
+# helper: assemble each plan repeat times, errors counted
+def helper_assembleAll(resStrList, engineName, repeat):
+    errors = 0
+    for _ in range(repeat):
+        for resStr in resStrList:
+            try:
+                assemblePlanWithEngine(resStr, engineName)
+            except Exception:
+                errors += 1
+    return errors
+
+# helper: LLM outputs of a jsonl file, optionally only the records of the given test case ids
+def helper_readPlans(fileName, caseIds=None):
+    resStrList, foundIds = [], set()
+    with open(fileName, encoding='utf-8') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            record = json.loads(line)
+            if 'resStr' not in record:  # a bare LLM output
+                if caseIds == None:
+                    resStrList.append(record)
+                continue
+            caseId = str(record.get('testCaseId'))
+            if caseIds == None or caseId in caseIds:
+                resStrList.append(record['resStr'])
+                foundIds.add(caseId)
+    if caseIds != None and len(foundIds) < len(caseIds):
+        raise ValueError('Test case ids not found in %s: %s' % (fileName, ', '.join(sorted(set(caseIds) - foundIds))))
+    return resStrList
+
+if __name__ == '__main__':
+    import argparse
+    from assemblyEngines import dict_assemblyEngines
+    from batchAssembly import WARM_UP_RES_STR
+    from planGenerator import generateSyntheticPlans
+
+    parser = argparse.ArgumentParser(description='Profile plan assembly per function and per Step.')
+    parser.add_argument('--input', default=None, help='jsonl file of LLM outputs, or of {"testCaseId", "resStr"} records')
+    parser.add_argument('--cases', default=None, help='comma-separated test case ids to keep from --input')
+    parser.add_argument('--synthetic', type=int, default=50, help='number of synthetic plans, without --input')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--engine', default='reference', choices=list(dict_assemblyEngines))
+    parser.add_argument('--profiler', default='both', choices=['cprofile', 'sampling', 'both'])
+    parser.add_argument('--interval', type=float, default=0.001, help='sampling interval (s)')
+    parser.add_argument('--collapsed', default=None, help='output file of collapsed stacks, for flamegraphs')
+    parser.add_argument('--pstats', default=None, help='output file of the cProfile stats')
+    parser.add_argument('--top', type=int, default=25)
+    args = parser.parse_args()
+
+    if args.input != None:
+        resStrList = helper_readPlans(args.input, args.cases.split(',') if args.cases != None else None)
+    else:
+        resStrList = [WARM_UP_RES_STR] + generateSyntheticPlans(args.synthetic, numPedPhases=2, numOverlapPhases=2)
+    res = profileAssembly(resStrList, args.engine, args.repeat, args.profiler, args.interval)
+    print(formatProfileReport(res, args.top))
+    if args.input == None:
+        assert res['errors'] == 0  # the example and the synthetic plans always assemble
+    if args.collapsed != None and 'collapsedStacks' in res:
+        writeCollapsedStacks(res['collapsedStacks'], args.collapsed)
+        print('Collapsed stacks written to %s' % args.collapsed)
+    if args.pstats != None and 'stats' in res:
+        res['stats'].dump_stats(args.pstats)
+        print('cProfile stats written to %s' % args.pstats)
@@ -0,0 +1,232 @@
+# Prompt slicing: a minimal system prompt per conversation, from the lines of prompts/prompts.txt that the plan descriptions need
+#
+# Each line (instruction) of the prompt is tagged with a section (PROMPT_SECTIONS): core lines are always sent; stage, ring, ped,
+# dummy, phaseNumber, permissive, timepoints, overlap and editing lines only when keyword detection on the descriptions of the
+# conversation (English and Chinese keywords) finds the feature. A conversation with edits gets the editing section from its second
+# description on; its prompt only grows, so the earlier replies stay consistent with it.
+#
+# Run: python promptBuilder.py [--dataset ../planDescriptionDataset/testDataset.xlsx]
+#   offline token report on the dataset descriptions, and a check that the ped section is sent to every case whose
+#   ground truth has ped phases; evaluatePromptSlicing compares the accuracy of the full and sliced prompts with an LLM.
+import ast
+import math
+import os
+import re
+
+PROMPT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'prompts', 'prompts.txt')
+DATASET_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'planDescriptionDataset', 'testDataset.xlsx')
+
+# (start of the line, section) of each line of prompts.txt, in order
+PROMPT_SECTIONS = [
+    ('Users describe the timing of phases', 'core'),
+    ('For each phase, unless the phase is described', 'core'),
+    ('Users may describe multiple phases together', 'core'),
+    ('Example 1: "north and south bound through"', 'core'),
+    ('Step 1: Generate result1.', 'core'),
+    ('Write the time duration for each phase', 'core'),
+    ('If a stage is dedicated to each direction', 'stage'),
+    ('If split phasing is used for a specific direction-bound', 'stage'),
+    ('If the plan does not involve dedicated stage', 'stage'),
+    ('If the user specifies a stage of mixed traffic', 'stage'),
+    ('If the user describes multiple phases and their time duration', 'stage'),
+    ('Otherwise, if the user describes phases sequentially', 'ring'),
+    ('If the user uses stage-style descriptions within ring', 'ring'),
+    ('When users add pedestrian (ped) phases', 'ped'),
+    ('If the pedestrian phase', 'ped'),
+    ('If a dummy phase is added', 'dummy'),
+    ('If the user modifies the signal operation', 'editing'),
+    ('If the user wants to add a second occurrence', 'editing'),
+    ('Finally, place the generated stageStyle', 'core'),
+    ('Step 2: Generate result2.', 'core'),
+    ('For every phase occurrence mentioned by the user', 'core'),
+    ('Additionally, phases are categorized', 'core'),
+    ('For the json object of each phase', 'core'),
+    ('In result2, the phase objects could also have', 'core'),
+    ('If the user does not mention pedestrian phases', 'core'),
+    ('If a pedestrian phase does not include the term', 'ped'),
+    ('Note that the pedestrian crossing of each direction', 'ped'),
+    ('If the phase name is not provided', 'phaseNumber'),
+    ('Through phases cannot be permissive phases', 'permissive'),
+    ('Considering the cyclical nature of the phases', 'timepoints'),
+    ('Note that by default, the start and end times', 'timepoints'),
+    ('Note that a phase', 'core'),
+    ('When the user specifies that X overlaps Y', 'overlap'),
+    ('If the user specifies that phase x follows multiple phases', 'overlap'),
+    ('When the user cancels the overlapping relationship', 'overlap'),
+    ('For right turns and U-turns', 'core'),
+    ('If the user changes the duration of a phase', 'editing'),
+    ('If the user provides a new duration', 'editing'),
+    ('If the user provides a new green light duration', 'editing'),
+    ('Make a list of all phase occurrence JSON objects', 'core'),
+    ('Step 3: Generate result3.', 'core'),
+    ('Record the duration of the cycle length', 'core'),
+    ('Finally, make a json for the final output', 'core'),
+]
+
+# Keywords (regex on the lowercased description) of each optional section; a false positive only costs tokens
+dict_keywordsOfSection = {
+    'ring': r'ring|环',
+    'ped': r'ped|walk|crossing|barnes|行人|过街|人行|phase\s*[a-l]\b|相位\s*[a-l]',  # phases A-L are ped phases
+    'dummy': r'dummy|虚',
+    'phaseNumber': r'phase\s*(\d|[a-l]\b|one|two|three|four|five|six|seven|eight|nine|ten|eleven|twelve|thirteen|fourteen|fifteen|sixteen)|相位\s*[\da-l一二三四五六七八九十]',
+    'permissive': r'permissive|light off|lights off|mixed|灭灯|熄灯|许可|混行|放行',
+    'timepoints': r'from|start of|end of|till|until|second \d|at \d|cycle start|\d\s*(s|秒)?\s*(to|-|~|至|到)\s*\d|开始|结束|第\s*\d|至|到',
+    'overlap': r'overlap|follow|concurrent|trail|parent|跟随|搭接|重叠|并发|伴随|早断|迟起',
+    'editing': r'change|modify|extend|reduce|increase|decrease|shorten|lengthen|cancel|remove|delete|replace|instead|改|延长|缩短|增加|减少|取消|删除|去掉|调整',
+}
+
+def detectPromptSections(planDescriptions):
+    '''
+    Sections of the prompt needed by the descriptions of a conversation (a str, or the list of its descriptions in order).
+
+    Returns:
+    set of section names, 'core' included; 'stage' unless only ring structures are described; 'editing' for a conversation
+    with more than one description.
+    '''
+    if type(planDescriptions) == str:
+        planDescriptions = [planDescriptions]
+    sections = set(['core'])
+    for planDescription in planDescriptions:
+        text = planDescription.lower()
+        for section, keywords in dict_keywordsOfSection.items():
+            if re.search(keywords, text) != None:
+                sections.add(section)
+    if 'ring' not in sections or any(re.search(r'stage|阶段', _.lower()) != None for _ in planDescriptions):
+        sections.add('stage')
+    if len(planDescriptions) > 1:
+        sections.add('editing')
+    return sections
+
+def buildPrompt(planDescriptions=None, sections=None, promptFile=PROMPT_FILE):
+    '''
+    The system prompt with the lines of the given sections (or of the sections detected from planDescriptions), in their order
+    in the prompt file. With neither, or with all sections, the full prompt (the prompt file as is).
+    '''
+    lines = helper_getPromptLines(promptFile)
+    if sections == None:
+        sections = detectPromptSections(planDescriptions) if planDescriptions != None else set(section for section, _ in lines)
+    return ''.join(line for section, line in lines if section in sections)
+
+def estimateTokens(text):
+    '''Offline token count estimate: about 4 characters per token for English, 1.5 per token for Chinese (BPE tokenizers of Qwen-like models).'''
+    numCjk = len(re.findall(r'[　-〿一-鿿＀-￯]', text))
+    return int(math.ceil((len(text) - numCjk) / 4 + numCjk / 1.5))
+
+def getTokenReport(conversations, countTokens=estimateTokens, promptFile=PROMPT_FILE):
+    '''
+    Token counts of the full and sliced system prompts over conversations (lists of plan descriptions).
+
+    Parameters:
+    countTokens: callable(text) -> number of tokens, e.g. lambda text: len(tokenizer.encode(text)) of the deployed model.
+
+    Returns:
+    dict of fullTokens, dict_tokensOfSection (tokens of each section), conversations (number), meanSlicedTokens, reduction
+    (1 - mean sliced / full), dict_countOfSection (conversations sending each section), and cases: per conversation, the
+    sections, slicedTokens and descriptionTokens.
+    '''
+    lines = helper_getPromptLines(promptFile)
+    dict_tokensOfSection = {}
+    for section, line in lines:
+        dict_tokensOfSection[section] = dict_tokensOfSection.get(section, 0) + countTokens(line)
+    fullTokens = countTokens(''.join(line for _, line in lines))
+    cases, dict_countOfSection = [], {}
+    for planDescriptions in conversations:
+        sections = detectPromptSections(planDescriptions)
+        for section in sections:
+            dict_countOfSection[section] = dict_countOfSection.get(section, 0) + 1
+        cases.append({'sections': sorted(sections), 'slicedTokens': countTokens(buildPrompt(sections=sections, promptFile=promptFile)),
+                      'descriptionTokens': sum(countTokens(_) for _ in planDescriptions)})
+    meanSlicedTokens = sum(_['slicedTokens'] for _ in cases) / max(len(cases), 1)
+    return {'fullTokens': fullTokens, 'dict_tokensOfSection': dict_tokensOfSection, 'conversations': len(cases),
+            'meanSlicedTokens': meanSlicedTokens, 'reduction': 1 - meanSlicedTokens / fullTokens,
+            'dict_countOfSection': dict_countOfSection, 'cases': cases}
+
+def readDatasetConversations(fileName=DATASET_FILE):
+    '''
+    Test cases of the plan description dataset as conversations: case A1.2 is the third turn of the conversation A1, A1.1, A1.2.
+
+    Returns:
+    list of dict of testCaseId, planDescriptions (of the conversation up to this case), dict_lightColorRec (ground truth) and isValid.
+    '''
+    import pandas as pd
+    df = pd.read_excel(fileName, sheet_name='test cases')
+    dict_descriptionOfCase = dict(zip(df['testCaseId'].astype(str), df['planGenerationAndEditingDescription'].astype(str)))
+    res = []
+    for caseId, dict_lightColorRec, isValid in zip(df['testCaseId'].astype(str), df['dict_lightColorRec'], df['isValid']):
+        baseId, _, turn = caseId.partition('.')
+        turnIds = [baseId] + ['%s.%d' % (baseId, i) for i in range(1, int(turn) + 1)] if turn != '' else [baseId]
+        res.append({'testCaseId': caseId, 'planDescriptions': [dict_descriptionOfCase[_] for _ in turnIds if _ in dict_descriptionOfCase],
+                    'dict_lightColorRec': ast.literal_eval(dict_lightColorRec), 'isValid': int(isValid)})
+    return res
+
+def evaluatePromptSlicing(queryLlm, cases, slicePrompt=True, engineName='reference', promptFile=PROMPT_FILE):
+    '''
+    Dataset regression of a prompt: each conversation is replayed turn by turn with the LLM, and the plan assembled from the
+    reply to its last description is compared with the ground truth color codes.
+
+    Parameters:
+    queryLlm: callable(messages) -> reply text (see selfRepairLoop.py).
+    cases: list of readDatasetConversations records.
+    slicePrompt: True for the sliced prompt (rebuilt at each turn), False for the full prompt.
+
+    Returns:
+    dict of accuracy (share of cases with the ground truth color codes), correct, cases, systemTokens (estimated, summed over
+    the queries) and results (per case: testCaseId, isCorrect, error).
+    '''
+    from assemblyEngines import assemblePlanWithEngine
+    from selfRepairLoop import helper_extractJson
+    results, systemTokens = [], 0
+    for case in cases:
+        messages, isCorrect, error = [], False, None
+        for i, planDescription in enumerate(case['planDescriptions']):
+            prompt = buildPrompt(case['planDescriptions'][:i + 1], promptFile=promptFile) if slicePrompt else buildPrompt(promptFile=promptFile)
+            systemTokens += estimateTokens(prompt)
+            messages = [{'role': 'system', 'content': prompt}] + messages[1:] + [{'role': 'user', 'content': '#Plan Description# %s' % planDescription}]
+            reply = queryLlm(messages)
+            messages.append({'role': 'assistant', 'content': reply})
+        try:
+            resOfChat2SPaT = assemblePlanWithEngine(helper_extractJson(reply), engineName)
+            isCorrect = {k: list(v) for k, v in resOfChat2SPaT['dict_lightColorRec'].items()} == case['dict_lightColorRec']
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+        results.append({'testCaseId': case['testCaseId'], 'isCorrect': isCorrect, 'error': error})
+    correct = sum(1 for _ in results if _['isCorrect'])
+    return {'accuracy': correct / max(len(results), 1), 'correct': correct, 'cases': len(results), 'systemTokens': systemTokens, 'results': results}
+
+dict_promptLinesOfFile = {}  # prompt file -> (section, line) list, read once
+
+# helper: (section, line) of each line of the prompt file; a line not in PROMPT_SECTIONS (the prompt was edited) is an error
+def helper_getPromptLines(promptFile):
+    if promptFile not in dict_promptLinesOfFile:
+        with open(promptFile, encoding='utf-8') as f:
+            lines = f.read().splitlines(keepends=True)
+        if len(lines) != len(PROMPT_SECTIONS):
+            raise ValueError('%s has %d lines, PROMPT_SECTIONS has %d; update PROMPT_SECTIONS.' % (promptFile, len(lines), len(PROMPT_SECTIONS)))
+        for i, (line, (start, _)) in enumerate(zip(lines, PROMPT_SECTIONS)):
+            if not line.startswith(start):
+                raise ValueError('Line %d of %s does not start with "%s"; update PROMPT_SECTIONS.' % (i + 1, promptFile, start))
+        dict_promptLinesOfFile[promptFile] = [(section, line) for line, (_, section) in zip(lines, PROMPT_SECTIONS)]
+    return dict_promptLinesOfFile[promptFile]
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Token report of the sliced prompts on the plan description dataset.')
+    parser.add_argument('--dataset', default=DATASET_FILE)
+    args = parser.parse_args()
+
+    with open(PROMPT_FILE, encoding='utf-8') as f:
+        assert buildPrompt() == f.read()
+    cases = readDatasetConversations(args.dataset)
+    res = getTokenReport([_['planDescriptions'] for _ in cases])
+    print('Full prompt: %d tokens (estimated); sections: %s' % (res['fullTokens'], ', '.join('%s %d' % _ for _ in res['dict_tokensOfSection'].items())))
+    print('%d dataset cases: %.0f tokens per sliced prompt on average, %.1f%% fewer than the full prompt' % (res['conversations'], res['meanSlicedTokens'], 100 * res['reduction']))
+    print('Cases sending each section: %s' % ', '.join('%s %d' % (k, res['dict_countOfSection'].get(k, 0)) for k in res['dict_tokensOfSection']))
+    for language, isLanguage in [('zh', lambda _: re.search(r'[一-鿿]', _) != None), ('en', lambda _: re.search(r'[一-鿿]', _) == None)]:
+        tokens = [r['slicedTokens'] for case, r in zip(cases, res['cases']) if isLanguage(case['planDescriptions'][0])]
+        print('  %s: %d cases, %.0f tokens per sliced prompt' % (language, len(tokens), sum(tokens) / max(len(tokens), 1)))
+
+    # Ped phases in the ground truth need the ped section
+    missing = [case['testCaseId'] for case, r in zip(cases, res['cases'])
+               if any('行人' in _ or 'PED' in _.upper() for _ in case['dict_lightColorRec']) and 'ped' not in r['sections']]
+    print('Cases with ped phases in the ground truth but no ped section: %s' % (missing if len(missing) > 0 else 'none'))
@@ -0,0 +1,194 @@
+# Self-repair loop: the validation warnings of an assembled plan are turned into a corrective follow-up message to the LLM,
+# and the LLM is queried again until the plan is valid, within a retry and time budget
+#
+# The LLM is any callable queryLlm(messages) -> reply text, messages being a chat history [{'role': 'system' | 'user' | 'assistant',
+# 'content': str}]; StubLlm replays canned replies, for tests and dataset runs without a model.
+#
+# Run: python selfRepairLoop.py [--cases 200]  (dataset run with the stub LLM)
+import json
+import time
+
+from assemblyEngines import assemblePlanWithEngine
+from planSchemaValidation import validateLlmOutputs
+from promptBuilder import PROMPT_FILE, buildPrompt
+
+MAX_ITEMS_IN_MESSAGE = 5  # errors or warnings listed per kind in a corrective message
+
+def buildInitialMessages(planDescription, promptFile=PROMPT_FILE, slicePrompt=False):
+    '''Chat history of a new plan: the prompt of Chat2SPaT as system message (only the sections the description needs
+    if slicePrompt, see promptBuilder.py), and the plan description. Without slicing, the prompt file is sent as is, whatever its
+    sections (only slicing needs the lines of the file to match PROMPT_SECTIONS).'''
+    if slicePrompt:
+        prompt = buildPrompt([planDescription], promptFile=promptFile)
+    else:
+        with open(promptFile, encoding='utf-8') as f:
+            prompt = f.read()
+    return [{'role': 'system', 'content': prompt}, {'role': 'user', 'content': '#Plan Description# %s' % planDescription}]
+
+def buildRepairMessage(resOfChat2SPaT=None, schemaErrors=None, assemblyError=None, checkCycleLength=True):
+    '''
+    Concise corrective follow-up message from the schema errors, the assembly error, or the warnings of an assembled plan
+    (warningMsgConflictPhases, warningMsgPedWalk, and warningMsgCycleLength if checkCycleLength). Returns None if there is nothing to correct.
+    '''
+    lines = []
+    if schemaErrors != None and len(schemaErrors) > 0:
+        lines.append('Your json does not match the output format:')
+        lines += ['- %s: %s' % (_['path'] if _['path'] != '' else 'json', _['reason']) for _ in schemaErrors[:MAX_ITEMS_IN_MESSAGE]]
+    elif assemblyError != None:
+        lines.append('The plan cannot be assembled from your json (%s). Check the stage / ring structure and the phase attributes.' % assemblyError)
+    elif resOfChat2SPaT != None:
+        for phasePair, intervals in list(resOfChat2SPaT['warningMsgConflictPhases'].items())[:MAX_ITEMS_IN_MESSAGE]:
+            phaseName, phaseConflictName = phasePair.split('|')
+            lines.append('- Conflicting phases %s and %s both have right of way at seconds %s.'
+                         % (phaseName, phaseConflictName, ', '.join('%d-%d' % (t1, t2) for t1, t2 in intervals)))
+        for k, walks in list(resOfChat2SPaT['warningMsgPedWalk'].items())[:MAX_ITEMS_IN_MESSAGE]:
+            lines.append('- The WALK of ped phase %s lasts only %s s; it should be at least 7 s.'
+                         % (k.replace(' WALK too short', ''), ', '.join(str(_) for _ in walks)))
+        if checkCycleLength and len(resOfChat2SPaT['warningMsgCycleLength']) > 0:
+            lines.append('- The phases give a cycle length of %s s, but the cycle length is %s s.'
+                         % (resOfChat2SPaT['warningMsgCycleLength']['actual cycle length'], resOfChat2SPaT['warningMsgCycleLength']['cycle length from chat']))
+        if len(lines) > 0:
+            lines.insert(0, 'The plan assembled from your json is invalid:')
+    if len(lines) == 0:
+        return None
+    lines.append('Please correct result1, result2 and result3 according to the plan description, and output the complete json again.')
+    return '\n'.join(lines)
+
+def runRepairLoop(queryLlm, messages, maxAttempts=3, timeBudget=60, engineName='reference', checkCycleLength=True):
+    '''
+    Query the LLM, assemble its outputs, and re-query with a corrective message until the plan is valid.
+
+    Parameters:
+    queryLlm: callable(messages) -> reply text with the json of result1 / result2 / result3.
+    messages(list): chat history so far (see buildInitialMessages); not modified.
+    maxAttempts: maximum number of queries, the first one included.
+    timeBudget: seconds; no new query is sent once they are spent.
+    checkCycleLength: if True, a plan with warningMsgCycleLength is not accepted either.
+
+    Returns:
+    dict of isValid, resOfChat2SPaT (the first valid plan, else the last assembled one, or None), resStr, attempts,
+    seconds, messages (chat history with the replies and corrective messages) and history (one record per attempt).
+    '''
+    t0 = time.perf_counter()
+    messages = list(messages)
+    res = {'isValid': False, 'resOfChat2SPaT': None, 'resStr': None, 'attempts': 0, 'seconds': 0, 'messages': messages, 'history': []}
+    while res['attempts'] < maxAttempts and time.perf_counter() - t0 < timeBudget:
+        res['attempts'] += 1
+        reply = queryLlm(messages)
+        messages.append({'role': 'assistant', 'content': reply})
+        record = {'attempt': res['attempts'], 'schemaErrors': [], 'assemblyError': None, 'isValid': False}
+        resStr = helper_extractJson(reply)
+        record['schemaErrors'] = validateLlmOutputs(resStr) if resStr != None else [{'path': '', 'reason': 'no json object in the reply'}]
+        resOfChat2SPaT = None
+        if len(record['schemaErrors']) == 0:
+            try:
+                resOfChat2SPaT = assemblePlanWithEngine(resStr, engineName)
+            except Exception as e:
+                record['assemblyError'] = '%s: %s' % (type(e).__name__, e)
+        if resOfChat2SPaT != None:
+            res['resOfChat2SPaT'], res['resStr'] = resOfChat2SPaT, resStr
+        repairMessage = buildRepairMessage(resOfChat2SPaT, record['schemaErrors'], record['assemblyError'], checkCycleLength)
+        record['seconds'] = time.perf_counter() - t0
+        res['history'].append(record)
+        if repairMessage == None:
+            record['isValid'] = res['isValid'] = True
+            break
+        messages.append({'role': 'user', 'content': repairMessage})
+    res['seconds'] = time.perf_counter() - t0
+    return res
+
+def runRepairLoopOnDataset(planDescriptions, queryLlm, promptFile=PROMPT_FILE, slicePrompt=False, **kwargs):
+    '''
+    Run the repair loop for each plan description, and aggregate the time to a valid plan.
+
+    Returns:
+    dict of cases (number), validAtFirstAttempt, repaired, failed, attempts (attempts -> number of valid cases),
+    timeToValid (p50, p90, max seconds of the valid cases) and results (per case: isValid, attempts, seconds).
+    '''
+    results = []
+    for planDescription in planDescriptions:
+        res = runRepairLoop(queryLlm, buildInitialMessages(planDescription, promptFile, slicePrompt), **kwargs)
+        results.append({'isValid': res['isValid'], 'attempts': res['attempts'], 'seconds': res['seconds']})
+    secondsSorted = sorted(_['seconds'] for _ in results if _['isValid'])
+    def percentile(q):
+        return round(secondsSorted[min(len(secondsSorted) - 1, int(q / 100 * len(secondsSorted)))], 4) if len(secondsSorted) > 0 else None
+    dict_attempts = {}
+    for _ in results:
+        if _['isValid']:
+            dict_attempts[_['attempts']] = dict_attempts.get(_['attempts'], 0) + 1
+    return {'cases': len(results), 'validAtFirstAttempt': sum(1 for _ in results if _['isValid'] and _['attempts'] == 1),
+            'repaired': sum(1 for _ in results if _['isValid'] and _['attempts'] > 1), 'failed': sum(1 for _ in results if not _['isValid']),
+            'attempts': dict(sorted(dict_attempts.items())),
+            'timeToValid': {'p50': percentile(50), 'p90': percentile(90), 'max': percentile(100)}, 'results': results}
+
+class StubLlm:
+    '''
+    Local stand-in for an LLM: replays canned replies. The reply to a conversation is chosen by its last plan description
+    and the number of replies already in it, so one stub serves many conversations.
+
+    Parameters:
+    dict_replies: plan description -> list of replies (the last one is repeated).
+    latency: seconds of sleep per query.
+    '''
+    def __init__(self, dict_replies, latency=0):
+        self.dict_replies = dict_replies
+        self.latency = latency
+        self.queries = 0
+
+    def __call__(self, messages):
+        self.queries += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+        descriptions = [_['content'] for _ in messages if _['role'] == 'user' and _['content'].startswith('#Plan Description# ')]
+        replies = self.dict_replies[descriptions[-1][len('#Plan Description# '):]]
+        numReplies = sum(1 for _ in messages if _['role'] == 'assistant')
+        return replies[min(numReplies, len(replies) - 1)]
+
+# helper: the json object in a reply (the text from the first '{' to the last '}', e.g. in a ```json block), or None
+def helper_extractJson(reply):
+    start, end = reply.find('{'), reply.rfind('}')
+    if start < 0 or end < start:
+        return None
+    return reply[start:end + 1]
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='Run the self-repair loop on synthetic cases with a stub LLM.')
+    parser.add_argument('--cases', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per stub query')
+    args = parser.parse_args()
+
+    # Each case: a valid plan, replied after 0-2 bad replies (malformed split, conflicting phases, wrong cycle length)
+    rnd = random.Random(0)
+    dict_replies = {}
+    for i in range(args.cases):
+        res = json.loads(generateSyntheticPlan(seed=i, numStages=4, cycleLength=120))
+        badReplies = []
+        for kind in rnd.sample(['malformed', 'conflict', 'cycleLength'], rnd.choice([0, 1, 1, 2])):
+            bad = json.loads(json.dumps(res))
+            firstStage = bad['result1'][0]['stageStyle'][0]
+            if kind == 'malformed':
+                firstStage[0] = {k: {'split': '%ss' % v['split']} for k, v in firstStage[0].items()}
+            elif kind == 'conflict':
+                phaseNames = [next(iter(_)) for _ in firstStage]
+                firstStage.append({'EBT' if phaseNames[0][0] in 'NS' else 'NBT': dict(firstStage[0][phaseNames[0]])})
+            else:
+                bad['result3'] = res['result3'] + 10
+            badReplies.append('```json\n%s\n```' % json.dumps(bad))
+        dict_replies['synthetic plan %d' % i] = badReplies + ['```json\n%s\n```' % json.dumps(res)]
+
+    stubLlm = StubLlm(dict_replies, latency=args.latency)
+    res = runRepairLoop(stubLlm, buildInitialMessages('synthetic plan 0'), engineName='fast')
+    print('case 0: valid %s after %d attempt(s)' % (res['isValid'], res['attempts']))
+    for message in res['messages'][2:]:
+        if message['role'] == 'user':
+            print('  > ' + message['content'].replace('\n', '\n    '))
+
+    resOfDataset = runRepairLoopOnDataset(list(dict_replies), stubLlm, engineName='fast')
+    print('%d cases: %d valid at the first attempt, %d repaired, %d failed; valid after n attempts %s; time to valid plan %s s'
+          % (resOfDataset['cases'], resOfDataset['validAtFirstAttempt'], resOfDataset['repaired'], resOfDataset['failed'],
+             resOfDataset['attempts'], resOfDataset['timeToValid']))
+    assert resOfDataset['failed'] == 0
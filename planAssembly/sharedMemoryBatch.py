@@ -0,0 +1,173 @@
+# Shared-memory transport of batch results: the workers write the assembled plans of a chunk into one shared memory block,
+# and only a small descriptor (block name and plan offsets) is pickled back to the parent
+#
+# Each plan is written in the binary format of planSerialization.py (movement ids, int8 color matrix, int32 phase stage table,
+# json of the warnings), so the parent reads the color rows as numpy views into the block, without copying.
+# Cleanup: the parent removes the name of a block as soon as it attaches to it; the memory itself is freed once the last plan
+# (view) of the block is garbage collected. A block written for a chunk the parent never reads (the consumer stopped, or an error)
+# is removed when its future completes, and the resource tracker removes what is left if the parent dies.
+#
+# Run: python sharedMemoryBatch.py [--plans 2000] [--cycle-length 480] [--workers 4]
+import collections
+import itertools
+import os
+from multiprocessing import shared_memory
+
+from batchAssembly import assemblePlanOrNone, createAssemblyPool
+from planSerialization import loadPlan, serializePlan
+
+class SharedPlanBlock(shared_memory.SharedMemory):
+    '''
+    Shared memory block of a chunk of plans, attached in the parent. Its name is removed right away; the mapping stays valid
+    while plans read from it (numpy views) are in use, and is released with the last of them.
+    '''
+    def __init__(self, name):
+        super().__init__(name=name)
+        self.unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+        except BufferError:  # views of the block are still in use; the mapping is released with them
+            pass
+
+def assemblePlanChunkToSharedMemory(resStrList):
+    '''
+    Assemble a chunk of plans in a worker, and write them into a new shared memory block.
+
+    Returns:
+    descriptor dict of name (of the block) and offsets (start of each plan in the block, and the end of the last one);
+    a plan that cannot be assembled has an empty range (None in the parent).
+    '''
+    return writePlansToSharedMemory([assemblePlanOrNone(resStr) for resStr in resStrList])
+
+def writePlansToSharedMemory(resOfPlans):
+    '''Write plan objs (or None) into a new shared memory block; returns its descriptor (see assemblePlanChunkToSharedMemory).'''
+    payloads = [serializePlan(_) for _ in resOfPlans]
+    offsets = [0] + list(itertools.accumulate(len(_) for _ in payloads))
+    block = shared_memory.SharedMemory(create=True, size=max(offsets[-1], 1))
+    try:
+        block.buf[:offsets[-1]] = b''.join(payloads)
+    except BaseException:
+        block.close()
+        block.unlink()
+        raise
+    block.close()
+    return {'name': block.name, 'offsets': offsets}
+
+def assemblePlanBatchShared(resStrIter, pool=None, workers=None, chunksize=8, maxPendingChunks=None):
+    '''
+    Same as batchAssembly.assemblePlanBatch, with the results sent back through shared memory: a generator of plan objs
+    (None if the plan cannot be assembled), in the order of the inputs, whose dict_lightColorRec rows are read-only int8 numpy views
+    into shared memory (use list(row), or planSerialization.loadPlan(..., asLists=True) semantics, for json).
+
+    The pool should be created by batchAssembly.createAssemblyPool (which starts the resource tracker before the workers).
+    '''
+    ownPool = pool == None
+    if ownPool:
+        pool = createAssemblyPool(workers)
+    if maxPendingChunks == None:
+        maxPendingChunks = 2 * pool._max_workers
+    pendingChunks = collections.deque()
+    resStrIter = iter(resStrIter)
+    try:
+        while True:
+            while len(pendingChunks) < maxPendingChunks:
+                chunk = list(itertools.islice(resStrIter, chunksize))
+                if len(chunk) == 0:
+                    break
+                pendingChunks.append(pool.submit(assemblePlanChunkToSharedMemory, chunk))
+            if len(pendingChunks) == 0:
+                break
+            for resOfChat2SPaT in readPlansFromSharedMemory(pendingChunks.popleft().result()):
+                yield resOfChat2SPaT
+    finally:
+        for future in pendingChunks:
+            if not future.cancel():
+                future.add_done_callback(helper_removeBlockOfFuture)
+        if ownPool:
+            pool.shutdown()
+
+def readPlansFromSharedMemory(descriptor):
+    '''Plan objs of a shared memory block, as a list; the block name is removed, and its memory freed with the last plan.'''
+    block = SharedPlanBlock(descriptor['name'])
+    offsets = descriptor['offsets']
+    return [loadPlan(block.buf[offsets[i]:offsets[i + 1]].toreadonly()) for i in range(len(offsets) - 1)]
+
+# helper: remove the shared memory block of a chunk that will not be read (done callback of its future)
+def helper_removeBlockOfFuture(future):
+    if future.cancelled() or future.exception() != None:
+        return
+    try:
+        block = shared_memory.SharedMemory(name=future.result()['name'])
+    except FileNotFoundError:
+        return
+    block.close()
+    block.unlink()
+
+if __name__ == '__main__':
+    import argparse
+    import pickle
+    import time
+    from batchAssembly import assemblePlanBatch
+    from planGenerator import generateSyntheticPlans
+
+    parser = argparse.ArgumentParser(description='Batch assembly with results through shared memory, against pickled results.')
+    parser.add_argument('--plans', type=int, default=400)
+    parser.add_argument('--cycle-length', type=int, default=480)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--chunksize', type=int, default=32)
+    args = parser.parse_args()
+
+    resStrList = generateSyntheticPlans(args.plans, cycleLength=args.cycle_length, numStages=8, numPedPhases=4, numOverlapPhases=2)
+    pool = createAssemblyPool(args.workers)
+    try:
+        t0 = time.perf_counter()
+        resOfPlans = list(assemblePlanBatch(resStrList, pool=pool, chunksize=args.chunksize))
+        secondsPickle = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        resOfPlansShared = list(assemblePlanBatchShared(resStrList, pool=pool, chunksize=args.chunksize))
+        secondsShared = time.perf_counter() - t0
+
+        # Same plans; the color rows are views into shared memory
+        for res, resShared in zip(resOfPlans, resOfPlansShared):
+            assert (res == None) == (resShared == None)
+            if res != None:
+                assert {k: list(v) for k, v in resShared['dict_lightColorRec'].items()} == res['dict_lightColorRec']
+                assert resShared['planSchemeMinorMerged'] == res['planSchemeMinorMerged']
+                assert all(resShared[k] == res[k] for k in ['warningMsgConflictPhases', 'warningMsgPedWalk', 'isValid'])
+        row = next(iter(next(_ for _ in resOfPlansShared if _ != None)['dict_lightColorRec'].values()))
+        assert not row.flags['OWNDATA'] and not row.flags['WRITEABLE']
+        print('%d plans, cycle %d s, %d workers: pickled results %.2f s, shared memory %.2f s (%.1fx)'
+              % (args.plans, args.cycle_length, args.workers, secondsPickle, secondsShared, secondsPickle / secondsShared))
+
+        # Transport alone (worker side and parent side, without assembly), per chunk
+        chunks = [resOfPlans[i:i + args.chunksize] for i in range(0, len(resOfPlans), args.chunksize)]
+        t0 = time.perf_counter()
+        buffers = [pickle.dumps(_) for _ in chunks]
+        secondsDumps = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for buf in buffers:
+            pickle.loads(buf)
+        secondsLoads = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        descriptors = [writePlansToSharedMemory(_) for _ in chunks]
+        secondsWrite = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for descriptor in descriptors:
+            readPlansFromSharedMemory(descriptor)
+        secondsRead = time.perf_counter() - t0
+        print('transport of %d chunks: pickle %.0f + %.0f ms (%.1f MB through the pipe); shared memory %.0f + %.0f ms (%.1f KB of descriptors)'
+              % (len(chunks), secondsDumps * 1000, secondsLoads * 1000, sum(len(_) for _ in buffers) / 1e6, secondsWrite * 1000,
+                 secondsRead * 1000, sum(len(pickle.dumps(_)) for _ in descriptors) / 1e3))
+
+        # A consumer stopping early leaves no block behind
+        batch = assemblePlanBatchShared(resStrList, pool=pool, chunksize=args.chunksize)
+        next(batch)
+        batch.close()
+    finally:
+        pool.shutdown()
+    if os.path.isdir('/dev/shm'):
+        del resOfPlansShared, row
+        leftBlocks = [_ for _ in os.listdir('/dev/shm') if _.startswith('psm_')]
+        print('shared memory blocks left: %d' % len(leftBlocks))
@@ -0,0 +1,184 @@
+# Signal state of the movements of an assembled plan at absolute (epoch) times: color, time to the next change, and next green
+#
+# The cycle runs from cycleReferenceTime + offset (and every cycleLength seconds before and after). Each movement gets a change-point
+# table of its cyclic color segments [start, end) (the segment crossing the end of the cycle is unwrapped past cycleLength),
+# and a per-second table of the segment in effect; a query is one modulo and two table lookups, O(1) in the number of segments.
+#
+# Run: python signalStateQuery.py [--queries 1000000]
+import math
+
+import numpy as np
+
+from planEvaluation import helper_getColorMatrixOfCycle
+
+class SignalStateIndex:
+    '''
+    Query index of an assembled plan.
+
+    Parameters:
+    resOfChat2SPaT(dict): the assembled plan obj (full or slim).
+    cycleReferenceTime: epoch time (s) of a cycle start, without offset.
+    offset: seconds from cycleReferenceTime to the cycle start, as the offsets of dayPlanSchedule.
+    greenCodes: color codes counted as green for the next green queries (default green / WALK and permissive).
+    '''
+    def __init__(self, resOfChat2SPaT, cycleReferenceTime=0, offset=0, greenCodes=(2, -1)):
+        self.movementNames, colors = helper_getColorMatrixOfCycle(resOfChat2SPaT['dict_lightColorRec'])
+        if colors.shape[1] == 0:
+            raise ValueError('The plan has no color codes.')
+        self.dict_indexOfMovement = {k: m for m, k in enumerate(self.movementNames)}
+        self.cycleStart = cycleReferenceTime + offset
+        self.cycleLength = C = colors.shape[1]
+        M = len(self.movementNames)
+
+        # Step 1: Change points of each movement
+        tables = [helper_getSegments(colors[m], C, greenCodes) for m in range(M)]
+        K = max(len(_['start']) for _ in tables)
+
+        # Step 2: Segment tables (movements x segments, padded) and per-second tables (movements x seconds)
+        self.segmentColor = np.zeros((M, K), dtype=np.int8)
+        self.segmentNextColor = np.zeros((M, K), dtype=np.int8)
+        self.segmentEnd = np.full((M, K), np.inf)
+        self.segmentGreenStart = np.full((M, K), np.inf)   # start of the current (if green) or next green segment
+        self.segmentGreenEnd = np.full((M, K), np.inf)
+        self.segmentOfSecond = np.zeros((M, C), dtype=np.int32)
+        self.unwrapOfSecond = np.zeros((M, C))  # C for the seconds before the first change point (they belong to the last segment)
+        for m, table in enumerate(tables):
+            k = len(table['start'])
+            self.segmentColor[m, :k] = table['color']
+            self.segmentNextColor[m, :k] = table['nextColor']
+            self.segmentEnd[m, :k] = table['end']
+            self.segmentGreenStart[m, :k] = table['greenStart']
+            self.segmentGreenEnd[m, :k] = table['greenEnd']
+            self.segmentOfSecond[m] = table['segmentOfSecond']
+            self.unwrapOfSecond[m] = table['unwrapOfSecond']
+        # python lists of the same tables, for single queries without numpy scalar overhead
+        self.tables = tables
+
+    def getMovementIndices(self, movementNames):
+        '''Row indices of movement names (an array, for queryBatch).'''
+        return np.array([self.dict_indexOfMovement[_] for _ in movementNames], dtype=np.int32)
+
+    def query(self, movementName, t):
+        '''
+        Signal state of a movement at epoch time t.
+
+        Returns:
+        dict of color (color code), timeToChange (s; inf if the color never changes), nextColor, timeToGreen (s; 0 if green now,
+        inf if never green) and timeToEndOfGreen (s, end of the current or next green).
+        '''
+        table = self.tables[self.dict_indexOfMovement[movementName]]
+        position = (t - self.cycleStart) % self.cycleLength
+        second = int(position)
+        k = table['segmentOfSecond'][second]
+        position += table['unwrapOfSecond'][second]
+        return {'color': table['color'][k], 'timeToChange': table['end'][k] - position, 'nextColor': table['nextColor'][k],
+                'timeToGreen': max(table['greenStart'][k] - position, 0), 'timeToEndOfGreen': table['greenEnd'][k] - position}
+
+    def getState(self, movementName, t):
+        '''Color code of a movement at epoch time t.'''
+        table = self.tables[self.dict_indexOfMovement[movementName]]
+        return table['color'][table['segmentOfSecond'][int((t - self.cycleStart) % self.cycleLength)]]
+
+    def getNextChange(self, movementName, t):
+        '''(epoch time of the next color change, next color code) of a movement; (inf, color) if its color never changes.'''
+        res = self.query(movementName, t)
+        return t + res['timeToChange'], res['nextColor']
+
+    def getNextGreen(self, movementName, t):
+        '''(start, end) epoch times of the current or next green of a movement; start is t if green now, (inf, inf) if never green.'''
+        res = self.query(movementName, t)
+        return t + res['timeToGreen'], t + res['timeToEndOfGreen']
+
+    def queryBatch(self, movementIndices, times):
+        '''
+        Vectorized query of many (movement, t) pairs.
+
+        Parameters:
+        movementIndices: int array of movement rows (see getMovementIndices).
+        times: float array of epoch times, same shape.
+
+        Returns:
+        dict of arrays, as query: color, timeToChange, nextColor, timeToGreen, timeToEndOfGreen.
+        '''
+        movementIndices = np.asarray(movementIndices)
+        positions = np.mod(np.asarray(times, dtype=float) - self.cycleStart, self.cycleLength)
+        seconds = positions.astype(np.int64)
+        k = self.segmentOfSecond[movementIndices, seconds]
+        positions += self.unwrapOfSecond[movementIndices, seconds]
+        return {'color': self.segmentColor[movementIndices, k], 'timeToChange': self.segmentEnd[movementIndices, k] - positions,
+                'nextColor': self.segmentNextColor[movementIndices, k],
+                'timeToGreen': np.maximum(self.segmentGreenStart[movementIndices, k] - positions, 0),
+                'timeToEndOfGreen': self.segmentGreenEnd[movementIndices, k] - positions}
+
+# helper: cyclic color segments of a movement, with the per-second segment table and the current / next green of each segment
+def helper_getSegments(colorsOfCycle, C, greenCodes):
+    colorsOfCycle = [int(_) for _ in colorsOfCycle]
+    changePoints = [s for s in range(C) if colorsOfCycle[s] != colorsOfCycle[s - 1]]
+    if len(changePoints) == 0:  # the color never changes
+        isGreen = colorsOfCycle[0] in greenCodes
+        return {'start': [0], 'end': [math.inf], 'color': [colorsOfCycle[0]], 'nextColor': [colorsOfCycle[0]],
+                'greenStart': [-math.inf if isGreen else math.inf], 'greenEnd': [math.inf],
+                'segmentOfSecond': [0] * C, 'unwrapOfSecond': [0] * C}
+    k = len(changePoints)
+    start = changePoints
+    end = changePoints[1:] + [changePoints[0] + C]
+    color = [colorsOfCycle[s] for s in start]
+    nextColor = color[1:] + color[:1]
+    # current or next green segment of each segment, in the time frame of the segment (later cycles shifted by C)
+    greenStart, greenEnd = [], []
+    for i in range(k):
+        for j in range(i, i + k + 1):
+            if color[j % k] in greenCodes:
+                greenStart.append(start[j % k] + C * (j // k))
+                greenEnd.append(end[j % k] + C * (j // k))
+                break
+        else:
+            greenStart.append(math.inf)
+            greenEnd.append(math.inf)
+    segmentOfSecond, unwrapOfSecond = [], []
+    i = k - 1
+    for s in range(C):
+        if i + 1 < k and s >= start[i + 1] or s == start[0]:
+            i = (i + 1) % k
+        segmentOfSecond.append(i)
+        unwrapOfSecond.append(C if s < start[0] else 0)
+    return {'start': start, 'end': end, 'color': color, 'nextColor': nextColor, 'greenStart': greenStart, 'greenEnd': greenEnd,
+            'segmentOfSecond': segmentOfSecond, 'unwrapOfSecond': unwrapOfSecond}
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from assemblyEngines import assemblePlanWithEngine
+    from batchAssembly import WARM_UP_RES_STR
+
+    parser = argparse.ArgumentParser(description='Signal state queries at epoch times for the example plan.')
+    parser.add_argument('--queries', type=int, default=1000000)
+    args = parser.parse_args()
+
+    resOfChat2SPaT = assemblePlanWithEngine(WARM_UP_RES_STR, 'fast')
+    index = SignalStateIndex(resOfChat2SPaT, cycleReferenceTime=1700000000, offset=17)
+    t = 1700000123.4
+    print('NBT at %.1f: %s, next change %s, next green %s' % (t, index.query('NBT', t), index.getNextChange('NBT', t), index.getNextGreen('NBT', t)))
+
+    # Cross-check with the color codes, second by second
+    rnd = np.random.default_rng(0)
+    movementIndices = rnd.integers(0, len(index.movementNames), args.queries)
+    times = 1700000000 + rnd.uniform(-1e6, 1e6, args.queries)
+    t0 = time.perf_counter()
+    res = index.queryBatch(movementIndices, times)
+    secondsBatch = time.perf_counter() - t0
+    colors = np.array([list(resOfChat2SPaT['dict_lightColorRec'][_]) for _ in index.movementNames])
+    positions = np.floor(times - index.cycleStart).astype(np.int64) % index.cycleLength
+    assert (res['color'] == colors[movementIndices, positions]).all()
+    changed = np.isfinite(res['timeToChange'])
+    positionsAtChange = np.floor(times[changed] + res['timeToChange'][changed] + 1e-6 - index.cycleStart).astype(np.int64) % index.cycleLength
+    assert (colors[movementIndices[changed], positionsAtChange] == res['nextColor'][changed]).all()
+    positionsBeforeChange = (positionsAtChange - 1) % index.cycleLength
+    assert (colors[movementIndices[changed], positionsBeforeChange] == res['color'][changed]).all()
+
+    t0 = time.perf_counter()
+    for i in range(100000):
+        index.query(index.movementNames[movementIndices[i]], times[i])
+    secondsSingle = time.perf_counter() - t0
+    print('%d vectorized queries in %.1f ms (%.0f ns each); single queries %.2f us each'
+          % (args.queries, secondsBatch * 1000, secondsBatch / args.queries * 1e9, secondsSingle / 100000 * 1e6))
@@ -0,0 +1,318 @@
+# Event-driven SPaT scheduler: the assembled plans of many intersections running side by side, producing only state-change events
+#
+# Each plan is compiled once into the change points of its cycle (the seconds where any movement changes color, with the new colors
+# and how long they last); intersections running the same plan share it. The scheduler keeps one heap entry per intersection, for its
+# next change point, so the cost is O(log intersections) per change point and nothing is done between changes.
+# An event is (time, intersectionId, movementName, color, endTime); color None means the movement is no longer in the plan.
+#
+# A plan swap (swapPlan) takes effect at the end of the running cycle: the new plan's cycle starts at that boundary, and the boundary
+# produces the events of the movements whose color or end time changes, from the last second of the old cycle to the first one of the new.
+#
+# Run: python spatScheduler.py [--intersections 10000] [--plans 200] [--hours 1]
+import bisect
+import heapq
+import itertools
+import math
+import time
+
+import numpy as np
+
+from planEvaluation import helper_getColorMatrixOfCycle
+
+def compileChangePoints(resOfChat2SPaT):
+    '''
+    Compile an assembled plan into the change points of its cycle.
+
+    Parameters:
+    resOfChat2SPaT(dict): the assembled plan obj (full or slim).
+
+    Returns:
+    dict of movementNames, cycleLength, colors (int8 array (movements, cycleLength)), changeTimes (sorted seconds of the cycle
+    where any movement changes), changes (for each change time, a tuple of (movementName, new color, seconds the color lasts)),
+    and stateAtCycleStart (movementName -> (color, seconds until its first change); math.inf for a color that never changes).
+    '''
+    movementNames, colors = helper_getColorMatrixOfCycle(resOfChat2SPaT['dict_lightColorRec'])
+    if colors.shape[1] == 0:
+        raise ValueError('The plan has no color codes.')
+    C = colors.shape[1]
+    # Step 1: Change points of each movement (cyclic: position 0 changes if the color differs from the end of the cycle)
+    isChange = colors != np.roll(colors, 1, axis=1)
+    dict_changesOfTime = {}
+    stateAtCycleStart = {}
+    for m, movementName in enumerate(movementNames):
+        positions = np.flatnonzero(isChange[m]).tolist()
+        if len(positions) == 0:
+            stateAtCycleStart[movementName] = (int(colors[m, 0]), math.inf)
+            continue
+        # Step 2: Duration of each color, up to the next change point (the last one wraps into the next cycle)
+        durations = [b - a for a, b in zip(positions, positions[1:] + [positions[0] + C])]
+        for t, duration in zip(positions, durations):
+            dict_changesOfTime.setdefault(t, []).append((movementName, int(colors[m, t]), duration))
+        stateAtCycleStart[movementName] = (int(colors[m, 0]), positions[0] if positions[0] > 0 else durations[0])
+    changeTimes = sorted(dict_changesOfTime)
+    return {'movementNames': movementNames, 'cycleLength': C, 'colors': colors, 'changeTimes': changeTimes,
+            'changes': [tuple(dict_changesOfTime[t]) for t in changeTimes], 'stateAtCycleStart': stateAtCycleStart}
+
+class SpatScheduler:
+    '''
+    State-change events of the signal plans of many intersections, in time order.
+
+    Parameters:
+    startTime: the scheduler time (epoch seconds, or any time base shared with the cycle reference times) to start from;
+               the state at startTime is the initial state (see getState), only later changes produce events.
+    '''
+    def __init__(self, startTime=0):
+        self.now = startTime
+        self.heap = []  # (time of the next change point, entry seq, intersection state); entries of an older seq are stale
+        self.seq = itertools.count()
+        self.dict_stateOfIntersection = {}
+
+    def addIntersection(self, intersectionId, plan, cycleReferenceTime=0, offset=0):
+        '''
+        Add (or replace) an intersection running plan (an assembled plan obj, or a plan compiled by compileChangePoints, which
+        intersections can share), whose cycle starts at cycleReferenceTime + offset (and every cycleLength seconds before and after).
+        '''
+        if intersectionId in self.dict_stateOfIntersection:
+            self.removeIntersection(intersectionId)
+        plan = helper_getCompiledPlan(plan)
+        C = plan['cycleLength']
+        cycleStart = cycleReferenceTime + offset
+        cycleStart += math.floor((self.now - cycleStart) / C) * C
+        # The change points up to now are in effect already
+        state = {'intersectionId': intersectionId, 'plan': plan, 'cycleStart': cycleStart,
+                 'k': bisect.bisect_right(plan['changeTimes'], self.now - cycleStart), 'pendingPlan': None, 'seq': None}
+        self.dict_stateOfIntersection[intersectionId] = state
+        self.helper_scheduleNext(state)
+
+    def removeIntersection(self, intersectionId):
+        state = self.dict_stateOfIntersection.pop(intersectionId)
+        state['seq'] = None
+
+    def swapPlan(self, intersectionId, plan):
+        '''
+        Hot-swap the plan of an intersection at the end of its running cycle; the cycle of the new plan starts at that boundary.
+        A second swap before the boundary replaces the first one.
+        '''
+        state = self.dict_stateOfIntersection[intersectionId]
+        state['pendingPlan'] = helper_getCompiledPlan(plan)
+        plan = state['plan']
+        C = plan['cycleLength']
+        if len(plan['changeTimes']) == 0:
+            # A plan without changes is not in the heap; the boundary is the end of the cycle running now
+            state['cycleStart'] += math.floor((self.now - state['cycleStart']) / C) * C
+            state['k'] = 0
+        elif state['k'] == 0 and state['cycleStart'] > self.now:
+            # The next change point is in the next cycle already: the boundary is still ahead, at its start
+            state['cycleStart'] -= C
+            state['k'] = len(plan['changeTimes'])
+        else:
+            return  # the boundary is scheduled when the last change point of the running cycle is passed
+        self.helper_scheduleNext(state)
+
+    def getState(self, intersectionId):
+        '''Colors of the movements of an intersection at the scheduler time, as dict movementName -> color.'''
+        state = self.dict_stateOfIntersection[intersectionId]
+        plan = state['plan']
+        colors = plan['colors'][:, math.floor(self.now - state['cycleStart']) % plan['cycleLength']]
+        return dict(zip(plan['movementNames'], colors.tolist()))
+
+    def popEvents(self, untilTime):
+        '''
+        Advance the scheduler to untilTime, and return the state-change events up to it (inclusive), in time order, as a list of
+        (time, intersectionId, movementName, color, endTime).
+        '''
+        heap = self.heap
+        events = []
+        while len(heap) > 0 and heap[0][0] <= untilTime:
+            t, seq, state = heap[0]
+            if seq != state['seq']:
+                heapq.heappop(heap)
+                continue
+            intersectionId, plan, k = state['intersectionId'], state['plan'], state['k']
+            if k < len(plan['changeTimes']):
+                events.extend((t, intersectionId, name, color, t + duration) for name, color, duration in plan['changes'][k])
+                state['k'] = k + 1
+            else:
+                events.extend(self.helper_swapAtBoundary(state, t))
+            # The next change point replaces the entry on top of the heap
+            nextTime = self.helper_getNextTime(state)
+            if nextTime == None:
+                heapq.heappop(heap)
+                state['seq'] = None
+            else:
+                state['seq'] = next(self.seq)
+                heapq.heapreplace(heap, (nextTime, state['seq'], state))
+        self.now = max(self.now, untilTime)
+        return events
+
+    def run(self, until=None, speed=1.0, clock=time.time, sleep=time.sleep):
+        '''
+        Generator of the events of each change time (lists, see popEvents), released in real time.
+
+        Parameters:
+        until: scheduler time to stop at (None: run while there are events).
+        speed: simulated seconds per wall second (1.0 real time, 60 one minute per second); None as fast as possible.
+        clock, sleep: wall clock and sleep functions.
+        '''
+        simStart, wallStart = self.now, clock()
+        while len(self.heap) > 0:
+            nextTime = self.heap[0][0]
+            if until != None and nextTime > until:
+                break
+            if speed != None:
+                wait = wallStart + (nextTime - simStart) / speed - clock()
+                if wait > 0:
+                    sleep(wait)
+            events = self.popEvents(nextTime)
+            if len(events) > 0:
+                yield events
+        if until != None:
+            self.now = max(self.now, until)
+
+    # helper: time of the next change point of an intersection (or of the boundary of a pending swap); None if it never changes
+    def helper_getNextTime(self, state):
+        plan = state['plan']
+        changeTimes = plan['changeTimes']
+        if state['k'] == len(changeTimes):
+            if state['pendingPlan'] != None:
+                return state['cycleStart'] + plan['cycleLength']
+            if len(changeTimes) == 0:
+                return None
+            state['cycleStart'] += plan['cycleLength']
+            state['k'] = 0
+        return state['cycleStart'] + changeTimes[state['k']]
+
+    # helper: (re)push the heap entry of an intersection; the previous entry becomes stale
+    def helper_scheduleNext(self, state):
+        nextTime = self.helper_getNextTime(state)
+        state['seq'] = None if nextTime == None else next(self.seq)
+        if nextTime != None:
+            heapq.heappush(self.heap, (nextTime, state['seq'], state))
+
+    # helper: switch to the pending plan at the cycle boundary t; returns the events of the movements whose color differs from the
+    # one showing (the last second of the old cycle), or whose color lasts until another time than the old plan announced
+    def helper_swapAtBoundary(self, state, t):
+        intersectionId = state['intersectionId']
+        planOld, plan = state['plan'], state['pendingPlan']
+        dict_endOfOld = {}  # movementName -> (color showing, end time announced by the old plan)
+        for m, name in enumerate(planOld['movementNames']):
+            color, duration = planOld['stateAtCycleStart'][name]
+            showing = int(planOld['colors'][m, -1])
+            dict_endOfOld[name] = (showing, t if showing != color else t + duration)
+        events = [(t, intersectionId, name, color, t + duration) for name, (color, duration) in plan['stateAtCycleStart'].items()
+                  if dict_endOfOld.get(name) != (color, t + duration)]
+        events.extend((t, intersectionId, name, None, math.inf) for name in dict_endOfOld if name not in plan['stateAtCycleStart'])
+        changeTimes = plan['changeTimes']
+        state.update({'plan': plan, 'cycleStart': t, 'pendingPlan': None,
+                      'k': 1 if len(changeTimes) > 0 and changeTimes[0] == 0 else 0})  # the change at 0 is in the events above
+        return events
+
+# helper: a compiled plan as is, or the plan obj compiled
+def helper_getCompiledPlan(plan):
+    return plan if 'changeTimes' in plan else compileChangePoints(plan)
+
+if __name__ == '__main__':
+    import argparse
+    import random
+    from assemblyEngines import assemblePlanWithEngine
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='City-scale SPaT scheduler benchmark on synthetic plans.')
+    parser.add_argument('--intersections', type=int, default=10000)
+    parser.add_argument('--plans', type=int, default=200)
+    parser.add_argument('--hours', type=float, default=1)
+    parser.add_argument('--engine', default='fast')
+    args = parser.parse_args()
+    random.seed(0)
+
+    # Distinct plans, assembled and compiled once; cycles of 90 to 180 s
+    t0 = time.perf_counter()
+    plans = []
+    for i, cycleLength in enumerate(itertools.islice(itertools.cycle([90, 120, 150, 180]), args.plans)):
+        try:
+            resStr = generateSyntheticPlan(seed=i, cycleLength=cycleLength, numStages=random.randint(2, 6), numPedPhases=2)
+        except ValueError:  # a combination of knobs the generator does not support
+            continue
+        plans.append(compileChangePoints(assemblePlanWithEngine(resStr, args.engine)))
+    print('%d plans assembled and compiled in %.1f s' % (len(plans), time.perf_counter() - t0))
+
+    startTime = 1.7e9
+    scheduler = SpatScheduler(startTime)
+    dict_planOfIntersection = {}
+    for intersectionId in range(args.intersections):
+        dict_planOfIntersection[intersectionId] = plan = random.choice(plans)
+        scheduler.addIntersection(intersectionId, plan, offset=random.randrange(plan['cycleLength']))
+    dict_stateOfIntersection = {_: scheduler.getState(_) for _ in range(100)}
+
+    # Throughput: the events of the simulated hours, as fast as possible
+    t0 = time.perf_counter()
+    numEvents = numBatches = 0
+    sampleEvents = []
+    for events in scheduler.run(until=startTime + args.hours * 3600, speed=None):
+        numEvents += len(events)
+        numBatches += 1
+        sampleEvents.extend(_ for _ in events if _[1] < 100)
+    seconds = time.perf_counter() - t0
+    print('%d intersections, %.1f simulated hours: %d events (%.0f per simulated second) in %.2f s, %.0f events/s (%.0fx real time)'
+          % (args.intersections, args.hours, numEvents, numEvents / (args.hours * 3600), seconds, numEvents / seconds,
+             args.hours * 3600 / seconds))
+
+    # The events replay the color rows of the plans
+    for t, intersectionId, movementName, color, endTime in sampleEvents:
+        stateOfIntersection = dict_stateOfIntersection[intersectionId]
+        assert stateOfIntersection[movementName] != color
+        stateOfIntersection[movementName] = color
+        plan = dict_planOfIntersection[intersectionId]
+        cycleStart = scheduler.dict_stateOfIntersection[intersectionId]['cycleStart']
+        row = plan['colors'][plan['movementNames'].index(movementName)]
+        position = int(t - cycleStart) % plan['cycleLength']
+        assert row[position] == color and row[position - 1] != color
+        assert all(row[int(_ - cycleStart) % plan['cycleLength']] == color for _ in range(int(t), int(min(endTime, t + 600))))
+    for intersectionId, stateOfIntersection in dict_stateOfIntersection.items():
+        assert stateOfIntersection == scheduler.getState(intersectionId)
+
+    # Hot swap: the running cycle completes, then the new plan starts at the boundary
+    planOld, planNew = dict_planOfIntersection[0], next(_ for _ in plans if _['movementNames'] != dict_planOfIntersection[0]['movementNames'])
+    scheduler.popEvents(scheduler.now + 7)
+    boundary = scheduler.dict_stateOfIntersection[0]['cycleStart']
+    boundary += math.ceil((scheduler.now - boundary) / planOld['cycleLength']) * planOld['cycleLength']
+    scheduler.swapPlan(0, planNew)
+    stateOfIntersection = scheduler.getState(0)
+    for t, intersectionId, movementName, color, endTime in scheduler.popEvents(boundary + 2 * planNew['cycleLength']):
+        if intersectionId == 0:
+            plan = planOld if t < boundary else planNew
+            assert t <= boundary or movementName in planNew['movementNames']
+            if color == None:
+                del stateOfIntersection[movementName]
+            else:
+                stateOfIntersection[movementName] = color
+            if t != boundary:
+                assert color == plan['colors'][plan['movementNames'].index(movementName), int(t - boundary) % plan['cycleLength']]
+    assert stateOfIntersection == scheduler.getState(0)
+
+    # Hot swap where second 0 of both plans has the same color: the color showing at the boundary is the one of the old plan's
+    # last second (B red turns green, A changes at 0 in the new plan only), and a color lasting longer is announced again (C)
+    planOld = compileChangePoints({'dict_lightColorRec': {'A': [0] * 10 + [2] * 10, 'B': [2] * 5 + [0] * 15, 'C': [2] * 20}})
+    planNew = compileChangePoints({'dict_lightColorRec': {'A': [2] * 12 + [0] * 8, 'B': [2] * 10 + [0] * 10, 'C': [2] * 15 + [0] * 5}})
+    swapScheduler = SpatScheduler(0)
+    swapScheduler.addIntersection('x', planOld)
+    swapScheduler.popEvents(19.5)
+    assert swapScheduler.getState('x') == {'A': 2, 'B': 0, 'C': 2}  # second 19 of the old cycle
+    swapScheduler.swapPlan('x', planNew)
+    assert sorted(swapScheduler.popEvents(20)) == [(20, 'x', 'A', 2, 32), (20, 'x', 'B', 2, 30), (20, 'x', 'C', 2, 35)]
+    stateOfIntersection = swapScheduler.getState('x')
+    for t in range(21, 60):
+        for _, _, movementName, color, endTime in swapScheduler.popEvents(t):
+            stateOfIntersection[movementName] = color
+        assert stateOfIntersection == swapScheduler.getState('x') == dict(zip(planNew['movementNames'], planNew['colors'][:, t % 20].tolist()))
+    print('hot swap at the cycle boundary: ok')
+
+    # Real time (accelerated): lateness of the events against the wall clock
+    scheduler = SpatScheduler(time.time())
+    for intersectionId in range(args.intersections):
+        plan = dict_planOfIntersection[intersectionId]
+        scheduler.addIntersection(intersectionId, plan, offset=random.randrange(plan['cycleLength']))
+    speed, simStart, wallStart = 60, scheduler.now, time.time()
+    lateness = [time.time() - (wallStart + (events[0][0] - simStart) / speed) for events in scheduler.run(until=simStart + 120, speed=speed)]
+    print('real time x%d over 120 simulated s: %d change times, lateness median %.2f ms, max %.2f ms'
+          % (speed, len(lateness), np.median(lateness) * 1000, max(lateness) * 1000))
@@ -0,0 +1,311 @@
+# Split and cycle length optimizer for an assembled plan: Webster's cycle, and a vectorized grid search minimizing delay
+#
+# The cycle of the assembled plan is cut at the start and end times of the phases in result1 into intervals (the stages of
+# a stage style plan; for a ring style plan, the intervals between the phase changes of all rings). The optimizer changes the
+# interval durations, so the stage / ring structure and barriers are kept, and writes the splits back to result1.
+import copy
+import json
+
+import numpy as np
+
+from Chat2SPaT import convertChatPlanResToSpatParams, helper_getSubValueFromPhase, helper_getDefaultParentPhaseList,\
+    helper_separateCombinedOppositeMovements, phaseNameFormatting
+
+# Phase attributes derived from the splits, removed from the LLM outputs when the splits are written back
+TIME_KEYS = ['STARTTIME', 'ENDTIME', 'GREENTIME', 'SPLIT', 'STARTOFGREEN', 'ENDOFGREEN']
+
+def optimizeSplits(resOfChat2SPaT, dict_movementFlows, cycleMin=40, cycleMax=180, cycleStep=1, numWeightVectors=256,
+                   startupLostTime=2, extensionOfGreen=2, pedWalk=7, maxDegreeOfSaturation=0.95, seed=0, resStr=None):
+    '''
+    Optimize the cycle length and splits of an assembled plan for the given movement flows.
+
+    Parameters:
+    resOfChat2SPaT(dict): the assembled plan obj (convertChatPlanResToSpatParams); its resStr holds the stage / ring structure.
+                          A slim plan obj (slimPlanRes) has no resStr: pass the LLM outputs as resStr.
+    dict_movementFlows(dict): movement -> {'flow': veh/h, 'saturationFlow': veh/h (default 1800)}, or movement -> flow;
+                              the movements are the formatted phase names, e.g. {'NBT': {'flow': 600, 'saturationFlow': 3600}}.
+    cycleMin, cycleMax, cycleStep: cycle lengths of the grid.
+    numWeightVectors: split vectors per cycle length (current plan, flow-proportional, even, and random ones around them).
+    startupLostTime, extensionOfGreen: lost time of a movement = startupLostTime + clearance (yellow, allRed, redAmber,
+                                       lateStart, earlyCutOff) - extensionOfGreen.
+    pedWalk: minimum WALK of ped phases (s), as checked by checkPedWalkIntvl.
+    maxDegreeOfSaturation: candidates with a movement above this v/c are infeasible.
+    resStr(str or dict): the LLM outputs the plan obj is assembled from (assembled again here for the start and end times of
+                         the phases); None to use resOfChat2SPaT['resStr'], which already has them.
+
+    Returns:
+    dict of 'minDelay' and 'webster' results, each with cycleLength, splits (of the intervals), avgDelay (s/veh),
+    degreeOfSaturation (movement -> v/c) and resStr (LLM outputs with the new splits, to be assembled by convertChatPlanResToSpatParams),
+    and 'candidates' (number of cycle length and split vectors evaluated). 'webster' is None if the flows exceed the capacity.
+    '''
+    rnd = np.random.default_rng(seed)
+    if resStr != None:
+        res = convertChatPlanResToSpatParams(resStr, plot=False, verbose=False)['resStr']
+    elif 'resStr' in resOfChat2SPaT:
+        res = copy.deepcopy(resOfChat2SPaT['resStr'])
+    else:
+        raise ValueError('The plan obj has no resStr (slim plan obj): pass the LLM outputs as resStr.')
+    cycleLength = len(next(iter(resOfChat2SPaT['dict_lightColorRec'].values())))
+
+    # Step 1: Phases of result1 and intervals of the cycle
+    phaseList = helper_getPhasesInResult1(res['result1'])
+    if len(phaseList) == 0:
+        raise ValueError('No phase with start and end time in result1.')
+    boundaries = sorted(set([0] + [_[1] for _ in phaseList] + [_[2] % cycleLength for _ in phaseList]))
+    intervals = [[boundaries[i], boundaries[i + 1] if i + 1 < len(boundaries) else cycleLength] for i in range(len(boundaries))]
+    # incidence of phases on intervals
+    phaseIncidence = np.zeros((len(phaseList), len(intervals)))
+    for p, (phaseNames, startTime, endTime, phaseInfo) in enumerate(phaseList):
+        for k, (t1, t2) in enumerate(intervals):
+            if helper_intervalInPhase(t1, startTime, endTime, cycleLength):
+                phaseIncidence[p, k] = 1
+    isGap = phaseIncidence.sum(axis=0) == 0  # intervals without phase, dropped when written back
+    currentDurations = np.array([t2 - t1 for t1, t2 in intervals], dtype=float)
+
+    # Step 2: Movements (formatted phase names) with their intervals, lost times and min splits
+    dict_movements = {}
+    phaseMinSplits = np.zeros(len(phaseList))
+    for p, (phaseNames, startTime, endTime, phaseInfo) in enumerate(phaseList):
+        dict_phaseTimes = {k: helper_getSubValueFromPhase(k, {'_': phaseInfo}) for k in
+                           ['yellow', 'allRed', 'redAmber', 'lateStart', 'earlyCutOff', 'minGreen', 'countDown']}
+        clearance = sum(dict_phaseTimes[k] for k in ['yellow', 'allRed', 'redAmber', 'lateStart', 'earlyCutOff'])
+        for phaseName in phaseNames:
+            if '行人' in phaseName or 'PED' in phaseName:  # WALK = split - lateStart - countDown - allRed - earlyCutOff (paintLightColorRec)
+                minSplit = pedWalk + sum(dict_phaseTimes[k] for k in ['lateStart', 'countDown', 'allRed', 'earlyCutOff'])
+            else:
+                minSplit = dict_phaseTimes['minGreen'] + clearance
+            phaseMinSplits[p] = max(phaseMinSplits[p], minSplit)
+            movement = dict_movements.setdefault(phaseName, {'incidence': np.zeros(len(intervals)), 'clearance': 0, 'redAmberAndAllRed': 0})
+            movement['incidence'] = np.maximum(movement['incidence'], phaseIncidence[p])
+            movement['clearance'] = max(movement['clearance'], clearance)
+            movement['redAmberAndAllRed'] = max(movement['redAmberAndAllRed'], dict_phaseTimes['redAmber'] + dict_phaseTimes['allRed'])
+
+    # Ped phases following parent movements (result2): WALK within each occurrence of each parent;
+    # the ped phase takes the split of the parent, with the redAmber of the parent added to its lateStart, and the allRed of the parent
+    constraintIncidence = list(phaseIncidence)
+    constraintMins = list(phaseMinSplits)
+    for phase in res['result2']:
+        phaseName = phaseNameFormatting(helper_getSubValueFromPhase('phaseName', phase))
+        if ('行人' not in phaseName and 'PED' not in phaseName) or phaseName in dict_movements:
+            continue
+        parentPhaseName = helper_getSubValueFromPhase('parentPhase', phase)
+        if parentPhaseName in (None, 'default'):
+            parentPhaseNames = helper_getDefaultParentPhaseList(phaseName)
+        else:  # the assembler records the parent phases as a list
+            parentPhaseNames = parentPhaseName if type(parentPhaseName) == list else str(parentPhaseName).split(',')
+            parentPhaseNames = [phaseNameFormatting(_.strip()) for _ in parentPhaseNames]
+        for parent in [dict_movements[_] for _ in parentPhaseNames if _ in dict_movements]:
+            for incidence in helper_getOccurrences(parent['incidence']):
+                constraintIncidence.append(incidence)
+                constraintMins.append(pedWalk + sum(helper_getSubValueFromPhase(k, phase) for k in ['lateStart', 'countDown', 'earlyCutOff'])
+                                      + parent['redAmberAndAllRed'])
+    constraintIncidence = np.array(constraintIncidence)
+    constraintMins = np.array(constraintMins)
+
+    # Flows of the movements
+    movementNames = [_ for _ in dict_movementFlows if _ in dict_movements]
+    if len(movementNames) == 0:
+        raise ValueError('None of the movements in dict_movementFlows is in the plan: %s' % list(dict_movements))
+    flows = np.array([helper_getFlow(dict_movementFlows[_])[0] for _ in movementNames]) / 3600  # veh/s
+    saturationFlows = np.array([helper_getFlow(dict_movementFlows[_])[1] for _ in movementNames]) / 3600
+    movementIncidence = np.array([dict_movements[_]['incidence'] for _ in movementNames])
+    lostTimes = np.array([startupLostTime + dict_movements[_]['clearance'] - extensionOfGreen for _ in movementNames])
+    flowRatios = flows / saturationFlows
+
+    # Step 3: Min durations of the intervals (satisfying all min splits), and split weight vectors
+    minDurations = helper_calcMinDurations(constraintIncidence, constraintMins, currentDurations)
+    # flow-proportional weights: each movement asks for its flow ratio, spread over its intervals as in the current plan
+    shareOfIntervals = movementIncidence * currentDurations / np.maximum((movementIncidence * currentDurations).sum(axis=1, keepdims=True), 1e-9)
+    demandWeights = (flowRatios[:, None] * shareOfIntervals).max(axis=0)
+    baseWeights = np.array([currentDurations, demandWeights, np.ones(len(intervals))])
+    baseWeights[:, isGap] = 0
+    baseWeights = baseWeights / np.maximum(baseWeights.sum(axis=1, keepdims=True), 1e-9)
+    numRandom = max(numWeightVectors - len(baseWeights), 0)
+    centers = baseWeights[rnd.integers(0, 2, numRandom)]  # random vectors around the current and flow-proportional weights
+    randomWeights = np.array([rnd.dirichlet(20 * c + 0.05) if c.sum() > 0 else c for c in centers]).reshape(numRandom, len(intervals))
+    randomWeights[:, isGap] = 0
+    weights = np.concatenate([baseWeights, randomWeights / np.maximum(randomWeights.sum(axis=1, keepdims=True), 1e-9)])
+
+    # Step 4: Grid of cycle lengths x weight vectors, with integer durations
+    cycles = np.arange(cycleMin, cycleMax + 1, cycleStep, dtype=float)
+    durations = helper_calcIntegerDurations(cycles, weights, minDurations, isGap)   # (cycles, weights, intervals)
+    avgDelays, degreesOfSaturation = helper_calcDelay(durations, cycles, movementIncidence, lostTimes, flows, saturationFlows)
+    feasible = (durations.sum(axis=-1) == cycles[:, None]) &\
+               np.all(durations @ constraintIncidence.T >= constraintMins - 1e-9, axis=-1) &\
+               np.all(degreesOfSaturation <= maxDegreeOfSaturation, axis=-1)
+    avgDelays = np.where(feasible, avgDelays, np.inf)
+    if not np.isfinite(avgDelays).any():
+        raise ValueError('No feasible cycle length and splits in [%s, %s] for the flows (v/c <= %s).' % (cycleMin, cycleMax, maxDegreeOfSaturation))
+    i, j = np.unravel_index(np.argmin(avgDelays), avgDelays.shape)
+
+    resOfOptimizer = {'candidates': int(avgDelays.size),
+                      'minDelay': helper_summarizeCandidate(res, phaseList, intervals, cycleLength, durations[i, j], int(cycles[i]),
+                                                            avgDelays[i, j], degreesOfSaturation[i, j], movementNames)}
+
+    # Step 5: Webster's cycle length, C0 = (1.5L + 5) / (1 - Y), with flow-proportional splits
+    sumOfCriticalRatios = demandWeights.sum()
+    sumOfLostTimes = helper_calcLostTimeOfCycle(movementIncidence, lostTimes)
+    resOfOptimizer['webster'] = None
+    if sumOfCriticalRatios < 1:
+        cycleWebster = int(round(min(max((1.5 * sumOfLostTimes + 5) / (1 - sumOfCriticalRatios), minDurations.sum()), cycleMax * 2)))
+        durationsWebster = helper_calcIntegerDurations(np.array([float(cycleWebster)]), baseWeights[1:2], minDurations, isGap)
+        avgDelayWebster, degreeOfSaturationWebster = helper_calcDelay(durationsWebster, np.array([float(cycleWebster)]),
+                                                                     movementIncidence, lostTimes, flows, saturationFlows)
+        resOfOptimizer['webster'] = helper_summarizeCandidate(res, phaseList, intervals, cycleLength, durationsWebster[0, 0], cycleWebster,
+                                                              avgDelayWebster[0, 0], degreeOfSaturationWebster[0, 0], movementNames)
+    return resOfOptimizer
+
+# helper: phases of result1 with their formatted names and start and end times, in the order of result1
+def helper_getPhasesInResult1(result1):
+    '''Returns list of [phaseNames (formatted and separated), startTime, endTime, phaseInfo]; phaseInfo is the phase obj in result1 itself.'''
+    res = []
+    if type(result1) == dict:
+        result1 = [{k: result1[k]} for k in result1]
+    for obj in result1:
+        if type(obj) == list:
+            res += helper_getPhasesInResult1(obj)
+        elif type(obj) == dict:
+            for k in obj:
+                if k in ('stageStyle', 'ringStyle'):
+                    res += helper_getPhasesInResult1(obj[k] if type(obj[k]) == list else [obj[k]])
+                elif type(obj[k]) == dict:
+                    startTime = helper_getSubValueFromPhase('startTime', {k: obj[k]})
+                    endTime = helper_getSubValueFromPhase('endTime', {k: obj[k]})
+                    if type(startTime) == int and type(endTime) == int:
+                        res.append([helper_separateCombinedOppositeMovements(phaseNameFormatting(k)), startTime, endTime, obj[k]])
+    return res
+
+# helper: whether the interval starting at t lies in the phase from startTime to endTime (cyclic)
+def helper_intervalInPhase(t, startTime, endTime, cycleLength):
+    startTime, endTime = startTime % cycleLength, endTime % cycleLength
+    if startTime < endTime:
+        return startTime <= t < endTime
+    return t >= startTime or t < endTime  # the phase crosses the end of the cycle, or lasts the whole cycle
+
+# helper: split the intervals of a movement into its occurrences (runs of consecutive intervals, cyclic)
+def helper_getOccurrences(incidence):
+    '''incidence = [1, 1, 0, 1] -> [[1, 1, 0, 1]] (one occurrence crossing the end of the cycle); [1, 0, 1, 0] -> [[0, 0, 1, 0], [1, 0, 0, 0]]'''
+    n = len(incidence)
+    if incidence.all():
+        return [incidence.copy()]
+    occurrences = []
+    start = next(k for k in range(n) if incidence[k] == 0)  # begin the scan at an interval without the movement
+    intervalsOfOccurrence = []
+    for i in range(1, n + 1):
+        k = (start + i) % n
+        if incidence[k] == 1:
+            intervalsOfOccurrence.append(k)
+        elif len(intervalsOfOccurrence) > 0:
+            occurrence = np.zeros(n)
+            occurrence[intervalsOfOccurrence] = 1
+            occurrences.append(occurrence)
+            intervalsOfOccurrence = []
+    return occurrences
+
+# helper: flow and saturation flow of a movement
+def helper_getFlow(flowOfMovement):
+    if type(flowOfMovement) == dict:
+        return flowOfMovement['flow'], flowOfMovement.get('saturationFlow', 1800)
+    return flowOfMovement, 1800
+
+# helper: smallest interval durations satisfying every min split, growing the intervals as in the current plan
+def helper_calcMinDurations(constraintIncidence, constraintMins, currentDurations):
+    minDurations = np.zeros(len(currentDurations))
+    for incidence, minSplit in zip(constraintIncidence, constraintMins):
+        deficit = minSplit - incidence @ minDurations
+        if deficit > 0:
+            share = incidence * currentDurations
+            share = share / share.sum() if share.sum() > 0 else incidence / max(incidence.sum(), 1)
+            minDurations += np.ceil(deficit * share)
+    return minDurations
+
+# helper: integer interval durations for every cycle length and weight vector, summing up to the cycle length
+def helper_calcIntegerDurations(cycles, weights, minDurations, isGap):
+    '''Durations = minDurations + (cycle - sum of minDurations) * weights, rounded by the largest remainder method.
+    Returns array of shape (cycles, weights, intervals); cycles shorter than the sum of minDurations give a sum above the cycle length.'''
+    spare = np.maximum(cycles - minDurations.sum(), 0)
+    durationsFloat = minDurations + spare[:, None, None] * weights[None, :, :]
+    durations = np.floor(durationsFloat)
+    remainder = np.rint(np.maximum(cycles[:, None], minDurations.sum()) - durations.sum(axis=-1))
+    fraction = np.where(isGap, -1, durationsFloat - durations)
+    ranks = np.argsort(np.argsort(-fraction, axis=-1), axis=-1)
+    return durations + (ranks < remainder[..., None])
+
+# helper: Webster's delay (s/veh, flow-weighted average) and v/c of the movements, for arrays of interval durations
+def helper_calcDelay(durations, cycles, movementIncidence, lostTimes, flows, saturationFlows):
+    cycles = cycles.reshape((-1,) + (1,) * (durations.ndim - 1))
+    effectiveGreens = np.maximum(durations @ movementIncidence.T - lostTimes, 1e-9)
+    greenRatios = np.minimum(effectiveGreens / cycles, 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        degreesOfSaturation = flows / (saturationFlows * greenRatios)
+        x = np.minimum(degreesOfSaturation, 0.999)
+        delays = cycles * (1 - greenRatios) ** 2 / (2 * (1 - greenRatios * x)) +\
+                 x ** 2 / (2 * np.maximum(flows, 1e-9) * (1 - x)) -\
+                 0.65 * (cycles / np.maximum(flows, 1e-9) ** 2) ** (1 / 3) * x ** (2 + 5 * greenRatios)
+    delays = np.maximum(delays, 0)
+    avgDelays = (delays * flows).sum(axis=-1) / max(flows.sum(), 1e-9)
+    return avgDelays, degreesOfSaturation
+
+# helper: lost time per cycle, summing the lost times of the movements ending at each interval boundary (the largest one)
+def helper_calcLostTimeOfCycle(movementIncidence, lostTimes):
+    n = movementIncidence.shape[1]
+    lostTimeAtBoundary = np.zeros(n)
+    for incidence, lostTime in zip(movementIncidence, lostTimes):
+        for k in range(n):
+            if incidence[k] == 1 and incidence[(k + 1) % n] == 0:  # the movement ends after interval k
+                lostTimeAtBoundary[k] = max(lostTimeAtBoundary[k], lostTime)
+    return lostTimeAtBoundary.sum()
+
+# helper: result of one candidate, with the LLM outputs carrying its splits
+def helper_summarizeCandidate(res, phaseList, intervals, cycleLength, durations, cycle, avgDelay, degreesOfSaturation, movementNames):
+    return {'cycleLength': cycle, 'splits': [int(_) for _ in durations], 'avgDelay': round(float(avgDelay), 2),
+            'degreeOfSaturation': {k: round(float(v), 3) for k, v in zip(movementNames, degreesOfSaturation)},
+            'resStr': writeSplitsToResStr(res, phaseList, intervals, cycleLength, durations, cycle)}
+
+def writeSplitsToResStr(res, phaseList, intervals, cycleLength, durations, cycle):
+    '''
+    LLM outputs (json str) with the splits of the phases in result1 set from the new interval durations, and result3 = cycle.
+    The start, end and green times derived from the old splits are removed (the assembler places the phases one after another),
+    also from result2 for the phases of result1, and the parent phases filled in by the assembler are restored.
+    '''
+    res = copy.deepcopy(res)
+    phaseListCopy = helper_getPhasesInResult1(res['result1'])
+    namesInResult1 = set([])
+    for (phaseNames, startTime, endTime, phaseInfo), (_, _, _, phaseInfoCopy) in zip(phaseList, phaseListCopy):
+        split = sum(int(durations[k]) for k, (t1, t2) in enumerate(intervals) if helper_intervalInPhase(t1, startTime, endTime, cycleLength))
+        for k in [_ for _ in phaseInfoCopy if _.replace(' ', '').upper() in TIME_KEYS]:
+            del phaseInfoCopy[k]
+        phaseInfoCopy.update({'split': split})
+        namesInResult1.update(phaseNames)
+    for phase in res['result2'] if type(res['result2']) == list else [{k: res['result2'][k]} for k in res['result2']]:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        if phaseNameFormatting(phaseName) in namesInResult1 and type(phase[phaseName]) == dict:
+            for k in [_ for _ in phase[phaseName] if _.replace(' ', '').upper() in TIME_KEYS]:
+                del phase[phaseName][k]
+        # the assembler replaces parentPhase 'default' by the list of default parent phases
+        parentPhaseName = helper_getSubValueFromPhase('parentPhase', phase) if type(phase[phaseName]) == dict else None
+        if type(parentPhaseName) == list:
+            isDefault = parentPhaseName == helper_getDefaultParentPhaseList(phaseNameFormatting(phaseName))
+            phase[phaseName].update({'parentPhase': 'default' if isDefault else ', '.join(parentPhaseName)})
+    res['result3'] = cycle
+    return json.dumps(res, ensure_ascii=False)
+
+if __name__ == '__main__':
+    from batchAssembly import WARM_UP_RES_STR
+    resOfChat2SPaT = convertChatPlanResToSpatParams(WARM_UP_RES_STR, plot=False, verbose=False)
+    dict_movementFlows = {'NBL': 180, 'SBL': 260, 'SBT': {'flow': 900, 'saturationFlow': 3600}, 'NBT': {'flow': 700, 'saturationFlow': 3600},
+                          'EBL': 150, 'WBL': 120, 'EBT': {'flow': 800, 'saturationFlow': 3600}, 'WBT': {'flow': 650, 'saturationFlow': 3600}}
+    resOfOptimizer = optimizeSplits(resOfChat2SPaT, dict_movementFlows)
+    print('%d candidates evaluated' % resOfOptimizer['candidates'])
+    for k in ['webster', 'minDelay']:
+        if resOfOptimizer[k] == None:
+            continue
+        resOfNewPlan = convertChatPlanResToSpatParams(resOfOptimizer[k]['resStr'], plot=False, verbose=False)
+        print('%-8s cycle %3d  splits %s  delay %.1f s/veh  valid %d' % (k, resOfOptimizer[k]['cycleLength'], resOfOptimizer[k]['splits'],
+                                                                       resOfOptimizer[k]['avgDelay'], resOfNewPlan['isValid']))
+        print('         v/c %s' % resOfOptimizer[k]['degreeOfSaturation'])
+
+    # A slim plan obj, with the LLM outputs given separately, is optimized the same
+    resOfSlim = convertChatPlanResToSpatParams(WARM_UP_RES_STR, plot=False, verbose=False, slim=True)
+    resOfOptimizerSlim = optimizeSplits(resOfSlim, dict_movementFlows, resStr=WARM_UP_RES_STR)
+    assert resOfOptimizerSlim == resOfOptimizer
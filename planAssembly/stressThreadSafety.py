@@ -0,0 +1,110 @@
+# Concurrent stress test of plan assembly in a thread pool: many threads assemble (and draw) the same shared, already parsed
+# LLM outputs at once, with both engines; every result must equal the sequential one, and the inputs and the global matplotlib
+# state must be unchanged afterwards.
+#
+# On a free-threaded CPython build (e.g. python3.13t), the threads run truly in parallel; on a GIL build, a tiny switch
+# interval makes the threads interleave inside the assembly steps.
+#
+# Run: python stressThreadSafety.py [--plans 200] [--tasks 2000] [--threads 16] [--no-plot]
+import io
+import json
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from assemblyEngines import assemblePlanWithEngine, compareAssemblyResults
+
+def runStressTest(resList, tasks=2000, threads=16, engineNames=('reference', 'fast'), plot=True, seed=0):
+    '''
+    Assemble randomly chosen plans of resList (parsed LLM outputs, shared by all threads) in a thread pool,
+    and compare each result with the sequential result of the same plan and engine.
+
+    Parameters:
+    resList(list): parsed LLM outputs (dicts); the ones that cannot be assembled are skipped.
+    tasks: number of assemblies run in the pool.
+    plot: also draw the signal times table of every tenth task (needs matplotlib).
+
+    Returns:
+    dict of tasks, threads, gilEnabled, seconds, mismatches (task count), errors (task count, with the first error messages),
+    inputsModified (number of plans of resList modified) and rcParamsModified (bool, None without plot).
+    '''
+    # Step 1: Sequential results, and snapshots of the inputs and of the matplotlib state
+    dict_expected = {}
+    for i, res in enumerate(resList):
+        for engineName in engineNames:
+            try:
+                dict_expected[(i, engineName)] = assemblePlanWithEngine(res, engineName, countdownTables=True)
+            except Exception:
+                pass
+    keys = sorted(dict_expected)
+    if len(keys) == 0:
+        raise ValueError('None of the plans can be assembled.')
+    inputSnapshots = [json.dumps(_, sort_keys=True) for _ in resList]
+    rcParamsSnapshot = None
+    if plot == True:
+        import matplotlib
+        from Chat2SPaT import plotPlanScheme
+        rcParamsSnapshot = dict(matplotlib.rcParams)
+
+    # Step 2: Concurrent runs
+    rnd = random.Random(seed)
+    taskKeys = [keys[rnd.randrange(len(keys))] for _ in range(tasks)]
+    def runTask(taskNum):
+        i, engineName = taskKeys[taskNum]
+        resOfChat2SPaT = assemblePlanWithEngine(resList[i], engineName, countdownTables=True)
+        expected = dict_expected[(i, engineName)]
+        mismatches = compareAssemblyResults(expected, resOfChat2SPaT)
+        if resOfChat2SPaT['dict_countdownTables'] != expected['dict_countdownTables']:
+            mismatches.append('dict_countdownTables')
+        if plot == True and taskNum % 10 == 0:
+            cycleLength = len(next(iter(resOfChat2SPaT['dict_lightColorRec'].values())))
+            plotPlanScheme(resOfChat2SPaT['planSchemeMinorMerged'], cycleLength).savefig(io.BytesIO(), format='png')
+        return mismatches
+
+    switchInterval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)
+    t0 = time.perf_counter()
+    mismatches, errors = 0, []
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            for future in [pool.submit(runTask, taskNum) for taskNum in range(tasks)]:
+                try:
+                    if len(future.result()) > 0:
+                        mismatches += 1
+                except Exception as e:
+                    errors.append('%s: %s' % (type(e).__name__, e))
+    finally:
+        sys.setswitchinterval(switchInterval)
+    seconds = time.perf_counter() - t0
+
+    # Step 3: Inputs and global state after the runs
+    inputsModified = sum(1 for res, snapshot in zip(resList, inputSnapshots) if json.dumps(res, sort_keys=True) != snapshot)
+    rcParamsModified = None
+    if plot == True:
+        rcParamsModified = any(matplotlib.rcParams[k] != v for k, v in rcParamsSnapshot.items())
+    return {'tasks': tasks, 'threads': threads, 'gilEnabled': getattr(sys, '_is_gil_enabled', lambda: True)(), 'seconds': seconds,
+            'mismatches': mismatches, 'errors': len(errors), 'firstErrors': errors[:5], 'inputsModified': inputsModified,
+            'rcParamsModified': rcParamsModified}
+
+if __name__ == '__main__':
+    import argparse
+    import logging
+    from batchAssembly import WARM_UP_RES_STR
+    from planGenerator import generateSyntheticPlans
+
+    parser = argparse.ArgumentParser(description='Assemble shared plans concurrently in a thread pool and check the results.')
+    parser.add_argument('--plans', type=int, default=200)
+    parser.add_argument('--tasks', type=int, default=2000)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--no-plot', action='store_true', help='do not draw figures in the threads')
+    args = parser.parse_args()
+
+    logging.getLogger('matplotlib.font_manager').setLevel(logging.ERROR)  # fonts of Chinese phase names may be missing
+    resList = [json.loads(WARM_UP_RES_STR)] + [json.loads(_) for _ in generateSyntheticPlans(args.plans, formatErrorRate=0.3,
+                                                                                                numPedPhases=2, numOverlapPhases=2)]
+    res = runStressTest(resList, tasks=args.tasks, threads=args.threads, plot=not args.no_plot)
+    print('Python %s, GIL %s: %d tasks in %d threads, %.1f s; %d mismatches, %d errors %s; %d inputs modified; rcParams modified %s'
+          % (sys.version.split()[0], 'enabled' if res['gilEnabled'] else 'disabled', res['tasks'], res['threads'], res['seconds'],
+             res['mismatches'], res['errors'], res['firstErrors'], res['inputsModified'], res['rcParamsModified']))
+    assert res['mismatches'] == 0 and res['errors'] == 0 and res['inputsModified'] == 0 and res['rcParamsModified'] != True
@@ -0,0 +1,146 @@
+# Signal timing diagram as SVG / HTML, built with plain strings (no matplotlib needed)
+from xml.sax.saxutils import escape
+
+from Chat2SPaT import helper_getSubValueFromPhase, helper_getPhasePlotRows, helper_getPhasePlotRectangles, helper_getXtickList,\
+    helper_modifyCyclicTimepoint, getPhasePlotLabelAndRotation, calcFontsizeModifier, getCycleLengthOfPlanScheme
+
+# Layout of the matplotlib figure in convertChatPlanResToSpatParams (figure size in inches, default axes position)
+FIG_W, FIG_H = 12, 8
+AXES_LEFT, AXES_RIGHT, AXES_BOTTOM, AXES_TOP = 0.125, 0.9, 0.11, 0.88
+UNIT_HEIGHT, SPACE_BTW_BARS = 1, 0.1
+
+def convertPlanResToSvg(resOfChat2SPaT, dpi=80):
+    '''
+    Draw the signal times table of a generated plan as an SVG string, the same diagram as the plot of convertChatPlanResToSpatParams.
+
+    Parameters:
+    resOfChat2SPaT(dict): The generated plan obj by convertChatPlanResToSpatParams.
+    dpi: pixels per inch of the figure (and 1pt = dpi/72 px for the fonts).
+
+    Returns:
+    svg(str): the <svg> element.
+    '''
+    # The stored planSchemeMinorMerged keeps the dummy phases; they are removed before plotting, as in convertChatPlanResToSpatParams
+    planScheme = [_ for _ in resOfChat2SPaT['planSchemeMinorMerged'] if helper_getSubValueFromPhase('phaseName', _) != 'DUMMYPHASE']
+    dict_lightColorRec = resOfChat2SPaT['dict_lightColorRec']
+    if len(dict_lightColorRec) > 0:
+        cycleLength = len(next(iter(dict_lightColorRec.values())))
+    else:
+        cycleLength = getCycleLengthOfPlanScheme(planScheme)
+
+    planSchemeSorted, dict_rowOfPhases = helper_getPhasePlotRows(planScheme)
+    phasePlotNum = len(dict_rowOfPhases)
+    fontsizeModifier = calcFontsizeModifier(FIG_H, phasePlotNum)
+    ptToPx = dpi / 72
+
+    # Data limits with the default 5% margins of matplotlib: x in [0, cycleLength], y in [1, phasePlotNum + bar height]
+    width, height = FIG_W * dpi, FIG_H * dpi
+    axX0, axX1 = AXES_LEFT * width, AXES_RIGHT * width
+    axY0, axY1 = (1 - AXES_TOP) * height, (1 - AXES_BOTTOM) * height
+    xMin, xMax = -0.05 * cycleLength, 1.05 * cycleLength
+    yLow, yHigh = UNIT_HEIGHT, UNIT_HEIGHT * phasePlotNum + UNIT_HEIGHT - SPACE_BTW_BARS
+    yMin, yMax = yLow - 0.05 * (yHigh - yLow), yHigh + 0.05 * (yHigh - yLow)
+    if yMax == yMin:  # no phase to draw
+        yMin, yMax = 0, 1
+    scaleX = (axX1 - axX0) / (xMax - xMin)
+    scaleY = (axY1 - axY0) / (yMax - yMin)
+
+    def toPx(t, y):
+        return axX0 + (t - xMin) * scaleX, axY1 - (y - yMin) * scaleY
+
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="0 0 %d %d">' % (width, height, width, height),
+           '<rect width="%d" height="%d" fill="white"/>' % (width, height)]
+
+    # Bars of the phases
+    for phaseName in dict_rowOfPhases:
+        y1 = UNIT_HEIGHT * (phasePlotNum - dict_rowOfPhases[phaseName])
+        helper_appendSvgRectangleInCycle(svg, toPx, 0, cycleLength, y1, UNIT_HEIGHT - SPACE_BTW_BARS, cycleLength, 'red')
+    labels = []
+    for phase in planSchemeSorted:
+        phaseName = helper_getSubValueFromPhase('phaseName', phase)
+        startTime = helper_getSubValueFromPhase('startTime', phase)
+        lateStart = helper_getSubValueFromPhase('lateStart', phase)
+        redAmber = helper_getSubValueFromPhase('redAmber', phase)
+        y1 = UNIT_HEIGHT * (phasePlotNum - dict_rowOfPhases[phaseName])
+        barHeight = UNIT_HEIGHT - SPACE_BTW_BARS
+        for t1, duration, color, barPart in helper_getPhasePlotRectangles(phase, cycleLength):
+            if barPart == 'lower':
+                helper_appendSvgRectangleInCycle(svg, toPx, t1, duration, y1, 0.5 * barHeight, cycleLength, color)
+            elif barPart == 'upper':
+                helper_appendSvgRectangleInCycle(svg, toPx, t1, duration, y1 + 0.5 * barHeight, 0.5 * barHeight, cycleLength, color)
+            else:
+                helper_appendSvgRectangleInCycle(svg, toPx, t1, duration, y1, barHeight, cycleLength, color)
+
+        # text and symbol of the phase (drawn after all bars, as in the plot texts are above patches)
+        xText, yName = toPx(helper_modifyCyclicTimepoint(startTime + lateStart + redAmber + 1, cycleLength), y1 + 0.51)
+        labels.append('<text x="%.1f" y="%.1f" font-family="SimHei, sans-serif" font-style="italic" font-size="%.1f">%s</text>'
+                      % (xText, yName, int(14 * fontsizeModifier) * ptToPx, escape(phaseName)))
+        text, rotation = getPhasePlotLabelAndRotation(phaseName)
+        if text != '':
+            _, yText = toPx(0, y1 + 0.18)
+            labels.append('<text x="%.1f" y="%.1f" font-family="DejaVu Sans, sans-serif" font-size="%.1f" xml:space="preserve"'
+                          ' transform="rotate(%d %.1f %.1f)">%s</text>'
+                          % (xText, yText, int(15 * fontsizeModifier) * ptToPx, -rotation, xText, yText, escape(text)))
+    svg.extend(labels)
+
+    # Axes frame, ticks and labels
+    svg.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="none" stroke="black"/>' % (axX0, axY0, axX1 - axX0, axY1 - axY0))
+    for xtick in helper_getXtickList(cycleLength):
+        x, _ = toPx(xtick, yMin)
+        svg.append('<line x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f" stroke="black"/>' % (x, axY1, x, axY1 + 3.5 * ptToPx))
+        svg.append('<text x="%.1f" y="%.1f" font-family="sans-serif" font-size="%.1f" text-anchor="middle">%d</text>'
+                   % (x, axY1 + 16 * ptToPx, 12 * ptToPx, xtick))
+    svg.append('<text x="%.1f" y="%.1f" font-family="sans-serif" font-size="%.1f" text-anchor="middle">Timeline within a cycle</text>'
+               % ((axX0 + axX1) / 2, axY1 + 36 * ptToPx, 16 * ptToPx))
+    svg.append('<text x="%.1f" y="%.1f" font-family="sans-serif" font-size="%.1f" text-anchor="middle" transform="rotate(-90 %.1f %.1f)">Phases</text>'
+               % (axX0 - 10 * ptToPx, (axY0 + axY1) / 2, 16 * ptToPx, axX0 - 10 * ptToPx, (axY0 + axY1) / 2))
+    svg.append('</svg>')
+    return '\n'.join(svg)
+
+def convertPlanResListToHtml(dict_resOfIntersections, columns=3, title='Signal times tables'):
+    '''
+    Show the timing diagrams of many intersections side by side in one HTML page.
+
+    Parameters:
+    dict_resOfIntersections(dict): {intersection name: resOfChat2SPaT}. A None plan (failed assembly) is shown as a message.
+    columns: number of diagrams per row.
+
+    Returns:
+    html(str): a standalone HTML page.
+    '''
+    html = ['<!DOCTYPE html>', '<html>', '<head>', '<meta charset="utf-8">', '<title>%s</title>' % escape(title),
+            '<style>',
+            '.grid {display: grid; grid-template-columns: repeat(%d, 1fr); gap: 16px;}' % columns,
+            '.grid svg {width: 100%; height: auto;}',
+            '.invalid h3 {color: red;}',
+            '</style>', '</head>', '<body>', '<h2>%s</h2>' % escape(title), '<div class="grid">']
+    for intersectionName, resOfChat2SPaT in dict_resOfIntersections.items():
+        if resOfChat2SPaT == None:
+            html.append('<div class="invalid"><h3>%s</h3><p>TSC plan cannot be assembled using the inputs.</p></div>' % escape(str(intersectionName)))
+            continue
+        isValid = resOfChat2SPaT.get('isValid', 1)
+        html.append('<div class="%s"><h3>%s%s</h3>' % ('valid' if isValid == 1 else 'invalid', escape(str(intersectionName)),
+                                                       '' if isValid == 1 else ' (INVALID)'))
+        html.append(convertPlanResToSvg(resOfChat2SPaT))
+        html.append('</div>')
+    html.extend(['</div>', '</body>', '</html>'])
+    return '\n'.join(html)
+
+# helper: add the svg rectangle(s) of an interval along the cycle, same as drawRectangleInCycle
+def helper_appendSvgRectangleInCycle(svg, toPx, t1, width, y1, height, cycleLength, color):
+    '''t1->t2, or 0->t2 + t1 -> cycleLength; (t1, y1) is the lower left corner in data coordinates'''
+    t2 = (t1 + width) % cycleLength
+    if width == 0:
+        return
+    if t1 < t2:  # 周期内的长方形
+        intervals = [[t1, t2]]
+    else:  # 跨周期的两个长方形
+        intervals = []
+        if cycleLength - t1 > 0:
+            intervals.append([t1, cycleLength])
+        if t2 > 0:
+            intervals.append([0, t2])
+    for tStart, tEnd in intervals:
+        x0, y0 = toPx(tStart, y1 + height)
+        x1, y1Px = toPx(tEnd, y1)
+        svg.append('<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="%s" stroke="black"/>' % (x0, y0, x1 - x0, y1Px - y0, color))
@@ -0,0 +1,267 @@
+# What-if sweep: validity of an assembled plan under a grid of clearance and split changes, without re-assembling each variant
+#
+# The phase stages of the assembled plan (planSchemeMinorMerged) are read once into arrays. A variant adds deltas to the
+# clearance attributes of all phase stages (values clipped at 0) and / or scales the start and end times to a new cycle length.
+# The color codes of all variants with the same cycle length are painted as one (variants, phases, seconds) array, as
+# paintLightColorRec does phase stage by phase stage, then the conflicting phases (conflictMatrix) and the WALK intervals
+# are checked for all variants at once, as checkConflictPhases and checkPedWalkIntvl do.
+#
+# Run: python whatIfSweep.py [--plans 300]
+import itertools
+
+import numpy as np
+
+from Chat2SPaT import conflictMatrix, helper_getSubValueFromPhase
+
+SWEEP_ATTRIBUTES = ['yellow', 'allRed', 'greenFlash', 'redAmber', 'lateStart', 'earlyCutOff']
+# Attributes of a phase stage read by paintLightColorRec
+STAGE_ATTRIBUTES = ['startTime', 'split', 'lateStart', 'greenFlash', 'yellow', 'allRed', 'redAmber', 'earlyCutOff', 'countDown', 'isPermissive']
+
+def buildSweepGrid(cycleLength=(None,), **dict_deltas):
+    '''
+    All combinations of the given values, as a list of variants.
+
+    Parameters:
+    cycleLength: new cycle lengths (None keeps the cycle length of the plan).
+    dict_deltas: attribute (in SWEEP_ATTRIBUTES) -> deltas (s), e.g. allRed=[0, 1, 2], greenFlash=[0, -99] (-99 removes greenFlash).
+
+    Returns:
+    variants(list): [{'cycleLength': 130, 'allRed': 2, 'greenFlash': -99}, ...]
+    '''
+    unknown = [_ for _ in dict_deltas if _ not in SWEEP_ATTRIBUTES]
+    if len(unknown) > 0:
+        raise ValueError('Unknown sweep attributes: %s' % unknown)
+    keys = ['cycleLength'] + list(dict_deltas)
+    return [dict(zip(keys, values)) for values in itertools.product(cycleLength, *dict_deltas.values())]
+
+def getPlanStructure(resOfChat2SPaT):
+    '''
+    Phase stages of an assembled plan as arrays, for sweepPlan.
+
+    Returns:
+    dict of cycleLength, phaseNames (rows of the color arrays), row (phase row of each phase stage), isPed, and one int array
+    per attribute in STAGE_ATTRIBUTES (defaults as helper_getSubValueFromPhase).
+    '''
+    planScheme = [_ for _ in resOfChat2SPaT['planSchemeMinorMerged'] if helper_getSubValueFromPhase('phaseName', _) != 'DUMMYPHASE']
+    phaseNames = sorted(set(helper_getSubValueFromPhase('phaseName', _) for _ in planScheme))
+    dict_rowOfPhase = {k: i for i, k in enumerate(phaseNames)}
+    lengths = sorted(len(resOfChat2SPaT['dict_lightColorRec'][_]) for _ in phaseNames)
+    res = {'cycleLength': lengths[len(lengths) // 2] if len(lengths) > 0 else 0, 'phaseNames': phaseNames,
+           'row': np.array([dict_rowOfPhase[helper_getSubValueFromPhase('phaseName', _)] for _ in planScheme], dtype=np.int64),
+           'isPed': np.array([('行人' in k or 'PED' in k) for k in (helper_getSubValueFromPhase('phaseName', _) for _ in planScheme)], dtype=bool)}
+    for attr in STAGE_ATTRIBUTES:
+        res[attr] = np.array([helper_getSubValueFromPhase(attr, _) for _ in planScheme], dtype=np.int64)
+    return res
+
+def sweepPlan(resOfChat2SPaT, variants, returnColors=False):
+    '''
+    Evaluate the variants of an assembled plan.
+
+    Parameters:
+    resOfChat2SPaT(dict): the assembled plan obj, or its structure (getPlanStructure) to evaluate several grids.
+    variants(list): see buildSweepGrid.
+    returnColors: also return the color codes of each variant.
+
+    Returns:
+    dict of variants, isValid (bool array, one per variant), and per variant: warningMsgConflictPhases and warningMsgPedWalk
+    (as the fields of the plan obj), walkLengths (ped phase -> WALK durations) and, if returnColors, colors (phases x seconds int8 array).
+    '''
+    structure = resOfChat2SPaT if 'row' in resOfChat2SPaT else getPlanStructure(resOfChat2SPaT)
+    V = len(variants)
+    res = {'variants': variants, 'isValid': np.zeros(V, dtype=bool), 'warningMsgConflictPhases': [None] * V,
+           'warningMsgPedWalk': [None] * V, 'walkLengths': [None] * V}
+    if returnColors:
+        res['colors'] = [None] * V
+    # Variants with the same cycle length are evaluated together
+    dict_variantsOfCycle = {}
+    for v, variant in enumerate(variants):
+        dict_variantsOfCycle.setdefault(variant.get('cycleLength') or structure['cycleLength'], []).append(v)
+    for cycleLength, variantNums in dict_variantsOfCycle.items():
+        colors = helper_paintVariants(structure, [variants[v] for v in variantNums], cycleLength)
+        conflicts = helper_checkConflictsOfVariants(structure['phaseNames'], colors)
+        walkLengths, warningsOfWalk = helper_getWalkLengthsOfVariants(structure['phaseNames'], colors)
+        for i, v in enumerate(variantNums):
+            res['warningMsgConflictPhases'][v] = conflicts[i]
+            res['warningMsgPedWalk'][v] = warningsOfWalk[i]
+            res['walkLengths'][v] = walkLengths[i]
+            res['isValid'][v] = len(conflicts[i]) == 0 and len(warningsOfWalk[i]) == 0
+            if returnColors:
+                res['colors'][v] = colors[i]
+    return res
+
+def sweepPlans(resOfPlans, variants):
+    '''
+    sweepPlan for each plan of a batch (None entries are skipped).
+
+    Returns:
+    isValid(array): plans x variants validity mask (False for None plans).
+    '''
+    isValid = np.zeros((len(resOfPlans), len(variants)), dtype=bool)
+    for p, resOfChat2SPaT in enumerate(resOfPlans):
+        if resOfChat2SPaT != None:
+            isValid[p] = sweepPlan(resOfChat2SPaT, variants)['isValid']
+    return isValid
+
+# helper: color codes of the variants (variants x phases x seconds), painted as paintLightColorRec and helper_paintLightColor do
+def helper_paintVariants(structure, variants, cycleLength):
+    V, S = len(variants), len(structure['row'])
+    # Step 1: Attributes of each variant and phase stage (variants x phase stages)
+    dict_values = {}
+    for attr in STAGE_ATTRIBUTES:
+        deltas = np.array([_.get(attr, 0) for _ in variants], dtype=np.int64)[:, None]
+        dict_values[attr] = np.maximum(structure[attr][None, :] + deltas, 0) if attr in SWEEP_ATTRIBUTES\
+            else np.broadcast_to(structure[attr][None, :], (V, S))
+    startTime, split = dict_values['startTime'], dict_values['split']
+    if cycleLength != structure['cycleLength']:  # start and end times scaled to the new cycle length
+        endTime = np.rint((startTime + split) * cycleLength / structure['cycleLength']).astype(np.int64)
+        startTime = np.rint(startTime * cycleLength / structure['cycleLength']).astype(np.int64)
+        split = endTime - startTime
+    lateStart, greenFlash, yellow, allRed, redAmber, earlyCutOff, countDown =\
+        [dict_values[_] for _ in ['lateStart', 'greenFlash', 'yellow', 'allRed', 'redAmber', 'earlyCutOff', 'countDown']]
+
+    # Step 2: Paint the phase stages in order, each paint for all variants at once
+    colors = np.zeros((V, len(structure['phaseNames']), cycleLength), dtype=np.int8)
+    t = np.arange(cycleLength)[None, :]
+    def paint(s, start, duration, colorCode):
+        start, end = start[:, None], start[:, None] + duration[:, None]
+        # helper_paintLightColor: [start, end) within the cycle, and the part beyond the cycle painted from second 0
+        mask = ((t >= start) & (t < np.minimum(end, cycleLength))) | (t < end - cycleLength)
+        colors[:, structure['row'][s], :][mask] = colorCode  # a view of the row of the phase
+    for s in range(S):
+        start = startTime[:, s] + lateStart[:, s]
+        if structure['isPed'][s]:
+            walk = split[:, s] - lateStart[:, s] - countDown[:, s] - allRed[:, s] - earlyCutOff[:, s]
+            paint(s, start, walk, 2)
+            paint(s, start + walk, countDown[:, s], 3)
+        else:
+            green = split[:, s] - lateStart[:, s] - greenFlash[:, s] - yellow[:, s] - allRed[:, s] - earlyCutOff[:, s]
+            if structure['isPermissive'][s] == 0:
+                paint(s, start, green, 2)
+                paint(s, start + green, greenFlash[:, s], 3)
+            else:
+                paint(s, start, green + greenFlash[:, s], -1)
+            paint(s, start + green + greenFlash[:, s], yellow[:, s], 1)
+            paint(s, start, redAmber[:, s], 4)
+    return colors
+
+# helper: warningMsgConflictPhases of each variant, as checkConflictPhases (intervals [start, end) of the seconds in conflict)
+def helper_checkConflictsOfVariants(phaseNames, colors):
+    dictOpposite = {'东': '西', '西': '东', '北': '南', '南': '北', 'E': 'W', 'W': 'E', 'N': 'S', 'S': 'N'}
+    dict_rowOfPhase = {k: i for i, k in enumerate(phaseNames)}
+    res = [{} for _ in range(colors.shape[0])]
+    checkedPhaseNames = set([])
+    for phaseName in phaseNames:
+        if phaseName not in conflictMatrix:
+            continue
+        for phaseConflictName in conflictMatrix[phaseName]:
+            if phaseConflictName in checkedPhaseNames or phaseConflictName not in dict_rowOfPhase:
+                continue
+            # through and opposite permissive left-turn: not a conflict while the left-turn is permissive (-1) or yellow (1)
+            exemptByConflictPhase = ('直行' in phaseName and '左转' in phaseConflictName or 'BT' in phaseName and 'BL' in phaseConflictName)\
+                                    and dictOpposite[phaseName[0]] == phaseConflictName[0]
+            exemptByPhase = ('左转' in phaseName and '直行' in phaseConflictName or 'BL' in phaseName and 'BT' in phaseConflictName)\
+                            and dictOpposite[phaseName[0]] == phaseConflictName[0]
+            colorsOfPhase, colorsOfConflict = colors[:, dict_rowOfPhase[phaseName]], colors[:, dict_rowOfPhase[phaseConflictName]]
+            conflicted = (colorsOfPhase != 0) & (colorsOfConflict != 0)
+            if exemptByConflictPhase:
+                conflicted &= (colorsOfConflict != -1) & (colorsOfConflict != 1)
+            if exemptByPhase:
+                conflicted &= (colorsOfPhase != -1) & (colorsOfPhase != 1)
+            for v, intervals in helper_getRuns(conflicted).items():
+                res[v]['%s|%s' % (phaseName, phaseConflictName)] = intervals
+        checkedPhaseNames.add(phaseName)
+    return res
+
+# helper: WALK durations of the ped phases of each variant, with a WALK crossing the end of the cycle counted once, and
+# warningMsgPedWalk as checkPedWalkIntvl (which checks the phases with '行人' or 'Ped' in their names)
+def helper_getWalkLengthsOfVariants(phaseNames, colors):
+    V, T = colors.shape[0], colors.shape[2]
+    walkLengths, warningsOfWalk = [{} for _ in range(V)], [{} for _ in range(V)]
+    for i, phaseName in enumerate(phaseNames):
+        if '行人' not in phaseName and 'PED' not in phaseName.upper():
+            continue
+        isWalk = colors[:, i] == 2
+        dict_runs = helper_getRuns(isWalk)
+        for v in range(V):
+            walks = [t2 - t1 for t1, t2 in dict_runs.get(v, [])]
+            if len(walks) > 0 and isWalk[v, 0] and isWalk[v, -1]:
+                walks = [walks[0] + walks[-1]] + walks[1:-1]  # as checkPedWalkIntvl: an all-WALK cycle has no WALK interval
+            walkLengths[v][phaseName] = walks
+            walksShort = [_ for _ in walks if _ < 7]
+            if len(walksShort) > 0 and ('行人' in phaseName or 'Ped' in phaseName):
+                warningsOfWalk[v][phaseName + ' WALK too short'] = walksShort
+    return walkLengths, warningsOfWalk
+
+# helper: runs of True of each row of a bool matrix, {row: [[start, end], ...]} (rows without run are left out)
+def helper_getRuns(mask):
+    padded = np.zeros((mask.shape[0], mask.shape[1] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask
+    edges = np.diff(padded, axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    res = {}
+    for v, t1, t2 in zip(rows.tolist(), starts.tolist(), ends.tolist()):
+        res.setdefault(v, []).append([t1, t2])
+    return res
+
+if __name__ == '__main__':
+    import argparse
+    import copy
+    import random
+    import time
+    from Chat2SPaT import paintLightColorRec, checkConflictPhases, checkPedWalkIntvl
+    from assemblyEngines import assemblePlanWithEngine
+    from planGenerator import generateSyntheticPlan
+
+    parser = argparse.ArgumentParser(description='What-if sweep of clearance changes over synthetic plans.')
+    parser.add_argument('--plans', type=int, default=300)
+    args = parser.parse_args()
+
+    rnd = random.Random(0)
+    resOfPlans = []
+    for i in range(args.plans):
+        try:
+            resStr = generateSyntheticPlan(seed=i, numStages=rnd.choice([3, 4]), numRings=rnd.choice([0, 0, 2]), numPedPhases=rnd.choice([0, 2]),
+                                           numPermissivePhases=rnd.choice([0, 2]), language=rnd.choice(['en', 'zh']))
+        except ValueError:  # a combination of knobs the generator does not support
+            continue
+        resOfPlans.append(assemblePlanWithEngine(resStr, 'fast'))
+    variants = buildSweepGrid(cycleLength=[None, 80], allRed=[0, 1, 2], yellow=[0, 1], greenFlash=[0, -99], lateStart=[0, 3])
+
+    t0 = time.perf_counter()
+    isValid = sweepPlans(resOfPlans, variants)
+    seconds = time.perf_counter() - t0
+    print('%d plans x %d variants in %.2f s (%.0f us per variant); valid: %d plans as assembled, %d plans in all variants'
+          % (len(resOfPlans), len(variants), seconds, seconds / isValid.size * 1e6, isValid[:, 0].sum(), isValid.all(axis=1).sum()))
+    assert (isValid[:, 0] == np.array([_['isValid'] == 1 for _ in resOfPlans])).all()  # the plans as assembled
+    for k in np.argsort(-(~isValid).sum(axis=0), kind='stable')[:5]:
+        print('  %s: %d plans invalid' % (variants[k], (~isValid[:, k]).sum()))
+
+    # Cross-check with the reference steps on the modified plan schemes (and a new cycle length)
+    variants = variants[:24] + buildSweepGrid(cycleLength=[90, 150], allRed=[0, 2])
+    t0 = time.perf_counter()
+    mismatches = checked = 0
+    for resOfChat2SPaT in resOfPlans[:50]:
+        resOfSweep = sweepPlan(resOfChat2SPaT, variants, returnColors=True)
+        structure = getPlanStructure(resOfChat2SPaT)
+        for v, variant in enumerate(variants):
+            planScheme = copy.deepcopy([_ for _ in resOfChat2SPaT['planSchemeMinorMerged'] if helper_getSubValueFromPhase('phaseName', _) != 'DUMMYPHASE'])
+            cycleLength = variant['cycleLength'] or structure['cycleLength']
+            for phase in planScheme:
+                phaseInfo = phase[helper_getSubValueFromPhase('phaseName', phase)]
+                for attr in SWEEP_ATTRIBUTES:
+                    phaseInfo[attr] = max(helper_getSubValueFromPhase(attr, phase) + variant.get(attr, 0), 0)
+                if cycleLength != structure['cycleLength']:
+                    startTime, endTime = phaseInfo['startTime'], phaseInfo['startTime'] + phaseInfo['split']
+                    phaseInfo['startTime'] = int(np.rint(startTime * cycleLength / structure['cycleLength']))
+                    phaseInfo['split'] = int(np.rint(endTime * cycleLength / structure['cycleLength'])) - phaseInfo['startTime']
+            dict_lightColorRec = paintLightColorRec(planScheme, cycleLength)
+            if any(len(_) != cycleLength for _ in dict_lightColorRec.values()):
+                continue  # paints longer than a cycle extend the rows of the reference
+            checked += 1
+            colors = np.array([dict_lightColorRec[_] for _ in structure['phaseNames']])
+            if not (colors == resOfSweep['colors'][v]).all() or checkConflictPhases(dict_lightColorRec) != resOfSweep['warningMsgConflictPhases'][v]\
+                    or checkPedWalkIntvl(dict_lightColorRec) != resOfSweep['warningMsgPedWalk'][v]:
+                mismatches += 1
+    print('cross-check with the reference steps: %d mismatches of %d variants (%.2f s)' % (mismatches, checked, time.perf_counter() - t0))
+    assert mismatches == 0